@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from models.scenario import ScenarioConfig
+from models.trace import Trace, TraceField
+from utils.theaterq import TheaterQHandler, TheaterQDualLinkSettings, TheaterQContMode
+from utils.theaterq_mock import MockTheaterQ
+from utils.trace_buffer import TraceBuffer
+from constants import TRACE_BUFFER_PATH
+from utils.trace_generator import (TraceSynthesizer, SawtoothModifier,
+                                   GilbertElliottModifier, write_scenario)
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+MARKER_UPDATES = 100
+VIDEO_UPDATES = 30
+POLL_UPDATES = 10
+PLOT_BUCKETS = 930 # Pixel columns of the trace plot
+
+
+@dataclass
+class StageResult:
+    stage: str
+    entries: int
+    seconds: float
+    peak_bytes: int
+
+    @property
+    def key(self) -> str:
+        return f"{self.stage}@{self.entries}"
+
+
+def measure(stage: str, entries: int, target: Callable[[], None],
+            repeat: int) -> StageResult:
+    # Timing runs without tracemalloc, its hooks distort the results
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        target()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    target()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return StageResult(stage=stage, entries=entries, seconds=best, peak_bytes=peak)
+
+
+def prepare_scenario(workdir: str, entries: int) -> str:
+    synthesizer = TraceSynthesizer(entries=entries, seed=entries,
+                                   modifiers=[SawtoothModifier(TraceField.RATE, 5000000, 50000000, 60000000),
+                                              GilbertElliottModifier(p=0.01, r=0.3, loss_bad=0.5)])
+    write_scenario(workdir, f"Benchmark {entries}", "", synthesizer, synthesizer,
+                   basename=f"bench-{entries}")
+
+    # Simple format copy for the simple_parse stage
+    simple_path = os.path.join(workdir, f"simple-{entries}.csv")
+    with open(simple_path, "w") as handle:
+        handle.write("keep,latency,rate,loss,limit\n")
+        for chunk in synthesizer.chunks():
+            data = chunk.data[:, [TraceField.KEEP, TraceField.LATENCY, TraceField.RATE,
+                                  TraceField.LOSS, TraceField.LIMIT]]
+            handle.write((("%d,%d,%d,%d,%d\n") * len(data)) % tuple(data.ravel().tolist()))
+
+    return simple_path
+
+
+class HeadlessDisplay:
+    def __init__(self):
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> bool:
+        if os.environ.get("DISPLAY"):
+            return True
+
+        if shutil.which("Xvfb") is None:
+            return False
+
+        display = ":97"
+        self.process = subprocess.Popen(["Xvfb", display, "-screen", "0", "1920x1080x24"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.environ["DISPLAY"] = display
+        time.sleep(1)
+        return self.process.poll() is None
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def run_core_stages(workdir: str, entries: int, repeat: int, use_fifo: bool) -> List[StageResult]:
+    simple_path = prepare_scenario(workdir, entries)
+    results = []
+
+    files = [Path(workdir) / f"forward-bench-{entries}.csv", Path(workdir) / f"return-bench-{entries}.csv"]
+    buffer_path = os.path.join(TRACE_BUFFER_PATH, f"{TraceBuffer.key(files, 'extended', None)}.trace")
+
+    def load():
+        ScenarioConfig(name="bench", description="", basepath=workdir, trace_format="extended",
+                       forward_file=f"forward-bench-{entries}.csv",
+                       return_file=f"return-bench-{entries}.csv")
+
+    def parse():
+        # Without the trace buffer of the previous run
+        if os.path.exists(buffer_path):
+            os.remove(buffer_path)
+        load()
+    results.append(measure("scenario_parse", entries, parse, repeat))
+    results.append(measure("scenario_map", entries, load, repeat))
+
+    scenario = ScenarioConfig(name="bench", description="", basepath=workdir, trace_format="extended",
+                              forward_file=f"forward-bench-{entries}.csv",
+                              return_file=f"return-bench-{entries}.csv")
+
+    with open(simple_path, "r") as handle:
+        simple_lines = handle.readlines()
+    results.append(measure("simple_parse", entries,
+                           lambda: Trace.from_lines(simple_lines, simple=True), repeat))
+    del simple_lines
+
+    def plot_data():
+        # Cached per scenario, measured without the previous result
+        scenario.plot_data.clear()
+        scenario.get_plot_data().aggregate(PLOT_BUCKETS)
+    results.append(measure("get_plot_data", entries, plot_data, repeat))
+    results.append(measure("get_length_ns", entries,
+                           lambda: scenario.get_length_ns(), repeat))
+
+    # A FIFO behaves like the character device: the writer blocks until
+    # the reader has consumed the data.
+    mock = MockTheaterQ(os.path.join(workdir, f"mock-{entries}"), fifo=use_fifo, arm_delay=0)
+    mock.start(["bench0", "bench1"])
+    handler = TheaterQHandler(forward_interface="bench0", return_interface="bench1",
+                              **mock.handler_options())
+
+    results.append(measure("load_trace_file", entries, 
+                           lambda: handler.load_trace_file("bench0", scenario.forward_trace),
+                           repeat))
+
+    handler.update(TheaterQDualLinkSettings(scenario.forward_trace, scenario.return_trace,
+                                            contmode=TheaterQContMode.LOOP))
+    handler.start()
+    handler.get_details() # Builds the index of the mock
+
+    def poll():
+        for _ in range(POLL_UPDATES):
+            handler.get_details()
+    results.append(measure(f"get_details_x{POLL_UPDATES}", entries, poll, repeat))
+
+    handler.clean()
+    mock.stop()
+    return results
+
+
+def run_gui_stages(workdir: str, entries: int, repeat: int) -> List[StageResult]:
+    import tkinter as tk
+    from tkinter import ttk
+    from modes.emulator import EmulatorMode
+
+    scenario = ScenarioConfig(name="bench", description="", basepath=workdir, trace_format="extended",
+                              forward_file=f"forward-bench-{entries}.csv",
+                              return_file=f"return-bench-{entries}.csv")
+
+    root = tk.Tk()
+    root.geometry("1920x1080")
+    frame = ttk.Frame(root)
+    frame.pack(fill="both", expand=True)
+
+    # Only the attributes used by the plot functions are required
+    mode = EmulatorMode.__new__(EmulatorMode)
+    mode.scenario = scenario
+    mode.trace_plot_area = frame
+    mode.trace_plot_hint = ttk.Label(frame, text="")
+    mode.trace_plot_return_file = False
+    mode.current_time = 0
+    mode.canvas = None
+    mode.canvas_lock = threading.Lock()
+
+    results = []
+
+    def init_draw():
+        mode.trace_plot_clear()
+        mode.trace_plot_init_draw()
+        root.update()
+    results.append(measure("plot_init_draw", entries, init_draw, repeat))
+
+    length = scenario.get_length_ns() / 1e9
+    def marker():
+        for i in range(MARKER_UPDATES):
+            mode.trace_plot_update_marker(length * i / MARKER_UPDATES)
+            root.update()
+    results.append(measure(f"plot_marker_x{MARKER_UPDATES}", entries, marker, repeat))
+    mode.trace_plot_clear()
+
+    video = make_video(workdir)
+    if video is not None:
+        from utils.video_player import VideoPlayer
+        player = VideoPlayer(frame, video, height=300, width=720)
+
+        def video_update():
+            for i in range(VIDEO_UPDATES):
+                player.update(i)
+                root.update()
+        results.append(measure(f"video_update_x{VIDEO_UPDATES}", entries, video_update, repeat))
+        del player
+
+    root.destroy()
+    return results
+
+
+def make_video(workdir: str) -> Optional[str]:
+    try:
+        import cv2
+        import numpy as np
+    except ImportError:
+        print("OpenCV not available, skipping video stage.")
+        return None
+
+    path = os.path.join(workdir, "bench.mp4")
+    if os.path.exists(path):
+        return path
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 25, (1280, 720))
+    rng = np.random.default_rng(0)
+    for _ in range(25 * VIDEO_UPDATES):
+        writer.write(rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def compare(results: List[StageResult], baseline: Dict[str, Dict], tolerance: float,
+            min_delta: float = 0.0) -> bool:
+    ok = True
+    print(f"{'stage':<24}{'entries':>10}{'time (s)':>12}{'baseline':>12}{'ratio':>8}{'peak (MiB)':>12}")
+    for result in results:
+        reference = baseline.get(result.key)
+        ratio = ""
+        reference_time = ""
+        if reference is not None:
+            factor = result.seconds / max(reference["seconds"], 1e-9)
+            ratio = f"{factor:.2f}"
+            reference_time = f"{reference['seconds']:.4f}"
+            # Sub-millisecond stages are dominated by timer and scheduling noise
+            if factor > 1 + tolerance and result.seconds - reference["seconds"] > min_delta:
+                ratio += " !"
+                ok = False
+
+        print(f"{result.stage:<24}{result.entries:>10}{result.seconds:>12.4f}{reference_time:>12}"
+              f"{ratio:>8}{result.peak_bytes / (1 << 20):>12.1f}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Frontend Benchmark")
+    parser.add_argument("--sizes", "-s", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Trace sizes (entries) to benchmark, up to 10000000")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="Timing repetitions per stage (best is reported)")
+    parser.add_argument("--fifo", action="store_true", help="Use a FIFO instead of a regular file as mock TheaterQ device")
+    parser.add_argument("--no-gui", action="store_true", help="Skip the Tk/matplotlib/OpenCV stages")
+    parser.add_argument("--baseline", "-b", type=str, default=DEFAULT_BASELINE, help="Path to baseline JSON")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as new baseline")
+    parser.add_argument("--tolerance", "-t", type=float, default=0.2, help="Allowed slowdown relative to the baseline")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="Slowdowns below this many seconds are not reported as regression")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="emulator-bench-")
+    display = HeadlessDisplay()
+    gui = not args.no_gui and display.start()
+    if not args.no_gui and not gui:
+        print("No display and no Xvfb available, skipping GUI stages.")
+
+    results: List[StageResult] = []
+    try:
+        for size in args.sizes:
+            results.extend(run_core_stages(workdir, size, args.repeat, args.fifo))
+            if gui:
+                results.extend(run_gui_stages(workdir, size, args.repeat))
+    finally:
+        display.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as handle:
+            baseline = json.load(handle)
+
+    ok = compare(results, baseline, args.tolerance, args.min_delta)
+
+    serialized = {result.key: asdict(result) for result in results}
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(serialized, handle, indent=4)
+
+    if args.update_baseline:
+        baseline.update(serialized)
+        with open(args.baseline, "w") as handle:
+            json.dump(baseline, handle, indent=4)
+        print(f"Baseline updated: {args.baseline}")
+
+    sys.exit(0 if ok or args.update_baseline else 1)
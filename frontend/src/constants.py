@@ -8,3 +8,18 @@ BRIDGE_MODE_BRIDGE_NAME="br0"
 
 PUBLIC_NETNS_NAME="public"
 NETNS_RIGHT_BRIDGE_NAME="right-br"
+
+THEATERQ_DEVICE_TEMPLATE="/dev/theaterq:{dev}:{handle}:0"
+
+SESSION_FALLBACK_PATH="/tmp/emulator-sessions"
+CAPTURE_RING_PATH="/dev/shm/emulator-capture"
+
+REPLAY_DISPLAY_INTERVAL_MS=40
+PUBLIC_VLAN_READD_DELAY=5.0 # s
+REALPATH_TRACE_GRANULARITY=100000 # µs
+NFT_TABLE="emulator"
+REPLAY_STATE_PATH="/dev/shm/emulator-replay.json"
+TRACE_BUFFER_PATH="/dev/shm/emulator-traces"
+TRACE_BUFFER_MEMORY_SHARE=0.25 # of MemTotal, tmpfs pages are not reclaimed under pressure
+HELPER_SOCKET_PATH="/run/emulator/helper.sock"
+HELPER_COMMAND_TIMEOUT=30.0 # s
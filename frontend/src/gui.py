@@ -61,6 +61,9 @@ class EmulationDemonstrator:
 
     def __on_tab_change(self, event):
         selected_tab = event.widget.select()
+        if not selected_tab:
+            return
+
         index = event.widget.index(selected_tab)
         new_tab = self.tabs[index]
 
@@ -95,6 +98,12 @@ class EmulationDemonstrator:
         self.tab_control.add(frame, text=name)
         self.tabs.append(mode)
     
+    def remove_tabs(self) -> None:
+        for tab in self.tab_control.tabs():
+            self.tab_control.forget(tab)
+        self.tabs.clear()
+        self.active = None
+
     def enable_first_tab(self) -> None:
         if len(self.tabs) == 0:
             raise ValueError("Cannt enable without tabs.")
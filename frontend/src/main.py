@@ -18,10 +18,14 @@
 #
 
 import argparse
-import tkinter as tk
 import os
 
-from typing import List
+from utils.startup_profiler import StartupProfiler
+startup = StartupProfiler()
+
+import tkinter as tk
+
+from typing import List, Optional
 from threading import Thread
 
 from gui import EmulationDemonstrator
@@ -29,10 +33,17 @@ from utils.logger import *
 from modes.passthrough import PassthroughMode
 from modes.emulator import EmulatorMode
 from modes.realpath import RealpathMode
+from utils.firewall import Firewall
+from utils.reconciler import Reconciler
+from utils.cpu_isolation import CpuIsolation
 from constants import RIGHT_INTERFACE, LEFT_INTERFACE
 from models.operation import OperationMode
+from utils.theaterq_mock import MockTheaterQ
+from utils.theaterq import TheaterQClassifier
 from models.config import *
 
+startup.mark("imports")
+
 
 def check_interfaces(names: List[str]) -> bool:
     existing_interfaces = os.listdir('/sys/class/net/')
@@ -44,86 +55,142 @@ def check_interfaces(names: List[str]) -> bool:
 
 def clean(config: FullConfig, debug: bool = False) -> None:
     try:
-        EmulatorMode.cleanup_old_config(config, RIGHT_INTERFACE, LEFT_INTERFACE, dryrun=debug)
+        Reconciler(config, None, RIGHT_INTERFACE, LEFT_INTERFACE, dryrun=debug).apply()
     except Exception as ex:
         Logger.error(f"Unhandeled exception during interface cleanup: {ex}")
 
-    realpath = RealpathMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, None, debug)
-    try:
-        realpath.cleanup_old_config()
-    except Exception as ex:
-        Logger.error(f"Unhandeled exception during interface cleanup: {ex}")
+    Firewall(config, dryrun=debug).remove()
+
+
+def isolate_cpus(config: CpuConfig, interfaces: List[str], debug: bool = False) -> None:
+    # Threads started later inherit the affinity, steering the interrupts is done
+    # in the background, as it needs a privileged command per IRQ and queue.
+    isolation = CpuIsolation(config, interfaces, dryrun=debug)
+    threads = isolation.pin()
+
+    def steer():
+        report = isolation.apply(pin_process=False)
+        report.threads = threads
+        Logger.info(f"CPU isolation: {report}")
+        for error in report.errors:
+            Logger.warning(f"CPU isolation: {error}")
+
+    Thread(target=steer, name="cpu", daemon=True).start()
+
+
+def prewarm_plotting() -> None:
+    # Imports matplotlib and loads (or builds) its font cache before the first plot
+    with startup.phase("matplotlib"):
+        import matplotlib.pyplot
+        from matplotlib.backends import backend_tkagg
+        from matplotlib import font_manager
+        font_manager.findfont(font_manager.FontProperties())
+    Logger.debug(f"Plotting prewarmed after {startup.now():.2f} s")
+
+
+def startup_finished() -> None:
+    startup.report()
+    Thread(target=prewarm_plotting, name="prewarm", daemon=True).start()
 
 
 def main(config: FullConfig, debug: bool = False, verbose: bool = False, 
-         mode: OperationMode = OperationMode.ROUTED) -> None:
-    root = tk.Tk()
-    window = EmulationDemonstrator(root, debug)
-    Logger.set_logger(window, root, verbose)
+         mode: OperationMode = OperationMode.ROUTED, poll_interval: float = 10.0,
+         sample_interval: float = 1.0, mock: Optional[MockTheaterQ] = None) -> None:
+    with startup.phase("window"):
+        root = tk.Tk()
+        window = EmulationDemonstrator(root, debug)
+        Logger.set_logger(window, root, verbose)
 
     if debug:
         Logger.warning("Tool is running in debug mode. No commands are executed.")
 
-    if not debug and not check_interfaces([RIGHT_INTERFACE, LEFT_INTERFACE]):
+    if mock is not None:
+        mock.start([RIGHT_INTERFACE, LEFT_INTERFACE])
+        for link in config.links:
+            mock.start([link.forward_interface, link.return_interface], link.handle)
+        if config.classful is not None:
+            for index in range(len(config.classful.classes)):
+                mock.start([RIGHT_INTERFACE, LEFT_INTERFACE], TheaterQClassifier.leaf_handle(index))
+        Logger.warning(f"Using mock TheaterQ in {mock.basedir}.")
+
+    link_interfaces = [name for link in config.links for name in [link.forward_interface, link.return_interface]]
+    if not debug and not check_interfaces([RIGHT_INTERFACE, LEFT_INTERFACE] + link_interfaces):
         Logger.critical("Required Interfaces are not up.")
         window.run_mainloop()
         sys.exit(1)
-    
-    try:
-        EmulatorMode.cleanup_old_config(config, RIGHT_INTERFACE, LEFT_INTERFACE, dryrun=debug)
-    except Exception as ex:
-        Logger.error(f"Unhandeled exception during interface cleanup: {ex}")
 
+    if config.cpu is not None:
+        isolate_cpus(config.cpu, CpuIsolation.interfaces_from_config(config), debug)
+    
+    # Only differences to the required network state are applied, leftovers of
+    # other modes are removed. Restarts with an unchanged state skip the setup.
+    reconciler = Reconciler(config, mode, RIGHT_INTERFACE, LEFT_INTERFACE, dryrun=debug)
 
     if mode == OperationMode.ROUTED or mode == OperationMode.BRIDGED:
-        try:
-            EmulatorMode.config_interfaces(config, RIGHT_INTERFACE, LEFT_INTERFACE, 
-                                           as_bridge=(mode == OperationMode.BRIDGED), 
-                                           dryrun=debug)
-        except Exception as ex:
-            Logger.critical(f"Unable to set up interfaces: {ex}")
+        # Interfaces are set up while the tabs are built, tabs are only enabled
+        # by the mainloop, which is started after the setup finished.
+        setup_errors = []
+        def config_interfaces():
+            with startup.phase("interfaces"):
+                try:
+                    reconciler.apply()
+                except Exception as ex:
+                    setup_errors.append(ex)
+
+        config_thread = Thread(target=config_interfaces, name="interfaces")
+        config_thread.start()
+
+        with startup.phase("tabs"):
+            passthrough = PassthroughMode(config, window, debug)
+            emulator = EmulatorMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, 
+                                    window, debug, poll_interval=poll_interval,
+                                    sample_interval=sample_interval, mock=mock)
+            emulator.add_tabs(window)
+            passthrough.add_tabs(window)
+
+        config_thread.join()
+        if setup_errors:
+            window.remove_tabs()
+            Logger.critical(f"Unable to set up interfaces: {setup_errors[0]}")
             window.run_mainloop()
             sys.exit(1)
-
-        passthrough = PassthroughMode(config, window, debug, masquerade=False)
-        emulator = EmulatorMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, 
-                                window, debug, masquerade=False)
-        emulator.add_tabs(window)
-        passthrough.add_tabs(window)
     elif mode == OperationMode.EXTENDED:
         window.show_init_screen("Waiting for interface configuration ...")
         realpath = RealpathMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, window, debug)
-        try:
-            realpath.cleanup_old_config()
-        except Exception as ex:
-            Logger.error(f"Unhandeled exception during interface cleanup: {ex}")
 
+        # The GUI is usable once the interfaces are set up, real path tabs
+        # become ready individually when their gateway appears.
         def config_interfaces_async():
-            try:
-                realpath.config_interfaces()
-
-                def __event_submit(window):
-                    window.stop_init_screen()
-                
-                window.add_async_event(__event_submit, window=window)
-            except Exception as ex:
-                Logger.critical(f"Unable to set up interfaces: {ex}")
+            with startup.phase("interfaces"):
+                try:
+                    # An incomplete real path topology is rebuilt from scratch
+                    plan = reconciler.apply()
+                    if plan.bringup_missing:
+                        realpath.cleanup_old_config()
+                    realpath.config_interfaces(ready_callback=window.stop_init_screen, 
+                                               links_ready=not plan.bringup_missing)
+                except Exception as ex:
+                    Logger.critical(f"Unable to set up interfaces: {ex}")
         
         config_thread = Thread(target=config_interfaces_async)
         config_thread.start()
 
-        passthrough = PassthroughMode(config, window, debug, masquerade=True)
-        emulator = EmulatorMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, window, 
-                                debug, masquerade=True)
-        emulator.add_tabs(window)
-        passthrough.add_tabs(window)
-        realpath.add_tabs(window)
+        with startup.phase("tabs"):
+            passthrough = PassthroughMode(config, window, debug, firewall=realpath.firewall)
+            emulator = EmulatorMode(config, RIGHT_INTERFACE, LEFT_INTERFACE, window, 
+                                    debug, firewall=realpath.firewall, poll_interval=poll_interval,
+                                    sample_interval=sample_interval, mock=mock)
+            emulator.add_tabs(window)
+            passthrough.add_tabs(window)
+            realpath.add_tabs(window)
+            realpath.session_path = emulator.provider.get_session_path
     else:
         Logger.critical(f"Unknown operation mode: {mode}")
         window.run_mainloop()
         sys.exit(1)
 
     Logger.info("Demonstrator loaded.")
+    root.after_idle(startup_finished)
     window.run_mainloop()
 
 
@@ -134,6 +201,14 @@ if __name__ == "__main__":
     parser.add_argument("--mode", "-m", type=str, choices=[str(OperationMode.BRIDGED), str(OperationMode.ROUTED), str(OperationMode.EXTENDED)],
                         required=True, help="Select operation mode for demonstrator")
     parser.add_argument("--clean", "-c", action="store_true", help="Clean interfaces and exit")
+    parser.add_argument("--poll-interval", "-p", type=float, default=10.0, 
+                        help="Maximum interval in seconds between replay state reconciliations")
+    parser.add_argument("--sample-interval", type=float, default=1.0,
+                        help="Interval in seconds of session records and capture markers (derived from the replay clock, "
+                             "the kernel is only queried at reconciliations)")
+    parser.add_argument("--mock-theaterq", type=str, default=os.environ.get("THEATERQ_MOCK"),
+                        help="Use a userspace TheaterQ mock with devices and state in this directory")
+    parser.add_argument("--mock-fifo", action="store_true", help="Use FIFOs as mock TheaterQ devices")
     parser.add_argument("CONFIG", type=str, help="Path to config.json")
     args = parser.parse_args()
 
@@ -145,7 +220,14 @@ if __name__ == "__main__":
         clean(config=config, debug=args.debug)
         sys.exit(0)
 
+    mock = None
+    if args.mock_theaterq is not None:
+        mock = MockTheaterQ(args.mock_theaterq, fifo=args.mock_fifo)
+
     main(config=config, 
          debug=args.debug, 
          verbose=args.verbose, 
-         mode=mode)
+         mode=mode,
+         poll_interval=args.poll_interval,
+         sample_interval=args.sample_interval,
+         mock=mock)
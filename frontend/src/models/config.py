@@ -1,6 +1,6 @@
 import json
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from constants import *
 
@@ -11,6 +11,9 @@ class RealNetworkEntry:
     vlan: int
     address: Optional[str]
     gateway: Optional[str]
+    probe_target: str = "1.1.1.1"
+    probe_interval: float = 0.5 # s
+    record_budget: float = 200.0 # kbit/s, measurement traffic of the recorder
 
     def get_interface_name(self) -> str:
         return f"vlan{self.vlan}-d"
@@ -52,10 +55,76 @@ class GeneralConfig:
     right_interface_address: str
 
 
+@dataclass
+class CaptureConfig:
+    snaplen: int = 96 # bytes, headers only
+    ring_size: int = 8 # MB per file
+    ring_files: int = 4 # per interface
+    buffer_size: int = 2048 # KiB kernel buffer
+    path: str = CAPTURE_RING_PATH
+    filter: str = ""
+
+
+@dataclass
+class CpuConfig:
+    gui_cpus: List[int] = field(default_factory=lambda: [0]) # Frontend process and its children
+    packet_cpus: Optional[List[int]] = None # None: all other CPUs, NIC IRQs, RPS and XPS
+    irqs: List[str] = field(default_factory=list) # Additional IRQ names, e.g., xhci_hcd for USB NICs
+    fifo: bool = False # SCHED_FIFO for ksoftirqd, IRQ and NAPI threads on the packet CPUs
+    fifo_priority: int = 50
+
+
+@dataclass
+class LinkConfig:
+    name: str
+    forward_interface: str
+    return_interface: str
+    handle: int = 1
+    syncgroup: Optional[int] = None # None: own syncgroup, shared: started together
+    parent: Optional[str] = None # None: root qdisc, else class id of a classful root
+    scenario: Optional[str] = None # None: scenario loaded in the GUI
+
+    def get_bridge_name(self) -> str:
+        return f"br-{self.name}"[:15]
+
+
+@dataclass
+class TrafficClassConfig:
+    name: str
+    match: Dict[str, object] # ip_proto, src/dst/port, dscp, src/dst (CIDR), forward direction
+    scenario: Optional[str] = None # None: scenario loaded in the GUI
+    syncgroup: Optional[int] = None
+
+
+@dataclass
+class ClassfulConfig:
+    root: str = "prio" # prio or htb
+    filter: str = "flower" # flower or u32
+    classes: List[TrafficClassConfig] = field(default_factory=list)
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["ClassfulConfig"]:
+        if data is None or len(data.get("classes", [])) == 0:
+            return None
+
+        if data.get("root", "prio") not in ["prio", "htb"]:
+            raise ValueError(f"Unknown classful root qdisc '{data['root']}'")
+        if data.get("filter", "flower") not in ["flower", "u32"]:
+            raise ValueError(f"Unknown classful filter '{data['filter']}'")
+
+        return ClassfulConfig(root=data.get("root", "prio"),
+                              filter=data.get("filter", "flower"),
+                              classes=[TrafficClassConfig(**entry) for entry in data["classes"]])
+
+
 @dataclass
 class FullConfig:
     general: GeneralConfig
     extended: ExtendedConfig
+    capture: CaptureConfig = field(default_factory=CaptureConfig)
+    links: List[LinkConfig] = field(default_factory=list)
+    classful: Optional[ClassfulConfig] = None
+    cpu: Optional[CpuConfig] = None
 
     @staticmethod
     def from_json_file(path: str) -> "FullConfig":
@@ -78,7 +147,20 @@ class FullConfig:
             configs=configs,
         )
 
-        return FullConfig(general=general, extended=extended)
+        # Capture (optional)
+        capture = CaptureConfig(**data.get("capture", {}))
+
+        # Additional emulated links (optional)
+        links = [LinkConfig(**link) for link in data.get("links", [])]
+
+        # Per-class emulation on the main link (optional)
+        classful = ClassfulConfig.from_dict(data.get("classful", None))
+
+        # CPU isolation of GUI and packet path (optional)
+        cpu = CpuConfig(**data["cpu"]) if data.get("cpu") is not None else None
+
+        return FullConfig(general=general, extended=extended, capture=capture, 
+                          links=links, classful=classful, cpu=cpu)
 
     def __str__(self):
         return json.dumps(self, default=lambda o: o.__dict__, indent=4)
@@ -1,20 +1,92 @@
+import json
+import numpy as np
+
 from pathlib import Path
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Dict, Optional
+
+from models.trace import TraceField, TraceTransform
+from utils.trace_buffer import TraceBuffer
+
+
+U32_MAX = 4294967295
+
+
+@dataclass
+class PlotBuckets:
+    # One value per pixel column of the plot, so drawing does not depend on the
+    # number of trace entries. Entries overlapping a bucket boundary count for
+    # both buckets, a short loss burst is never hidden by its neighbors.
+    edges: np.ndarray = field(default_factory=lambda: np.empty(0)) # s, buckets + 1
+    loss_max: np.ndarray = field(default_factory=lambda: np.empty(0)) # %
+    loss_mean: np.ndarray = field(default_factory=lambda: np.empty(0)) # %, weighted by time
+    delay_low: np.ndarray = field(default_factory=lambda: np.empty(0)) # ms, min(delay - jitter)
+    delay_high: np.ndarray = field(default_factory=lambda: np.empty(0)) # ms, max(delay + jitter)
+    route_changes: np.ndarray = field(default_factory=lambda: np.empty(0)) # s, first change per bucket
 
 
 @dataclass
 class PlotDataSeries:
-    time: List[float] = field(default_factory=list)
-    rate: List[int] = field(default_factory=list)
-    delay: List[float] = field(default_factory=list)
-    queue: List[int] = field(default_factory=list)
+    time: np.ndarray = field(default_factory=lambda: np.empty(0)) # s, end of each entry
+    rate: np.ndarray = field(default_factory=lambda: np.empty(0)) # Mbps
+    delay: np.ndarray = field(default_factory=lambda: np.empty(0)) # ms
+    queue: np.ndarray = field(default_factory=lambda: np.empty(0)) # packets, view of the trace
+    jitter: np.ndarray = field(default_factory=lambda: np.empty(0)) # ns, view of the trace
+    loss: np.ndarray = field(default_factory=lambda: np.empty(0)) # scaled u32, view of the trace
+    dup_prob: np.ndarray = field(default_factory=lambda: np.empty(0)) # scaled u32, view of the trace
+    dup_delay: np.ndarray = field(default_factory=lambda: np.empty(0)) # ns, view of the trace
+    route: np.ndarray = field(default_factory=lambda: np.empty(0)) # view of the trace
+    route_changes: np.ndarray = field(default_factory=lambda: np.empty(0)) # s, start of the new route
+    buckets: Dict[int, PlotBuckets] = field(default_factory=dict, repr=False)
+
+    def aggregate(self, count: int) -> PlotBuckets:
+        if count not in self.buckets:
+            self.buckets[count] = self.__aggregate(max(count, 1))
+        return self.buckets[count]
+
+    def __aggregate(self, count: int) -> PlotBuckets:
+        if len(self.time) == 0 or self.time[-1] <= 0:
+            return PlotBuckets()
+
+        ends = self.time
+        starts = np.concatenate(([0.0], ends[:-1]))
+        edges = np.linspace(0, ends[-1], count + 1)
+
+        # Entries [first, last] overlap a bucket, first is non-decreasing. reduceat
+        # covers [first, next first), last adds the entry crossing the end.
+        first = np.minimum(np.searchsorted(ends, edges[:-1], side="right"), len(ends) - 1)
+        last = np.maximum(np.searchsorted(starts, edges[1:], side="left") - 1, first)
+
+        def bucket_max(values: np.ndarray) -> np.ndarray:
+            return np.maximum(np.maximum.reduceat(values, first), values[last])
+
+        def bucket_min(values: np.ndarray) -> np.ndarray:
+            return np.minimum(np.minimum.reduceat(values, first), values[last])
+
+        # Time weighted mean from the integral of the step function at the edges
+        loss = self.loss / U32_MAX * 100
+        integral = np.concatenate(([0.0], np.cumsum(loss * (ends - starts))))
+        active = np.minimum(np.searchsorted(ends, edges, side="right"), len(ends) - 1)
+        at_edges = integral[active] + loss[active] * np.clip(edges - starts[active], 0, None)
+
+        jitter = self.jitter / 1e6
+        changes = self.route_changes
+        if len(changes) > 0:
+            columns = np.minimum((changes / ends[-1] * count).astype(np.int64), count - 1)
+            changes = changes[np.concatenate(([True], np.diff(columns) > 0))]
+
+        return PlotBuckets(edges=edges,
+                           loss_max=bucket_max(loss),
+                           loss_mean=np.diff(at_edges) / np.diff(edges),
+                           delay_low=np.maximum(bucket_min(self.delay - jitter), 0),
+                           delay_high=bucket_max(self.delay + jitter),
+                           route_changes=changes)
 
 
 class ScenarioConfig:
     def __init__(self, name: str, description: str, basepath: str,
                  trace_format: str, forward_file: str, return_file: str,
-                 video: Optional[str] = None):
+                 video: Optional[str] = None, transform: Optional[TraceTransform] = None):
         self.name = name
         self.description = description
         self.basepath = Path(basepath)
@@ -32,59 +104,46 @@ class ScenarioConfig:
         if not self.return_file.exists():
             raise Exception(f"Configured return file does not exist: {self.return_file}")
         
-        self.forward_trace = []
-        with open(self.forward_file, "r") as handle:
-            self.forward_trace = handle.readlines()
-        
-        self.return_trace = []
-        with open(self.return_file, "r") as handle:
-            self.return_trace = handle.readlines()
-
-        if trace_format != "extended":
-            self.return_trace = ScenarioConfig.extend_trace(self.return_trace)
-            self.forward_trace = ScenarioConfig.extend_trace(self.forward_trace)
+        # Both traces are read-only views of one shared buffer, see TraceBuffer
+        self.transform = transform
+        self.buffer = TraceBuffer.load(self.forward_file, self.return_file, trace_format, transform)
+        self.forward_trace = self.buffer.forward
+        self.return_trace = self.buffer.reverse
+        self.plot_data: Dict[bool, PlotDataSeries] = {}
 
     def get_plot_data(self, return_trace: bool = False) -> PlotDataSeries:
-        input = self.forward_trace if not return_trace else self.return_trace
-        result = PlotDataSeries()
-        t = 0
-        for entry in input:
-            if not entry[0].isdigit():
-                continue
-
-            keep, delay, _, rate, _, limit, _, _, _ = entry.replace("\n", "").split(",")
-            t += int(keep)
-            result.time.append(float(t) / (1000 * 1000)) # s
-            result.delay.append(float(delay) / (1000 * 1000)) # ms
-            result.rate.append(int(rate) // 1e6) # Mbps
-            result.queue.append(int(limit)) # packets
-        
-        return result
+        if return_trace not in self.plot_data:
+            trace = self.forward_trace if not return_trace else self.return_trace
+            time = trace.end_times() / 1e6
+            route = trace[TraceField.ROUTE]
+            self.plot_data[return_trace] = PlotDataSeries(time=time,
+                                                          delay=trace[TraceField.LATENCY] / 1e6,
+                                                          rate=trace[TraceField.RATE] // 1e6,
+                                                          queue=trace[TraceField.LIMIT],
+                                                          jitter=trace[TraceField.JITTER],
+                                                          loss=trace[TraceField.LOSS],
+                                                          dup_prob=trace[TraceField.DUP_PROB],
+                                                          dup_delay=trace[TraceField.DUP_DELAY],
+                                                          route=route,
+                                                          route_changes=time[:-1][route[1:] != route[:-1]])
+        return self.plot_data[return_trace]
 
     def get_length_ns(self) -> int:
-        def get_one_len(file) -> int:
-            result = 0
-            for line in file:
-                if not line[0].isdigit():
-                    continue
-                result += int(line.split(",")[0]) * 1000 # µs to ns
-            
-            return result
-        
-        return max(get_one_len(self.forward_trace), get_one_len(self.return_trace))
+        return max(self.forward_trace.get_length_us(), self.return_trace.get_length_us()) * 1000
     
     def __str__(self) -> str:
         return f"{self.name} ({self.description})"
-    
-    @staticmethod
-    def extend_trace(trace: List[str]) -> List[str]:
-        result = []
 
-        for entry in trace:
-            if not entry[0].isnumeric():
-                continue
+    @staticmethod
+    def from_json_file(path: str) -> "ScenarioConfig":
+        with open(path, "r", encoding="utf-8") as handle:
+            data = json.load(handle)
 
-            keep, latency, rate, loss, limit = entry.replace("\n", "").split(",")
-            result.append(f"{keep},{latency},0,{rate},{loss},{limit},0,0,1\n")
-        
-        return result
+        return ScenarioConfig(name=data["name"],
+                              description=data["description"],
+                              basepath=str(Path(path).parent),
+                              trace_format=data["trace"]["format"],
+                              forward_file=data["trace"]["forward"],
+                              return_file=data["trace"]["return"],
+                              video=data.get("video", None),
+                              transform=TraceTransform.from_dict(data.get("transform", None)))
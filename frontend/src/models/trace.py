@@ -0,0 +1,296 @@
+import numpy as np
+
+from enum import Enum, IntEnum
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class TraceField(IntEnum):
+    KEEP = 0        # µs
+    LATENCY = 1     # ns
+    JITTER = 2      # ns
+    RATE = 3        # bps
+    LOSS = 4        # scaled u32
+    LIMIT = 5       # pkts
+    DUP_PROB = 6    # scaled u32
+    DUP_DELAY = 7   # ns
+    ROUTE = 8       # u16
+
+
+SIMPLE_FIELDS = [TraceField.KEEP, TraceField.LATENCY, TraceField.RATE, TraceField.LOSS, TraceField.LIMIT]
+
+
+class ResamplePolicy(Enum):
+    WORST = "worst"
+    MEAN = "mean"
+    FIRST = "first"
+    LINEAR = "linear"
+
+    @staticmethod
+    def from_str(string: str):
+        try: return ResamplePolicy(string.strip().lower())
+        except Exception:
+            raise Exception(f"Unknown ResamplePolicy '{string}'")
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+
+class Trace:
+    FIELDS = len(TraceField)
+
+    def __init__(self, data: np.ndarray):
+        if data.ndim != 2 or data.shape[1] != Trace.FIELDS:
+            raise ValueError(f"Trace data must have shape (n, {Trace.FIELDS}), got {data.shape}")
+
+        self.data = data
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def __getitem__(self, field: TraceField) -> np.ndarray:
+        return self.data[:, field]
+
+    @staticmethod
+    def from_lines(lines: Iterable[str], simple: bool = False) -> "Trace":
+        text = ",".join(line.rstrip("\n") for line in lines if line[:1].isdigit())
+        if len(text) == 0:
+            return Trace(np.empty((0, Trace.FIELDS), dtype=np.int64))
+
+        fields = len(SIMPLE_FIELDS) if simple else Trace.FIELDS
+        # Depending on the NumPy version, fromstring stops silently at the first
+        # value it cannot parse or raises
+        try:
+            values = np.fromstring(text, dtype=np.int64, sep=",")
+        except ValueError:
+            values = np.empty(0, dtype=np.int64)
+        if values.size != text.count(",") + 1:
+            raise ValueError("Trace contains values that are not integers.")
+
+        if values.size % fields != 0:
+            raise ValueError(f"Trace is not in {'simple' if simple else 'extended'} format.")
+
+        if not simple:
+            return Trace(values.reshape(-1, Trace.FIELDS))
+
+        # Simple format: no jitter and duplication, a single route
+        data = np.zeros((values.size // fields, Trace.FIELDS), dtype=np.int64)
+        data[:, SIMPLE_FIELDS] = values.reshape(-1, fields)
+        data[:, TraceField.ROUTE] = 1
+        return Trace(data)
+
+    def to_lines(self) -> List[str]:
+        result = []
+        for chunk in self.format_chunks():
+            result.extend(chunk.splitlines(keepends=True))
+
+        return result
+
+    def format_chunks(self, rows: int = 65536) -> Iterator[str]:
+        line_format = ",".join(["%d"] * Trace.FIELDS) + "\n"
+        for start in range(0, len(self), rows):
+            chunk = self.data[start:start + rows]
+            yield (line_format * len(chunk)) % tuple(chunk.ravel().tolist())
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as handle:
+            handle.write("keep,latency,jitter,rate,loss,limit,dup_prob,dub_delay,reorder_route\n")
+            for text in self.format_chunks():
+                handle.write(text)
+
+    def end_times(self) -> np.ndarray:
+        return np.cumsum(self.data[:, TraceField.KEEP])
+
+    def get_length_us(self) -> int:
+        return int(self.data[:, TraceField.KEEP].sum())
+
+    def time_scale(self, factor: float) -> "Trace":
+        if factor <= 0:
+            raise ValueError(f"Time scale factor must be positive, got {factor}")
+
+        result = self.data.copy()
+        keep = self.data[:, TraceField.KEEP]
+        scaled = np.rint(keep * factor).astype(np.int64)
+        # Do not let short entries vanish when speeding up the replay
+        result[:, TraceField.KEEP] = np.where(keep > 0, np.maximum(scaled, 1), 0)
+        return Trace(result)
+
+    def resample(self, granularity: int,
+                 policy: ResamplePolicy = ResamplePolicy.WORST) -> "Trace":
+        if granularity <= 0:
+            raise ValueError(f"Granularity must be positive, got {granularity}")
+
+        if len(self) == 0:
+            return Trace(self.data.copy())
+
+        if policy == ResamplePolicy.LINEAR:
+            return self.__interpolate(granularity)
+
+        return self.__aggregate(granularity, policy)
+
+    def __aggregate(self, granularity: int, policy: ResamplePolicy) -> "Trace":
+        keep = self.data[:, TraceField.KEEP]
+        buckets = (np.cumsum(keep) - keep) // granularity
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+
+        result = np.empty((len(bounds), Trace.FIELDS), dtype=np.int64)
+        result[:, TraceField.KEEP] = np.add.reduceat(keep, bounds)
+        result[:, TraceField.ROUTE] = self.data[bounds, TraceField.ROUTE]
+
+        match policy:
+            case ResamplePolicy.FIRST:
+                result[:, TraceField.LATENCY:TraceField.ROUTE] = self.data[bounds, TraceField.LATENCY:TraceField.ROUTE]
+            case ResamplePolicy.MEAN:
+                values = self.data[:, TraceField.LATENCY:TraceField.ROUTE].astype(np.float64)
+                weighted = np.add.reduceat(values * keep[:, None], bounds, axis=0)
+                weights = np.maximum(result[:, TraceField.KEEP], 1)[:, None]
+                result[:, TraceField.LATENCY:TraceField.ROUTE] = np.rint(weighted / weights)
+
+                # Unlimited entries (rate 0) are left out of the rate average
+                rate = self.data[:, TraceField.RATE]
+                limited = np.where(rate > 0, keep, 0)
+                weighted = np.add.reduceat(rate.astype(np.float64) * limited, bounds)
+                weights = np.add.reduceat(limited, bounds)
+                result[:, TraceField.RATE] = np.where(weights > 0, np.rint(weighted / np.maximum(weights, 1)), 0)
+            case ResamplePolicy.WORST:
+                for field in [TraceField.LATENCY, TraceField.JITTER, TraceField.LOSS,
+                              TraceField.DUP_PROB, TraceField.DUP_DELAY]:
+                    result[:, field] = np.maximum.reduceat(self.data[:, field], bounds)
+
+                result[:, TraceField.LIMIT] = np.minimum.reduceat(self.data[:, TraceField.LIMIT], bounds)
+
+                # A rate of 0 disables rate limiting, it must never win as the worst case
+                unlimited = np.iinfo(np.int64).max
+                rate = self.data[:, TraceField.RATE]
+                rate = np.minimum.reduceat(np.where(rate == 0, unlimited, rate), bounds)
+                result[:, TraceField.RATE] = np.where(rate == unlimited, 0, rate)
+            case _:
+                raise ValueError(f"Unsupported aggregation policy: {policy}")
+
+        return Trace(result)
+
+    def __interpolate(self, granularity: int) -> "Trace":
+        keep = self.data[:, TraceField.KEEP]
+        parts = np.maximum(1, -(-keep // granularity))
+        index = np.repeat(np.arange(len(self)), parts)
+        offset = np.arange(parts.sum()) - np.repeat(np.cumsum(parts) - parts, parts)
+
+        result = self.data[index]
+        result[:, TraceField.KEEP] = np.minimum(granularity, keep[index] - offset * granularity)
+
+        fraction = (offset * granularity) / np.maximum(keep[index], 1)
+        following = np.minimum(index + 1, len(self) - 1)
+        for field in [TraceField.LATENCY, TraceField.JITTER, TraceField.RATE]:
+            start = self.data[index, field]
+            delta = self.data[following, field] - start
+            if field == TraceField.RATE:
+                # No ramp from or to an unlimited rate (0), the entry keeps its rate
+                delta = np.where((start == 0) | (self.data[following, field] == 0), 0, delta)
+            result[:, field] = start + np.rint(delta * fraction).astype(np.int64)
+
+        return Trace(result)
+
+
+@dataclass
+class TraceTransform:
+    granularity: Optional[int] = None # µs
+    policy: ResamplePolicy = ResamplePolicy.WORST
+    timescale: float = 1.0
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["TraceTransform"]:
+        if data is None:
+            return None
+
+        return TraceTransform(granularity=data.get("granularity", None),
+                              policy=ResamplePolicy.from_str(data.get("policy", "worst")),
+                              timescale=float(data.get("timescale", 1.0)))
+
+    def apply(self, trace: Trace) -> Trace:
+        if self.timescale != 1.0:
+            trace = trace.time_scale(self.timescale)
+
+        if self.granularity is not None:
+            trace = trace.resample(self.granularity, self.policy)
+
+        return trace
+
+    def __str__(self) -> str:
+        return f"TraceTransform (granularity={self.granularity}, policy={self.policy}, timescale={self.timescale})"
+
+
+@dataclass
+class TraceComparison:
+    a: Trace
+    b: Trace
+    start: np.ndarray   # µs, start of each aligned segment
+    length: np.ndarray  # µs
+    index_a: np.ndarray # entry of a active during each segment
+    index_b: np.ndarray
+
+    COMPARED = [TraceField.LATENCY, TraceField.JITTER, TraceField.RATE,
+                TraceField.LOSS, TraceField.LIMIT]
+
+    @staticmethod
+    def align(a: Trace, b: Trace) -> "TraceComparison":
+        # Segments are split at every entry boundary of either trace, both traces
+        # are constant within a segment. Only the overlapping time span is compared.
+        if len(a) == 0 or len(b) == 0:
+            raise ValueError("Unable to compare empty traces")
+
+        ends_a, ends_b = a.end_times(), b.end_times()
+        horizon = min(ends_a[-1], ends_b[-1])
+        # Both inputs are sorted runs, a stable sort merges them in linear time
+        ends = np.concatenate((ends_a[ends_a < horizon], ends_b[ends_b < horizon], [horizon]))
+        ends.sort(kind="stable")
+        ends = ends[np.concatenate(([True], ends[1:] != ends[:-1]))]
+        start = np.concatenate(([0], ends[:-1]))
+
+        return TraceComparison(a=a, b=b, start=start, length=ends - start,
+                               index_a=np.searchsorted(ends_a, start, side="right"),
+                               index_b=np.searchsorted(ends_b, start, side="right"))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def get_length_us(self) -> int:
+        return int(self.start[-1] + self.length[-1])
+
+    def values(self, field: TraceField) -> Tuple[np.ndarray, np.ndarray]:
+        return self.a[field][self.index_a], self.b[field][self.index_b]
+
+    def delta(self, field: TraceField) -> np.ndarray:
+        value_a, value_b = self.values(field)
+        return value_b - value_a
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        total = max(self.get_length_us(), 1)
+        result = {}
+        for field in TraceComparison.COMPARED:
+            value_a, value_b = self.values(field)
+            delta = value_b - value_a
+            # Scaled u32 or ns times µs overflows int64 for hour-long traces
+            length = self.length.astype(np.float64)
+            result[field.name.lower()] = {
+                "mean_a": float(np.dot(value_a.astype(np.float64), length) / total),
+                "mean_b": float(np.dot(value_b.astype(np.float64), length) / total),
+                "mean_delta": float(np.dot(delta.astype(np.float64), length) / total),
+                "mean_abs_delta": float(np.dot(np.abs(delta).astype(np.float64), length) / total),
+                "max_abs_delta": int(np.abs(delta).max()),
+                "differing_share": float(self.length[delta != 0].sum() / total),
+            }
+
+        return result
+
+    def decimate(self, field: TraceField,
+                 buckets: int) -> Tuple[np.ndarray, Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+        # Min/max envelope of a, b and b - a per time bucket, one bucket per pixel is
+        # enough for plotting and keeps hour-long traces drawable
+        value_a, value_b = self.values(field)
+        delta = value_b - value_a
+        bucket = self.start * buckets // max(self.get_length_us(), 1)
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+        time = self.start[bounds] / 1e6 # s
+
+        return time, {name: (np.minimum.reduceat(values, bounds), np.maximum.reduceat(values, bounds))
+                      for name, values in [("a", value_a), ("b", value_b), ("delta", delta)]}
@@ -1,18 +1,26 @@
 import tkinter as tk
-import matplotlib.pyplot as plt
 import time
 
+from typing import Dict, Optional
+
 from tkinter import ttk
 from threading import Thread, Event, Lock
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 from modes.mode import Mode
 from utils.logger import Logger
-from utils.usb_data_provider import USBDataProvider
 from utils.generic_data_provider import GenericDataProvider
 from models.scenario import ScenarioConfig
+from models.trace import TraceField
 from utils.theaterq import *
-from utils.video_player import VideoPlayer
+from utils.telemetry import TelemetrySampler, TelemetryChannel
+from utils.replay_clock import ReplayClock
+from utils.session_recorder import SessionRecorder
+from utils.capture import PacketCapture
+from utils.theaterq_mock import MockTheaterQ
+from utils.link_registry import LinkRegistry, EmulatedLink
+from utils.trace_compare import CompareView, compare_scenarios, draw_comparison, format_summary
+from utils.firewall import Firewall
+from utils.replay_state import ReplayState
 from constants import *
 from utils.utils import run_fail_on_error, run_log_on_error
 from models.config import *
@@ -26,12 +34,14 @@ from models.config import *
 #
 class EmulatorMode(Mode):
     def __init__(self, config: FullConfig, interface_right: str, interface_left: str, 
-                 maingui, debug: bool = False, masquerade: bool = False):
+                 maingui, debug: bool = False, firewall: Optional[Firewall] = None,
+                 poll_interval: float = 10.0, sample_interval: float = 1.0,
+                 mock: Optional[MockTheaterQ] = None):
         super().__init__(config, maingui, debug)
 
         self.interface_right = interface_right
         self.interface_left = interface_left
-        self.masquerade = masquerade
+        self.firewall = firewall
 
         self.replay_time = None
         self.replay_status = None
@@ -46,18 +56,33 @@ class EmulatorMode(Mode):
         self.scenario_name = None
         self.scenario_description = None
         self.load_button = None
+        self.compare_button = None
         self.select_loop = None
         self.select_hold = None
 
         self.preview_scenario = None
         self.provider = None
         self.scenario: Optional[ScenarioConfig] = None
+        self.scenario_key: Optional[str] = None # Name in the scenario list
+        self.resume_state: Optional[ReplayState] = None
         self.current_time = 0
         self.contmode = TheaterQContMode.LOOP
         self.handler: Optional[TheaterQHandler] = None
+        self.links: Optional[LinkRegistry] = None
+        self.classifier: Optional[TheaterQClassifier] = None
+        self.mock = mock
 
         self.update_thread = None
         self.thread_event = None
+        self.poll_interval = poll_interval
+        self.sample_interval = sample_interval
+        self.clock = ReplayClock()
+        self.refresh_job = None
+        self.telemetry = TelemetrySampler()
+        self.recorder: Optional[SessionRecorder] = None
+        self.capture: Optional[PacketCapture] = None
+        self.capture_var = None
+        self.capture_toggle = None
         
         self.trace_var = None
         self.trace_plot_hint = None
@@ -65,6 +90,13 @@ class EmulatorMode(Mode):
         self.canvas = None
         self.canvas_lock = Lock()
         self.trace_plot_return_file = False
+        self.rate_overlay = None
+        self.queue_overlay = None
+        self.marker_time = None
+        self.marker_resolution = 0.0
+        self.comparison = None
+        self.compare_name = None
+        self.compare_var = None
 
         self.video_frame = None
         self.video_label = None
@@ -72,8 +104,6 @@ class EmulatorMode(Mode):
 
         self.is_enabled = False
         self.is_playing = False
-        
-        self.debug_time = 0
 
     def add_tabs(self, window) -> None:
         frame = ttk.Frame(window.get_tabs())
@@ -94,6 +124,11 @@ class EmulatorMode(Mode):
         self.replay_time.pack(side="left")
         self.replay_time.configure(font=('URW Gothic L', '20', 'bold'))
 
+        self.capture_var = tk.BooleanVar(value=False)
+        self.capture_toggle = ttk.Checkbutton(info_frame, text="Capture Headers", 
+                                              variable=self.capture_var)
+        self.capture_toggle.place(relx=0.42, rely=0.07)
+
         status_frame = ttk.Frame(info_frame)
         status_frame.place(relx=0.72, rely=0.05, relwidth=0.4, relheight=0.15)
         status_label = ttk.Label(status_frame, text="Status: ")
@@ -165,7 +200,11 @@ class EmulatorMode(Mode):
         self.load_button = ttk.Button(load_frame, text="Load Selected Scenario", style="R.TButton", 
                             command=self.__load_button)
         self.load_button.config(state="disabled")
-        self.load_button.pack(expand=True)
+        self.load_button.pack(side="left", expand=True)
+        self.compare_button = ttk.Button(load_frame, text="Compare with Loaded", style="R.TButton", 
+                            command=self.__compare_button)
+        self.compare_button.config(state="disabled")
+        self.compare_button.pack(side="left", expand=True)
 
         # TRACE FILE VIZ
         self.trace_plot_area = ttk.LabelFrame(frame, text="Trace File Graph")
@@ -177,6 +216,10 @@ class EmulatorMode(Mode):
         control = ttk.Radiobutton(self.trace_plot_area, text="Show Return Path Trace File", variable=self.trace_var, 
                                   value="return", style="R.TRadiobutton", command=self.__viz_mode_changed)
         control.grid(row=0, column=2, padx=5, sticky="ew")
+        self.compare_var = tk.BooleanVar(value=False)
+        control = ttk.Checkbutton(self.trace_plot_area, text="Show Difference", variable=self.compare_var, 
+                                  command=self.__viz_mode_changed)
+        control.grid(row=0, column=3, padx=5, sticky="ew")
         self.trace_plot_hint = ttk.Label(self.trace_plot_area, text="Not available.")
         self.trace_plot_hint.place(relx=0.5, rely=0.5, anchor="center")
         self.trace_plot_hint.configure(font=('URW Gothic L', '20'))
@@ -194,6 +237,7 @@ class EmulatorMode(Mode):
         if self.debug:
             self.provider = GenericDataProvider(self.usb_handler_changed)
         else:
+            from utils.usb_data_provider import USBDataProvider
             self.provider = USBDataProvider(self.usb_handler_changed)
 
         window.add_tab("Emulator", frame, self)
@@ -210,7 +254,9 @@ class EmulatorMode(Mode):
     def usb_handler_changed_internal(context, status: bool) -> None:
         context.scenario_list.delete(0, tk.END)
         context.preview_scenario = None
-        context.stop(unload=True)
+        # The adopted replay keeps running until its scenario is available
+        if context.resume_state is None:
+            context.stop(unload=True)
 
         if status:
             context.scenario_name.configure(text="Select a Scenario")
@@ -218,6 +264,7 @@ class EmulatorMode(Mode):
             all = context.provider.get_scenario_list()
             for entry in all:
                 context.scenario_list.insert(tk.END, entry)
+            context.__try_resume()
         else:
             context.scenario_name.configure(text="Not available")
             context.full_replace_textbox(context.scenario_description, "Insert a USB drive to show Scenarios.")
@@ -259,65 +306,151 @@ class EmulatorMode(Mode):
                 context.stop_button.configure(state="normal")
 
         context.replay_status.configure(text=status_text, foreground=status_color)
+        EmulatorMode.position_callback(context, time_total_out, time_current_out, force=True)
 
+    @staticmethod
+    def position_callback(context, time_total: int, time_current: int, force: bool = False) -> None:
         def ns_to_time(ns: int) -> str:
             seconds = int(ns / (1000 * 1000 * 1000))
             minutes = (seconds % 3600) // 60
             secs = seconds % 60
             return f"{minutes:02}:{secs:02}"
         
-        context.replay_time.configure(text=f"{ns_to_time(time_current_out)} / {ns_to_time(time_total_out)}")
-        context.current_time = float(time_current_out) / (1000.0 * 1000.0 * 1000.0)
-
-        if context.canvas is not None:
+        text = f"{ns_to_time(time_current)} / {ns_to_time(time_total)}"
+        if force or context.replay_time.cget("text") != text:
+            context.replay_time.configure(text=text)
+        context.current_time = float(time_current) / (1000.0 * 1000.0 * 1000.0)
+
+        # Redrawing the figure is expensive, only move the marker by whole pixels
+        if context.canvas is not None and (force or context.marker_time is None or 
+                abs(context.current_time - context.marker_time) >= context.marker_resolution):
             context.trace_plot_update_marker(context.current_time)
 
         if context.video_player is not None:
             context.video_player.update(context.current_time)
 
     def __update_event_thread_fn(self) -> None:
-        while True:
-            if self.thread_event.is_set() or self.handler is None:
-                return
-            
-            if self.debug:
-                state = self.handler.get_details()
-                self.maingui.add_async_event(EmulatorMode.state_change_callback,
-                                             context=self, 
-                                             time_total=100 * 1000 * 1000 * 1000, 
-                                             time_current=self.debug_time * 1000 * 1000 * 1000, 
-                                             stage=state.stage)
-                self.debug_time += 1
-                if self.debug_time >= 100:
-                    if self.handler.settings.contmode == TheaterQContMode.HOLD:
-                        self.debug -= 1
-                    else:
-                        self.debug_time = 0
-            else:
-                try:
-                    state = self.handler.get_details()
-                    self.maingui.add_async_event(EmulatorMode.state_change_callback,
-                                                context=self, 
-                                                time_total=state.total_time, 
-                                                time_current=state.position_time, 
-                                                stage=state.stage)
-                except Exception as ex:
-                    Logger.warning(f"Unable to update replay feedback: {ex}")
+        # Kernel queries reconcile the local clock, detect stage changes and sample
+        # the qdisc telemetry; they are sparse (tightly around transitions, see
+        # ReplayClock). Session records and capture markers are taken every
+        # sample_interval, between queries from the clock and the last counters.
+        debug_start = time.monotonic()
+        next_reconcile = debug_start
+        polled: Optional[TheaterQState] = None
+        while not self.thread_event.is_set() and self.links is not None:
+            try:
+                before = time.monotonic()
+                if before >= next_reconcile or polled is None:
+                    states = self.links.poll()
+                    after = time.monotonic()
+
+                    if self.handler.dryrun:
+                        elapsed = after - debug_start
+                        for state in states.values():
+                            state.total_time = 100 * 1000 * 1000 * 1000
+                            if self.contmode == TheaterQContMode.HOLD:
+                                state.position_time = int(min(elapsed, 100) * 1000 * 1000 * 1000)
+                            else:
+                                state.position_time = int((elapsed % 100) * 1000 * 1000 * 1000)
+
+                    self.links.record_telemetry(states)
+
+                    # The GUI, session and capture follow the primary link
+                    state = states.get(self.links.primary.name)
+                    if state is None:
+                        raise Exception("Primary link is not available")
+
+                    if self.clock.reconcile(state, (before + after) / 2):
+                        self.maingui.add_async_event(EmulatorMode.state_change_callback,
+                                                     context=self, 
+                                                     time_total=state.total_time, 
+                                                     time_current=state.position_time, 
+                                                     stage=state.stage)
+                    next_reconcile = after + self.clock.next_poll(self.poll_interval)
+                    polled = state
+                else:
+                    # Entry index is derived by the recorder (position_count -1)
+                    stage, position, total = self.clock.snapshot(before)
+                    state = TheaterQState(stage, polled.contmode, position, -1, total,
+                                          polled.total_count, polled.forward_stats,
+                                          polled.return_stats)
+
+                self.__record_session(state)
+                self.__mark_capture(state)
+                interval = min(self.sample_interval, max(next_reconcile - time.monotonic(), 0))
+            except Exception as ex:
+                Logger.warning(f"Unable to update replay feedback: {ex}")
+                interval = min(self.sample_interval, self.poll_interval)
+
+            self.thread_event.wait(interval)
+
+    def __refresh_display(self) -> None:
+        self.refresh_job = None
+        if not self.is_playing:
+            return
 
-            time.sleep(1)
+        stage, position, total = self.clock.snapshot()
+        if stage in [TheaterQStage.RUN, TheaterQStage.FINISH]:
+            EmulatorMode.position_callback(self, total, position)
+
+        self.refresh_job = self.trace_plot_area.after(REPLAY_DISPLAY_INTERVAL_MS, self.__refresh_display)
+
+    def __record_session(self, state: TheaterQState) -> None:
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(state)
+
+    def __mark_capture(self, state: TheaterQState) -> None:
+        capture = self.capture
+        if capture is not None:
+            capture.mark(state.position_time)
+
+    def __start_recorder(self, arm: bool) -> Optional[SessionRecorder]:
+        try:
+            path = SessionRecorder.create_session_path(self.provider.get_session_path(), 
+                                                       self.scenario.name)
+            recorder = SessionRecorder(path, self.scenario.name, 
+                                       self.scenario.forward_trace, 
+                                       self.scenario.return_trace,
+                                       metadata={"description": self.scenario.description,
+                                                 "contmode": str(self.contmode),
+                                                 "armed": arm,
+                                                 "forward_interface": self.interface_right,
+                                                 "return_interface": self.interface_left,
+                                                 "links": list(self.links.links.keys())})
+            recorder.start()
+            return recorder
+        except Exception as ex:
+            Logger.warning(f"Unable to record replay session: {ex}")
+            return None
 
     def trace_plot_init_draw(self) -> None:
+        # matplotlib takes seconds to import on the Pi, it is loaded on first use
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
         if self.scenario is None:
             return
+
+        if self.comparison is not None:
+            self.trace_plot_draw_comparison()
+            return
         
         trace = self.scenario.get_plot_data(self.trace_plot_return_file)
         self.trace_plot_hint.place_forget()
 
         self.fig, self.ax = plt.subplots(figsize=(9.3, 2.8))
+        # Jitter, loss and route changes per pixel column, independent of the trace length
+        buckets = trace.aggregate(int(self.fig.get_figwidth() * self.fig.dpi))
         self.ax.plot(trace.time, trace.delay, label="Delay", color="royalblue")
+        if len(buckets.edges) > 0:
+            self.ax.stairs(buckets.delay_high, buckets.edges, baseline=buckets.delay_low, fill=True,
+                           label="Jitter", color="royalblue", alpha=0.25, linewidth=0)
+        self.ax.vlines(buckets.route_changes, 0, 1, transform=self.ax.get_xaxis_transform(),
+                       label="Route Change", colors="white", linestyles=":", linewidth=1, alpha=0.7)
         self.ax.set_xlabel("Simulation Time (s)", color="white")
         self.ax.set_ylabel("Delay (ms)", color="royalblue")
-        self.ax.set_xlim(0, max(trace.time))
+        self.ax.set_xlim(0, trace.time.max())
         self.ax.set_ylim(0)
         self.ax.tick_params(axis='y', labelcolor='royalblue')
         self.ax.tick_params(axis='x', labelcolor='white')
@@ -331,7 +464,9 @@ class EmulatorMode(Mode):
         ax2.plot(trace.time, trace.rate, label="Rate", color="red")
         ax2.set_ylabel("Path Capacity (Mbps)", color="red")
         ax2.tick_params(axis='y', labelcolor='red')
-        ax2.set_ylim(0, max(trace.rate) + 10)
+        ax2.set_ylim(0, trace.rate.max() + 10)
+        self.rate_overlay, = ax2.plot([], [], label="Measured Rate", color="salmon", 
+                                      linestyle="--", linewidth=1)
         ax2.tick_params(axis='y', which='both', color='white')
 
         for spine in ax2.spines.values():
@@ -344,16 +479,39 @@ class EmulatorMode(Mode):
         ax3.plot(trace.time, trace.queue, label='Queue Capacity', color='lawngreen')
         ax3.set_ylabel("Queue Capacity (pkts)", color='lawngreen')
         ax3.set_ylim(0)
+        self.queue_overlay, = ax3.plot([], [], label="Queue Occupancy", color="lawngreen", 
+                                       linestyle=":", linewidth=1)
         ax3.tick_params(axis='y', labelcolor='lawngreen', grid_color="white")
         ax3.tick_params(axis='y', which='both', color='white')
 
         for spine in ax3.spines.values():
             spine.set_color('white')
 
+        ax4 = self.ax.twinx()
+        ax4.spines["left"].set_position(('outward', 50))
+        ax4.spines["left"].set_visible(True)
+        ax4.yaxis.set_label_position("left")
+        ax4.yaxis.tick_left()
+        if len(buckets.edges) > 0:
+            ax4.stairs(buckets.loss_max, buckets.edges, label="Loss (max)", fill=True,
+                       color="violet", alpha=0.35, linewidth=0)
+            ax4.stairs(buckets.loss_mean, buckets.edges, label="Loss (mean)", color="violet", linewidth=1)
+        ax4.set_ylabel("Loss (%)", color="violet")
+        ax4.set_ylim(0, 100)
+        ax4.tick_params(axis='y', labelcolor='violet')
+        ax4.tick_params(axis='y', which='both', color='white')
+
+        for spine in ax4.spines.values():
+            spine.set_color('white')
+
         self.marker = self.ax.axvline(x=self.current_time, color="orange", 
                                       linestyle="-", linewidth=4, label="Marker")
         self.fig.tight_layout()
 
+        x_min, x_max = self.ax.get_xlim()
+        self.marker_resolution = (x_max - x_min) / max(self.ax.get_window_extent().width, 1)
+        self.marker_time = None
+
         with self.canvas_lock:
             self.canvas = FigureCanvasTkAgg(self.fig, master=self.trace_plot_area)
             self.canvas.get_tk_widget().place(relx=0.5, rely=0.55, anchor="center")
@@ -363,12 +521,59 @@ class EmulatorMode(Mode):
 
         self.idx = 0
 
+    def trace_plot_draw_comparison(self) -> None:
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        comparison = self.comparison[self.trace_plot_return_file]
+        view = CompareView.DIFFERENCE if self.compare_var.get() else CompareView.OVERLAY
+        self.trace_plot_hint.place_forget()
+
+        self.fig = plt.figure(figsize=(9.3, 2.8))
+        axes = draw_comparison(self.fig, comparison, view, panels=2, color="white",
+                               labels=(self.scenario.name, self.compare_name))
+        self.ax = axes[TraceField.LATENCY]
+        for ax in axes.values():
+            ax.set_facecolor(THEME_COLOR)
+
+        self.marker = self.ax.axvline(x=self.current_time, color="orange", 
+                                      linestyle="-", linewidth=4, label="Marker")
+        self.fig.tight_layout()
+
+        x_min, x_max = self.ax.get_xlim()
+        self.marker_resolution = (x_max - x_min) / max(self.ax.get_window_extent().width, 1)
+        self.marker_time = None
+
+        with self.canvas_lock:
+            self.canvas = FigureCanvasTkAgg(self.fig, master=self.trace_plot_area)
+            self.canvas.get_tk_widget().place(relx=0.5, rely=0.55, anchor="center")
+            self.fig.patch.set_facecolor(THEME_COLOR)
+            self.canvas.get_tk_widget().config(bg=THEME_COLOR)
+
     def trace_plot_update_marker(self, time: float) -> None:
         with self.canvas_lock:
+            self.marker_time = time
             self.marker.set_xdata([time, time])
+            self.trace_plot_update_telemetry()
             self.canvas.draw_idle()
 
+    def trace_plot_update_telemetry(self) -> None:
+        if self.rate_overlay is None or self.queue_overlay is None:
+            return
+
+        samples = self.telemetry.snapshot()
+        if self.trace_plot_return_file:
+            rate, qlen = TelemetryChannel.RETURN_RATE, TelemetryChannel.RETURN_QLEN
+        else:
+            rate, qlen = TelemetryChannel.FORWARD_RATE, TelemetryChannel.FORWARD_QLEN
+
+        position = samples[:, TelemetryChannel.POSITION]
+        self.rate_overlay.set_data(position, samples[:, rate] / 1e6) # Mbps
+        self.queue_overlay.set_data(position, samples[:, qlen]) # packets
+
     def trace_plot_clear(self) -> None:
+        import matplotlib.pyplot as plt
+
         if self.canvas is None:
             return
 
@@ -377,53 +582,134 @@ class EmulatorMode(Mode):
             self.canvas.get_tk_widget().place_forget()
             plt.close(self.fig)
             self.canvas = None
+            self.rate_overlay = None
+            self.queue_overlay = None
+
+    def __link_settings(self) -> Dict[str, TheaterQDualLinkSettings]:
+        # Links without own scenario replay the scenario loaded in the GUI
+        settings = {}
+        for name, link in self.links.links.items():
+            scenario = self.scenario
+            if link.config.scenario is not None:
+                scenario = self.provider.load_scenario_config(link.config.scenario)
+
+            settings[name] = TheaterQDualLinkSettings(scenario.forward_trace,
+                                                      scenario.return_trace,
+                                                      contmode=self.contmode,
+                                                      buffer=scenario.buffer.path)
+        return settings
 
     def start(self, arm: bool = False) -> None:
-        self.load_button.configure(state="disabled")
-        self.play_button.configure(state="disabled")
-        self.arm_button.configure(state="disabled")
-        self.select_loop.configure(state="disabled")
-        self.select_hold.configure(state="disabled")
-        theaterq_settings = TheaterQDualLinkSettings(self.scenario.forward_trace,
-                                                     self.scenario.return_trace,
-                                                     contmode=self.contmode)
-        self.debug_time = 0
+        self.__lock_controls()
 
         try:
-            self.handler.update(theaterq_settings)
-            self.handler.start(arm)
+            self.links.reset_telemetry()
+            self.links.update(self.__link_settings())
+            if not self.links.start(arm):
+                raise Exception("TheaterQ is already running")
         except Exception as ex:
             Logger.error(f"Unable to start TheaterQ replay: {ex}")
             self.stop()
             return
 
+        ReplayState(scenario=self.scenario_key, contmode=str(self.contmode), armed=arm,
+                    links=list(self.links.links.keys())).save()
+
+        if self.capture_var.get():
+            self.capture = PacketCapture(self.config.capture, 
+                                         [self.interface_right, self.interface_left], 
+                                         dryrun=self.debug)
+            self.capture.start()
+
+        self.__follow_replay(arm)
+
+    def __lock_controls(self) -> None:
+        self.load_button.configure(state="disabled")
+        self.play_button.configure(state="disabled")
+        self.arm_button.configure(state="disabled")
+        self.select_loop.configure(state="disabled")
+        self.select_hold.configure(state="disabled")
+        self.capture_toggle.configure(state="disabled")
+        self.clock.reset()
+
+    def __follow_replay(self, arm: bool) -> None:
+        self.recorder = self.__start_recorder(arm)
         self.thread_event = Event()
         self.thread_event.clear()
         self.update_thread = Thread(target=self.__update_event_thread_fn, daemon=True)
         self.update_thread.start()
         self.is_playing = True
+        self.__refresh_display()
+
+    def __try_resume(self) -> None:
+        # Continues the GUI of a replay started by a previous frontend instance as
+        # soon as the mode is enabled and the scenario list is available. The kernel
+        # stats provide the position, the settings are only restored, not uploaded.
+        state = self.resume_state
+        if state is None or not self.is_enabled or self.links is None:
+            return
+
+        if state.scenario not in self.provider.get_scenario_list():
+            return
+
+        self.resume_state = None
+        try:
+            self.preview_scenario = state.scenario
+            self.__load_button()
+            self.contmode = TheaterQContMode.from_str(state.contmode)
+            self.mode_var.set(str(self.contmode))
+            for name, settings in self.__link_settings().items():
+                self.links.get(name).handler.settings = settings
+        except Exception as ex:
+            Logger.error(f"Unable to resume replay of '{state.scenario}': {ex}")
+            self.stop()
+            return
+
+        self.__lock_controls()
+        self.__follow_replay(state.armed)
+        Logger.info(f"Resumed replay of '{state.scenario}' started "
+                    f"{time.time() - state.started:.0f} s ago")
 
     def stop(self, unload: bool = False) -> None:
         if self.thread_event is not None:
             self.thread_event.set()
 
+        if self.refresh_job is not None:
+            self.trace_plot_area.after_cancel(self.refresh_job)
+            self.refresh_job = None
+
+        if self.capture is not None:
+            capture, self.capture = self.capture, None
+            capture.stop()
+            if self.recorder is not None:
+                try:
+                    capture.export(self.recorder.path)
+                except Exception as ex:
+                    Logger.error(f"Unable to export capture: {ex}")
+
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            recorder.close()
+
         self.stop_button.configure(state="disabled")
         self.select_loop.configure(state="normal")
         self.select_hold.configure(state="normal")
+        self.capture_toggle.configure(state="normal")
         self.load_button.configure(state="normal")
 
         total_time = 0
-        self.debug_time = 0
         if self.scenario is not None:
             total_time = self.scenario.get_length_ns()
         EmulatorMode.state_change_callback(self, total_time, 0, TheaterQStage.UNKNOWN)
         self.current_time = 0
 
-        if self.handler is not None:
+        if self.links is not None:
             try:
-                self.handler.stop()
+                self.links.stop()
             except Exception as ex:
                 Logger.error(f"Unable to stop TheaterQ replay: {ex}")
+            ReplayState.clear()
+            self.resume_state = None
 
         if self.video_player is not None:
             self.video_player.update(0)
@@ -437,7 +723,9 @@ class EmulatorMode(Mode):
             self.video_player = None
             self.video_label.place(relx=0.5, rely=0.5, anchor="center")
             self.scenario = None
+            self.comparison = None
             self.load_button.configure(state="disabled")
+            self.compare_button.configure(state="disabled")
             self.play_button.configure(state="disabled")
             self.arm_button.configure(state="disabled")
             self.replay_name.configure(text="Not loaded")
@@ -469,6 +757,9 @@ class EmulatorMode(Mode):
                                   self.provider.get_scenario_details(self.preview_scenario))
 
         self.scenario = self.provider.load_scenario_config(self.preview_scenario)
+        self.scenario_key = self.preview_scenario
+        self.comparison = None
+        self.compare_button.configure(state="normal")
 
         if self.canvas is not None:
             self.trace_plot_clear()
@@ -482,6 +773,7 @@ class EmulatorMode(Mode):
         self.trace_plot_init_draw()
 
         if self.scenario.video is not None:
+            from utils.video_player import VideoPlayer
             self.video_label.place_forget()
             self.video_frame.place(relx=0.5, rely=0.5, anchor="center")
             self.video_player = VideoPlayer(self.video_frame, self.scenario.video, height=300, width=720)
@@ -491,6 +783,47 @@ class EmulatorMode(Mode):
                                            time_current=0, 
                                            stage=TheaterQStage.UNKNOWN)
 
+    def __compare_button(self) -> None:
+        if self.scenario is None or self.preview_scenario is None:
+            return
+
+        # Loading and aligning hour-long traces takes a moment, keep the GUI responsive
+        self.compare_button.configure(state="disabled")
+        Thread(target=self.__compare_thread_fn, args=(self.scenario, self.preview_scenario), 
+               daemon=True).start()
+
+    def __compare_thread_fn(self, scenario: ScenarioConfig, name: str) -> None:
+        try:
+            other = self.provider.load_scenario_config(name)
+            comparison = {False: compare_scenarios(scenario, other, return_trace=False),
+                          True: compare_scenarios(scenario, other, return_trace=True)}
+        except Exception as ex:
+            Logger.error(f"Unable to compare '{scenario.name}' with '{name}': {ex}")
+            comparison = None
+
+        self.maingui.add_async_event(EmulatorMode.compare_ready_callback, context=self, 
+                                     scenario=scenario, name=name, comparison=comparison)
+
+    @staticmethod
+    def compare_ready_callback(context, scenario: ScenarioConfig, name: str, comparison) -> None:
+        if context.scenario is None:
+            return
+
+        context.compare_button.configure(state="normal")
+        if comparison is None or context.scenario is not scenario:
+            return
+
+        context.comparison = comparison
+        context.compare_name = name
+        summary = [f"{scenario.name} (A) vs. {name} (B)"]
+        for direction, return_trace in [("Forward", False), ("Return", True)]:
+            summary.append(f"{direction}:")
+            summary.extend(f"  {line}" for line in format_summary(comparison[return_trace]))
+        context.full_replace_textbox(context.scenario_description, "\n".join(summary))
+
+        context.trace_plot_clear()
+        context.trace_plot_init_draw()
+
     def __cont_mode_change(self) -> None:
         self.contmode = TheaterQContMode(self.mode_var.get())
 
@@ -511,61 +844,81 @@ class EmulatorMode(Mode):
     
     def enable(self) -> None:
         self.is_enabled = True
-        if self.masquerade:
+        if self.firewall is not None:
             try:
-                run_fail_on_error(f"iptables -t nat -A PREROUTING -i {self.config.extended.get_left_interface_name()} -d {self.config.extended.public_interface.get_public_ip()} -j DNAT --to-destination {self.config.general.right_endpoint_ip}", sudo=True, dryrun=self.debug)
-                run_fail_on_error(f"conntrack -F", sudo=True, dryrun=self.debug)
+                self.firewall.select(None)
             except Exception as ex:
-                Logger.error(f"Unable to install iptables rule: {ex}")
+                Logger.error(f"Unable to switch forwarding mode: {ex}")
+
+        # A replay survives restarts of the frontend, its links are adopted as they are
+        state = ReplayState.load()
+        adopt = state is not None
 
         try:
-            self.handler = TheaterQHandler(forward_interface=self.interface_right,
-                                           return_interface=self.interface_left,
-                                           dryrun=self.debug)
+            # The mock replaces the kernel module, so its commands run in debug mode too
+            self.links = LinkRegistry(dryrun=self.debug, mock=self.mock)
+            if self.config.classful is not None:
+                primary = self.__add_traffic_classes(self.config.classful, adopt)
+            else:
+                primary = self.links.add(LinkConfig(name="primary", 
+                                                    forward_interface=self.interface_right,
+                                                    return_interface=self.interface_left,
+                                                    handle=1, syncgroup=1),
+                                         telemetry=self.telemetry, adopt=adopt)
+            self.handler = primary.handler
+
+            for link in self.config.links:
+                self.links.add(link, adopt=adopt)
         except Exception as ex:
             Logger.error(f"Error preparing TheaterQ: {ex}")
             return
 
+        if adopt:
+            if self.links.adopted and sorted(state.links) == sorted(self.links.links.keys()):
+                self.resume_state = state
+                self.__try_resume()
+            else:
+                Logger.warning("Previous replay does not match the configured links, stopping it")
+                self.links.stop()
+                ReplayState.clear()
+
         Logger.info("Emulator enabled")
 
+    def __add_traffic_classes(self, classful: ClassfulConfig, adopt: bool = False) -> EmulatedLink:
+        # One TheaterQ leaf per traffic class, the first class is shown in the GUI
+        options = self.mock.classifier_options() if self.mock is not None else {"dryrun": self.debug}
+        self.classifier = TheaterQClassifier(forward_interface=self.interface_right,
+                                             return_interface=self.interface_left,
+                                             root=classful.root, filter_type=classful.filter,
+                                             matches=[traffic_class.match for traffic_class in classful.classes],
+                                             **options)
+        if not (adopt and self.classifier.is_installed()):
+            self.classifier.install()
+
+        links = []
+        for index, traffic_class in enumerate(classful.classes):
+            links.append(self.links.add(LinkConfig(name=traffic_class.name,
+                                                   forward_interface=self.interface_right,
+                                                   return_interface=self.interface_left,
+                                                   handle=TheaterQClassifier.leaf_handle(index),
+                                                   syncgroup=traffic_class.syncgroup,
+                                                   parent=self.classifier.class_id(index),
+                                                   scenario=traffic_class.scenario),
+                                        telemetry=self.telemetry if index == 0 else None,
+                                        adopt=adopt))
+        return links[0]
+
     def disable(self) -> None:
         self.is_enabled = False
 
         self.stop(unload=True)
-        del self.handler
+        if self.links is not None:
+            self.links.clean()
+        self.links = None
         self.handler = None
 
-        if self.masquerade:
-            try:
-                run_fail_on_error(f"iptables -t nat -D PREROUTING -i {self.config.extended.get_left_interface_name()} -d {self.config.extended.public_interface.get_public_ip()} -j DNAT --to-destination {self.config.general.right_endpoint_ip}", sudo=True, dryrun=self.debug)
-            except Exception as ex:
-                Logger.error(f"Unable to remove iptables rule: {ex}")
+        if self.classifier is not None:
+            self.classifier.clean()
+        self.classifier = None
 
         Logger.info("Emulator disabled")
-
-    @staticmethod
-    def cleanup_old_config(config: FullConfig, interface_right: str, 
-                           interface_left: str, dryrun: bool = False) -> None:
-        run_log_on_error(f"iptables -t nat -D PREROUTING -i {config.extended.get_left_interface_name()} -d {config.extended.public_interface.get_public_ip()} -j DNAT --to-destination {config.general.right_endpoint_ip}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"ip addr del {config.general.right_interface_address} dev {interface_right}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"ip addr del {config.general.left_interface_address} dev {interface_left}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"ip link set down dev {interface_right}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"ip link set down dev {interface_left}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"ip link set down dev {BRIDGE_MODE_BRIDGE_NAME}", sudo=True, dryrun=dryrun, log_debug=True)
-        run_log_on_error(f"brctl delbr {BRIDGE_MODE_BRIDGE_NAME}", sudo=True, dryrun=dryrun, log_debug=True)
-
-    @staticmethod
-    def config_interfaces(config: FullConfig, interface_right: str, interface_left: str, 
-                          as_bridge: bool = False, dryrun: bool = False) -> None:
-        
-        if not as_bridge:
-            run_fail_on_error(f"ip addr add {config.general.right_interface_address} dev {interface_right}", sudo=True, dryrun=dryrun)
-            run_fail_on_error(f"ip addr add {config.general.left_interface_address} dev {interface_left}", sudo=True, dryrun=dryrun)
-        else:
-            run_fail_on_error(f"brctl addbr {BRIDGE_MODE_BRIDGE_NAME}", sudo=True, dryrun=dryrun)
-            run_fail_on_error(f"brctl addif {BRIDGE_MODE_BRIDGE_NAME} {interface_left}", sudo=True, dryrun=dryrun)
-            run_fail_on_error(f"brctl addif {BRIDGE_MODE_BRIDGE_NAME} {interface_right}", sudo=True, dryrun=dryrun)
-            run_fail_on_error(f"ip link set up dev {BRIDGE_MODE_BRIDGE_NAME}", sudo=True, dryrun=dryrun)
-        
-        run_fail_on_error(f"ip link set up dev {interface_right}", sudo=True, dryrun=dryrun)
-        run_fail_on_error(f"ip link set up dev {interface_left}", sudo=True, dryrun=dryrun)
@@ -1,18 +1,19 @@
 import tkinter as tk
 
 from tkinter import ttk
+from typing import Optional
 
 from modes.mode import Mode
 from utils.logger import Logger
-from utils.utils import run_fail_on_error
+from utils.firewall import Firewall
 from constants import *
 from models.config import *
 
 
 class PassthroughMode(Mode):
-    def __init__(self, config: FullConfig, maingui, debug: bool, masquerade: bool = False):
+    def __init__(self, config: FullConfig, maingui, debug: bool, firewall: Optional[Firewall] = None):
         super().__init__(config, maingui, debug)
-        self.masquerade = masquerade
+        self.firewall = firewall
 
     def add_tabs(self, window) -> None:
         frame = ttk.Frame(window.get_tabs())
@@ -22,26 +23,13 @@ class PassthroughMode(Mode):
         window.add_tab("Passthrough", frame, self)
     
     def enable(self) -> None:
-        if self.masquerade:
+        if self.firewall is not None:
             try:
-                run_fail_on_error(f"iptables -t nat -A PREROUTING -i {self.config.extended.get_left_interface_name()} -d {self.config.extended.public_interface.get_public_ip()} -j DNAT --to-destination {self.config.general.right_endpoint_ip}", 
-                                  sudo=True, 
-                                  dryrun=self.debug)
-                run_fail_on_error(f"conntrack -F", 
-                                  sudo=True, 
-                                  dryrun=self.debug)
+                self.firewall.select(None)
             except Exception as ex:
-                Logger.error(f"Unable to install iptables rule: {ex}")
+                Logger.error(f"Unable to switch forwarding mode: {ex}")
 
         Logger.info("Passthrough enabled")
 
     def disable(self) -> None:
-        if self.masquerade:
-            try:
-                run_fail_on_error(f"iptables -t nat -D PREROUTING -i {self.config.extended.get_left_interface_name()} -d {self.config.extended.public_interface.get_public_ip()} -j DNAT --to-destination {self.config.general.right_endpoint_ip()}", 
-                                  sudo=True, 
-                                  dryrun=self.debug)
-            except Exception as ex:
-                Logger.error(f"Unable to remove iptables rule: {ex}")
-
         Logger.info("Passthrough disbaled")
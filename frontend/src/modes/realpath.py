@@ -1,15 +1,22 @@
 import tkinter as tk
+import os
 import subprocess
+import sys
 import time
 from threading import Thread
 
 from tkinter import ttk
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 from modes.mode import Mode
 from utils.logger import Logger
+from utils.bringup import BringupGraph
+from utils.gateway_monitor import GatewayMonitor
+from utils.firewall import Firewall
+from utils.path_prober import PathProber, PathStatus
+from utils.trace_generator import write_scenario
 from constants import *
-from utils.utils import run_fail_on_error, run_log_on_error
+from utils.utils import run_fail_on_error, run_log_on_error, start_subprocess
 from models.config import *
 
 
@@ -21,84 +28,122 @@ class RealpathMode:
         self.debug = debug
         self.maingui = maingui
         self.config = config
+        self.session_path: Callable[[], str] = lambda: SESSION_FALLBACK_PATH
+        self.firewall = Firewall(config, dryrun=debug)
 
         self.modes: List[RealpathModeEntry] = []
         for subconfig in self.config.extended.configs:
             self.modes.append(RealpathModeEntry(config=subconfig,
                                                 left_vlan_interface=config.extended.get_left_interface_name(),
                                                 base_interface=right_interface,
-                                                debug=debug, maingui=maingui))
+                                                debug=debug, maingui=maingui, firewall=self.firewall,
+                                                session_path=lambda: self.session_path()))
 
     def add_tabs(self, window) -> None:
         for mode in self.modes:
             mode.add_tabs(window)
 
-    def config_interfaces(self) -> None:
+    def config_interfaces(self, ready_callback: Optional[Callable[[], None]] = None, 
+                          links_ready: bool = False) -> None:
+        # Independent steps run concurrently, see BringupGraph. ready_callback is called
+        # once the interfaces are usable, the upstream gateways are awaited per tab.
+        # With links_ready, the interfaces are already in place (see Reconciler) and
+        # only the firewall and gateways are set up.
         def exec_in_default(cmd):
             run_fail_on_error(cmd, sudo=True, dryrun=self.debug)
 
-        # Config left interface
-        exec_in_default(f"ip link set up {self.left_interface}")
-        exec_in_default(f"ip link add link {self.left_interface} name {self.config.extended.get_left_interface_name()} type vlan id {self.config.extended.left_vlan}")
-        exec_in_default(f"ip addr add {self.config.general.left_interface_address} dev {self.config.extended.get_left_interface_name()}")
-        exec_in_default(f"ip link set up dev {self.config.extended.get_left_interface_name()}")
-
-        # Setup backrouting (right) namespace and interfaces
-        exec_in_default(f"ip netns add {PUBLIC_NETNS_NAME}")
-        exec_in_default(f"ip link set up {self.right_interface}")
-        exec_in_default(f"ip link add link {self.right_interface} name {self.config.extended.public_interface.get_public_interface_name()} type vlan id {self.config.extended.public_interface.vlan}")
-        exec_in_default(f"ip link set up dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_default(f"ip link set dev {self.config.extended.public_interface.get_public_interface_name()} netns {PUBLIC_NETNS_NAME}")
-
         def exec_in_netns(cmd):
             run_fail_on_error(f"ip netns exec {PUBLIC_NETNS_NAME} {cmd}", sudo=True, dryrun=self.debug)
 
-        exec_in_netns(f"ip link set up dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_netns(f"ip addr add {self.config.extended.public_interface.address} dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_netns(f"ip route add default via {self.config.extended.public_interface.gateway} dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_default(f"ip link add veth-host type veth peer name veth-public")
-        exec_in_default(f"ip link set veth-public netns {PUBLIC_NETNS_NAME}")
-        exec_in_default(f"ip link add link {self.right_interface} name {self.config.extended.get_right_interface_name()} type vlan id {self.config.extended.right_vlan}")
-        exec_in_default(f"brctl addbr {NETNS_RIGHT_BRIDGE_NAME}")
-        exec_in_default(f"brctl addif {NETNS_RIGHT_BRIDGE_NAME} veth-host")
-        exec_in_default(f"brctl addif {NETNS_RIGHT_BRIDGE_NAME} {self.config.extended.get_right_interface_name()}")
-        exec_in_default(f"ip link set up dev {NETNS_RIGHT_BRIDGE_NAME}")
-        exec_in_default(f"ip addr add {self.config.general.right_interface_address} dev {NETNS_RIGHT_BRIDGE_NAME}")
-        exec_in_default(f"ip link set up dev {self.config.extended.get_right_interface_name()}")
-        exec_in_default(f"ip link set up dev veth-host")
-        exec_in_netns(f"ip addr add {self.config.extended.right_netns_address} dev veth-public")
-        exec_in_netns(f"ip link set up dev veth-public")
-        
-        # Install iptables rules
-        exec_in_netns(f"iptables -t nat -A POSTROUTING -o veth-public -j MASQUERADE")
-        exec_in_default(f"iptables -t nat -A POSTROUTING -o {NETNS_RIGHT_BRIDGE_NAME} -j MASQUERADE")
+        public_interface = self.config.extended.public_interface
+        public_vlan_time = []
+        graph = BringupGraph("realpath")
 
-        # Setup upstream links
-        threads = []
-        for mode in self.modes:
-            mode.setup()
-            t = Thread(target=mode.wait_for_initial_config, args=(), daemon=True)
-            t.start()
-            threads.append(t)
+        def add_link_step(name, action, requires=None):
+            graph.add(name, (lambda: None) if links_ready else action, requires)
+
+        # Config left interface
+        def config_left():
+            exec_in_default(f"ip link set up {self.left_interface}")
+            exec_in_default(f"ip link add link {self.left_interface} name {self.config.extended.get_left_interface_name()} type vlan id {self.config.extended.left_vlan}")
+            exec_in_default(f"ip addr add {self.config.general.left_interface_address} dev {self.config.extended.get_left_interface_name()}")
+            exec_in_default(f"ip link set up dev {self.config.extended.get_left_interface_name()}")
+        add_link_step("left", config_left)
+
+        # Setup backrouting (right) namespace and interfaces
+        add_link_step("netns", lambda: exec_in_default(f"ip netns add {PUBLIC_NETNS_NAME}"))
+        add_link_step("right", lambda: exec_in_default(f"ip link set up {self.right_interface}"))
+
+        def config_public_vlan():
+            exec_in_default(f"ip link add link {self.right_interface} name {public_interface.get_public_interface_name()} type vlan id {public_interface.vlan}")
+            exec_in_default(f"ip link set up dev {public_interface.get_public_interface_name()}")
+            exec_in_default(f"ip link set dev {public_interface.get_public_interface_name()} netns {PUBLIC_NETNS_NAME}")
+            exec_in_netns(f"ip link set up dev {public_interface.get_public_interface_name()}")
+            exec_in_netns(f"ip addr add {public_interface.address} dev {public_interface.get_public_interface_name()}")
+            exec_in_netns(f"ip route add default via {public_interface.gateway} dev {public_interface.get_public_interface_name()}")
+            public_vlan_time.append(time.monotonic())
+        add_link_step("public-vlan", config_public_vlan, requires=["netns", "right"])
+
+        def config_veth():
+            exec_in_default(f"ip link add veth-host type veth peer name veth-public")
+            exec_in_default(f"ip link set veth-public netns {PUBLIC_NETNS_NAME}")
+            exec_in_netns(f"ip addr add {self.config.extended.right_netns_address} dev veth-public")
+            exec_in_netns(f"ip link set up dev veth-public")
+        add_link_step("veth", config_veth, requires=["netns"])
+
+        def config_right_bridge():
+            exec_in_default(f"ip link add link {self.right_interface} name {self.config.extended.get_right_interface_name()} type vlan id {self.config.extended.right_vlan}")
+            exec_in_default(f"brctl addbr {NETNS_RIGHT_BRIDGE_NAME}")
+            exec_in_default(f"brctl addif {NETNS_RIGHT_BRIDGE_NAME} veth-host")
+            exec_in_default(f"brctl addif {NETNS_RIGHT_BRIDGE_NAME} {self.config.extended.get_right_interface_name()}")
+            exec_in_default(f"ip link set up dev {NETNS_RIGHT_BRIDGE_NAME}")
+            exec_in_default(f"ip addr add {self.config.general.right_interface_address} dev {NETNS_RIGHT_BRIDGE_NAME}")
+            exec_in_default(f"ip link set up dev {self.config.extended.get_right_interface_name()}")
+            exec_in_default(f"ip link set up dev veth-host")
+        add_link_step("right-bridge", config_right_bridge, requires=["right", "veth"])
+
+        # NAT and marking, see Firewall. Rules match interface names, so they do not
+        # depend on the interface steps.
+        graph.add("firewall", self.firewall.apply)
+        graph.add("nat", self.firewall.apply_public, requires=["netns"])
+
+        # Setup upstream links, gateways are discovered by route notifications
+        monitor = None
+        if not self.debug:
+            try:
+                monitor = GatewayMonitor()
+                monitor.start()
+            except Exception as ex:
+                Logger.warning(f"Unable to monitor routes, falling back to polling: {ex}")
+                monitor = None
 
-        for t in threads:
-            t.join()
-        
         for mode in self.modes:
-            if not mode.is_ready():
-                Logger.info(f"Unable to set up {mode.name}: No default gateway was found.")
-        
+            add_link_step(f"uplink-{mode.name}", mode.setup, requires=["right"])
+            graph.add(f"gateway-{mode.name}", lambda mode=mode: mode.wait_for_initial_config(monitor), 
+                      requires=[f"uplink-{mode.name}"])
+
+        if ready_callback is not None:
+            graph.add("ready", ready_callback, 
+                      requires=["left", "public-vlan", "nat", "firewall"] + [f"uplink-{mode.name}" for mode in self.modes])
+
         # Some hacky workaround: Add the VLAN interface again to the network namespace with a delay. 
         # Otherwise the interface has lost its physical interface mapping in the netns.
-        exec_in_netns(f"ip link del {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_default(f"ip link add link {self.left_interface} name {self.config.extended.public_interface.get_public_interface_name()} type vlan id {self.config.extended.public_interface.vlan}")
-        exec_in_default(f"ip link set dev {self.config.extended.public_interface.get_public_interface_name()} netns {PUBLIC_NETNS_NAME}")
-        exec_in_netns(f"ip link set up dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_netns(f"ip addr add {self.config.extended.public_interface.address} dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_netns(f"ip route add default via {self.config.extended.public_interface.gateway} dev {self.config.extended.public_interface.get_public_interface_name()}")
-        exec_in_netns(f"iptables -t nat -A PREROUTING -i {self.config.extended.public_interface.get_public_interface_name()} -p tcp -j DNAT --to-destination {self.config.general.right_endpoint_ip}")
-        exec_in_netns(f"iptables -t nat -A PREROUTING -i {self.config.extended.public_interface.get_public_interface_name()} -p udp -j DNAT --to-destination {self.config.general.right_endpoint_ip}")
+        def readd_public_vlan():
+            time.sleep(max(0.0, public_vlan_time[0] + PUBLIC_VLAN_READD_DELAY - time.monotonic()))
+            exec_in_netns(f"ip link del {public_interface.get_public_interface_name()}")
+            exec_in_default(f"ip link add link {self.left_interface} name {public_interface.get_public_interface_name()} type vlan id {public_interface.vlan}")
+            exec_in_default(f"ip link set dev {public_interface.get_public_interface_name()} netns {PUBLIC_NETNS_NAME}")
+            exec_in_netns(f"ip link set up dev {public_interface.get_public_interface_name()}")
+            exec_in_netns(f"ip addr add {public_interface.address} dev {public_interface.get_public_interface_name()}")
+            exec_in_netns(f"ip route add default via {public_interface.gateway} dev {public_interface.get_public_interface_name()}")
+        add_link_step("public-vlan-readd", readd_public_vlan, 
+                  requires=["public-vlan", "nat"] + [f"gateway-{mode.name}" for mode in self.modes])
 
+        try:
+            graph.run()
+        finally:
+            if monitor is not None:
+                monitor.stop()
 
     def cleanup_old_config(self) -> None:
         # Cleanup upstream links
@@ -111,11 +156,8 @@ class RealpathMode:
                          dryrun=self.debug, 
                          log_debug=True)
         
-        # Delete iptables rules (network namespace will be cleaned by deletion)
-        run_log_on_error(f"iptables -t nat -D POSTROUTING -o {NETNS_RIGHT_BRIDGE_NAME} -j MASQUERADE", 
-                         sudo=True, 
-                         dryrun=self.debug, 
-                         log_debug=True)
+        # Delete the firewall table (the public one is cleaned by deletion of its namespace)
+        self.firewall.remove()
 
         # Cleanup backrouting interfaces and namespace
         run_log_on_error(f"ip netns del {PUBLIC_NETNS_NAME}", 
@@ -150,7 +192,9 @@ class RealpathMode:
 
 class RealpathModeEntry(Mode):
     def __init__(self, config: RealNetworkEntry, base_interface: str, 
-                 left_vlan_interface: str, maingui, debug: bool = False,):
+                 left_vlan_interface: str, maingui, debug: bool = False,
+                 session_path: Callable[[], str] = lambda: SESSION_FALLBACK_PATH,
+                 firewall: Optional[Firewall] = None):
         super().__init__(None, maingui, debug)
 
         self.name = config.name
@@ -161,53 +205,155 @@ class RealpathModeEntry(Mode):
         self.base_interface = base_interface
         self.default_gateway: Optional[str] = None
         self.fwmark = config.vlan
+        self.ready: Optional[bool] = None # None while waiting for the gateway
+        self.is_active = False
+        self.session_path = session_path
+        self.firewall = firewall
+        self.prober = PathProber(self.name, self.interface_name, self.fwmark, 
+                                 config.probe_target, config.probe_interval, dryrun=debug)
+        self.record_start: Optional[float] = None
+        self.recorder: Optional[subprocess.Popen] = None
 
     def add_tabs(self, window) -> None:
-        frame = ttk.Frame(window.get_tabs())
-        self.label = ttk.Label(frame, text=f"Real path via {self.name} is enabled.")
-        self.label.place(relx=0.5, rely=0.5, anchor="center")
+        self.frame = ttk.Frame(window.get_tabs())
+        self.label = ttk.Label(self.frame, text=f"Waiting for default gateway of {self.name} ...")
+        self.label.place(relx=0.5, rely=0.4, anchor="center")
         self.label.configure(font=('URW Gothic L', '28', 'bold'))
-        window.add_tab(self.name, frame, self)
+        self.health_label = ttk.Label(self.frame, text="")
+        self.health_label.place(relx=0.5, rely=0.5, anchor="center")
+        self.health_label.configure(font=('URW Gothic L', '18'))
+        self.record_button = ttk.Button(self.frame, text="Record Trace", style="R.TButton", 
+                                        command=self.__record_button)
+        self.record_button.configure(state="disabled")
+        self.record_button.place(relx=0.5, rely=0.6, anchor="center")
+        window.add_tab(self.name, self.frame, self)
+
+    def __refresh_health(self) -> None:
+        health = self.prober.health()
+        colors = {PathStatus.UP: "lawngreen", PathStatus.DEGRADED: "orange", PathStatus.DOWN: "red"}
+        self.health_label.configure(text=f"{health} (probing {self.prober.target})", 
+                                    foreground=colors.get(health.status, "white"))
+        if self.record_start is not None:
+            self.record_button.configure(text=f"Stop Recording ({time.time() - self.record_start:.0f} s)")
+        self.frame.after(1000, self.__refresh_health)
+
+    def __record_button(self) -> None:
+        if self.record_start is None:
+            self.__start_recorder()
+            return
+
+        self.record_button.configure(text="Record Trace")
+        if self.recorder is not None:
+            # The recorder writes the scenario after it was stopped
+            self.record_start = None
+            self.record_button.configure(state="disabled")
+            self.recorder.terminate()
+            Thread(target=self.__wait_recorder, args=(self.recorder,), daemon=True).start()
+            self.recorder = None
+            return
+
+        self.__export_probes()
+
+    def __start_recorder(self) -> None:
+        # Active recorder (raw sockets, needs root), the passive probes are used in debug mode
+        self.record_start = time.time()
+        output = os.path.join(self.session_path(), "recordings")
+        name = f"{self.name} {time.strftime('%Y%m%d-%H%M%S', time.localtime(self.record_start))}"
+        try:
+            self.recorder = start_subprocess([sys.executable, "-m", "utils.path_recorder", self.interface_name,
+                                              "--fwmark", str(self.fwmark), "--target", self.prober.target,
+                                              "--output", output, "--name", name,
+                                              "--granularity", str(REALPATH_TRACE_GRANULARITY),
+                                              "--budget", str(self.config.record_budget)],
+                                             shell=False, sudo=True, dryrun=self.debug, 
+                                             stdout=subprocess.PIPE)
+        except Exception as ex:
+            Logger.error(f"Unable to start recorder for {self.name}: {ex}")
+            self.record_start = None
+            return
+        Logger.info(f"Recording trace of {self.name}")
+
+    def __wait_recorder(self, process: subprocess.Popen) -> None:
+        stdout, stderr = process.communicate()
+        output = stdout.decode("utf-8", errors="replace").strip().splitlines() if stdout else []
+        if process.returncode != 0:
+            Logger.error(f"Recorder for {self.name} failed: {stderr.decode('utf-8', errors='replace').strip()}")
+        elif len(output) == 0:
+            Logger.error(f"Recorder for {self.name} exited without writing a scenario")
+        else:
+            Logger.info(output[-1])
+        self.maingui.add_async_event(lambda context: context.record_button.configure(state="normal"), 
+                                     context=self)
+
+    def __export_probes(self) -> None:
+        start, end = self.record_start, time.time()
+        self.record_start = None
+        try:
+            trace = self.prober.to_trace(start, end, granularity=REALPATH_TRACE_GRANULARITY)
+            name = f"{self.name} {time.strftime('%Y%m%d-%H%M%S', time.localtime(start))}"
+            path = write_scenario(os.path.join(self.session_path(), "recordings"), name, 
+                                  f"Recorded via {self.name} (RTT/2 per direction, probing {self.prober.target}).", 
+                                  trace, trace)
+            Logger.info(f"Recorded trace of {self.name} written to {path}")
+        except Exception as ex:
+            Logger.error(f"Unable to write recorded trace of {self.name}: {ex}")
+
+    @staticmethod
+    def ready_callback(context, ready: bool) -> None:
+        context.ready = ready
+        if not ready:
+            context.label.configure(text=f"{context.name} not enabled due to setup error.", foreground="red")
+            return
+
+        context.label.configure(text=f"Real path via {context.name} is enabled.")
+        context.record_button.configure(state="normal")
+        context.__refresh_health()
+        if context.is_active:
+            context.prober.start()
+            Logger.info(f"Real path {context.name} enabled")
     
     def enable(self) -> None:
-        if self.default_gateway is None:
+        # Marked traffic falls back to the main table until the gateway route exists
+        self.is_active = True
+        if self.firewall is not None:
+            try:
+                self.firewall.select(self.fwmark)
+            except Exception as ex:
+                Logger.error(f"Unable to switch forwarding mode: {ex}")
+
+        if self.ready is None:
+            Logger.info(f"{self.name} is enabled once its default gateway is available")
+            return
+
+        if not self.ready:
             Logger.error(f"Cannot enable {self.name} without default gateway!")
             self.label.configure(text=f"{self.name} not enabled due to setup error.", foreground="red")
             return
 
-        try:
-            run_fail_on_error(f"iptables -t mangle -A PREROUTING -i {self.left_vlan_interface} -j MARK --set-mark {self.fwmark}", 
-                              sudo=True, 
-                              dryrun=self.debug)
-            run_fail_on_error(f"ip rule add fwmark {self.fwmark} table {self.fwmark}", 
-                              sudo=True, 
-                              dryrun=self.debug)
-            run_fail_on_error(f"conntrack -F", 
-                              sudo=True, 
-                              dryrun=self.debug)
-        except Exception as ex:
-            Logger.error(f"Unable to install required route: {ex}")
-
+        self.prober.start()
         Logger.info(f"Real path {self.name} enabled")
 
     def disable(self) -> None:
-        if self.default_gateway is None:
-            Logger.error(f"Cannot disable {self.name} without default gateway!")
-            return
+        self.is_active = False
+        self.prober.stop()
+        if self.ready:
+            Logger.info(f"Real path {self.name} disbaled")
 
-        try:
-            run_fail_on_error(f"iptables -t mangle -D PREROUTING -i {self.left_vlan_interface} -j MARK --set-mark {self.fwmark}", 
-                              sudo=True, 
-                              dryrun=self.debug)
-            run_fail_on_error(f"ip rule del fwmark {self.fwmark} table {self.fwmark}", 
-                              sudo=True, 
-                              dryrun=self.debug)
-        except Exception as ex:
-            Logger.error(f"Unable to remove route: {ex}")
+    def wait_for_initial_config(self, monitor: Optional[GatewayMonitor] = None) -> None:
+        self.__wait_for_gateway(monitor)
 
-        Logger.info(f"Real path {self.name} disbaled")
+        ready = False
+        if self.default_gateway is not None:
+            try:
+                ready = self.is_ready()
+            except Exception as ex:
+                Logger.error(f"{self.name}: Unable to install default route: {ex}")
+        else:
+            Logger.info(f"Unable to set up {self.name}: No default gateway was found.")
 
-    def wait_for_initial_config(self) -> None:
+        self.maingui.add_async_event(RealpathModeEntry.ready_callback, context=self, ready=ready)
+
+    def __wait_for_gateway(self, monitor: Optional[GatewayMonitor]) -> None:
         if self.debug:
             time.sleep(5)
 
@@ -220,7 +366,12 @@ class RealpathModeEntry(Mode):
         
         if self.config.gateway is not None:
             self.default_gateway = self.config.gateway
-            time.sleep(5)
+            return
+
+        if monitor is not None:
+            self.default_gateway = monitor.wait(self.interface_name, timeout=10)
+            if self.default_gateway is None:
+                Logger.error(f"{self.name}: Interface {self.interface_name}: Unable to get gateway in timeout")
             return
 
         start = time.time()
@@ -243,7 +394,7 @@ class RealpathModeEntry(Mode):
     def is_ready(self) -> bool:
         if self.default_gateway is not None:
             Logger.info(f"Got default gateway for {self.name}: {self.default_gateway}")
-            run_fail_on_error(f"ip route add default via {self.default_gateway} dev {self.interface_name} table {self.fwmark}", 
+            run_fail_on_error(f"ip route replace default via {self.default_gateway} dev {self.interface_name} table {self.fwmark}", 
                               sudo=True, 
                               dryrun=self.debug)
             return True
@@ -251,13 +402,6 @@ class RealpathModeEntry(Mode):
             return False
 
     def cleanup_config(self) -> None:
-        run_log_on_error(f"iptables -t nat -D POSTROUTING -o {self.interface_name} -j MASQUERADE", sudo=True, 
-                         dryrun=self.debug, 
-                         log_debug=True)
-        run_log_on_error(f"iptables -t mangle -D PREROUTING -i {self.left_vlan_interface} -j MARK --set-mark {self.fwmark}", 
-                         sudo=True, 
-                         dryrun=self.debug, 
-                         log_debug=True)
         run_log_on_error(f"ip rule del fwmark {self.fwmark} table {self.fwmark}", 
                          sudo=True, 
                          dryrun=self.debug, 
@@ -286,9 +430,9 @@ class RealpathModeEntry(Mode):
             run_fail_on_error(f"ip route add default via {self.config.gateway} dev {self.interface_name}", 
                               sudo=True,
                               dryrun=self.debug)
-            
 
-        run_fail_on_error(f"iptables -t nat -A POSTROUTING -o {self.interface_name} -j MASQUERADE", 
+        # Marked by the firewall, the table is filled once the gateway is known
+        run_fail_on_error(f"ip rule add fwmark {self.fwmark} table {self.fwmark}", 
                           sudo=True, 
                           dryrun=self.debug)
 
@@ -0,0 +1,59 @@
+import unittest
+
+from utils.helper import HelperServer, HelperRequest, HelperOperation
+
+
+class HelperValidationTest(unittest.TestCase):
+    # Requests of group 'emulator' members that must never run programs as root
+    def setUp(self):
+        self.server = HelperServer(path="/nonexistent/helper.sock", group=None)
+
+    def validate(self, request: HelperRequest) -> None:
+        self.server._HelperServer__validate(request)
+
+    def assertRejected(self, operation: HelperOperation, argv, netns=None, input=None) -> None:
+        with self.assertRaises(ValueError, msg=" ".join(argv)):
+            self.validate(HelperRequest(operation, argv, netns=netns, input=input))
+
+    def test_accepts_frontend_commands(self):
+        for argv in [["tc", "-s", "-j", "qdisc", "show", "dev", "eth0"],
+                     ["ip", "-j", "-n", "public", "link", "show"],
+                     ["ip", "link", "add", "link", "eth0", "name", "eth0.10", "type", "vlan", "id", "10"],
+                     ["ip", "netns", "add", "public"],
+                     ["nft", "flush map ip emulator mode"],
+                     ["nft", "-j", "list", "table", "ip", "emulator"],
+                     ["conntrack", "-D", "-s", "172.16.1.2"],
+                     ["sysctl", "-w", "net.ipv4.ip_forward=1"],
+                     ["chrt", "-f", "-p", "50", "123"]]:
+            self.validate(HelperRequest(HelperOperation.classify(argv), argv))
+        self.validate(HelperRequest(HelperOperation.NETFILTER, ["nft", "-f", "-"], netns="public",
+                                    input=b"table ip emulator\n"))
+
+    def test_rejects_batch_abbreviations(self):
+        for option in ["-b", "-ba", "-bat", "-batc", "-batch", "-force", "-a", "-all"]:
+            self.assertRejected(HelperOperation.LINK, ["ip", option, "-", "link"], input=b"netns exec x sh\n")
+            self.assertRejected(HelperOperation.LINK, ["ip", option, "-", "link"])
+            self.assertRejected(HelperOperation.QDISC, ["tc", option, "-", "qdisc"])
+
+    def test_rejects_stdin_for_other_commands(self):
+        self.assertRejected(HelperOperation.LINK, ["ip", "link", "show"], input=b"exec sh\n")
+        self.assertRejected(HelperOperation.QDISC, ["tc", "qdisc", "show"], input=b"exec sh\n")
+
+    def test_rejects_nft_files(self):
+        for argv in [["nft", "-f", "/etc/shadow"], ["nft", "--fi", "/etc/shadow"],
+                     ["nft", "--file=/etc/shadow"], ["nft", "-I", "/tmp", "-f", "-"],
+                     ["nft", "--inc", "/tmp", "list", "ruleset"]]:
+            self.assertRejected(HelperOperation.NETFILTER, argv)
+
+    def test_rejects_other_programs(self):
+        self.assertRejected(HelperOperation.SCHEDULER, ["chrt", "-f", "1", "sh", "-c", "id"])
+        self.assertRejected(HelperOperation.NETNS, ["ip", "netns", "exec", "public", "sh", "-c", "id"])
+        self.assertRejected(HelperOperation.NETNS, ["ip", "-n", "x", "netns", "exec", "public", "sh"])
+        self.assertRejected(HelperOperation.QDISC, ["tc", "exec", "bpf", "run", "sh"])
+        self.assertRejected(HelperOperation.SYSCTL, ["sysctl", "-w", "kernel.core_pattern=|/tmp/x"])
+        self.assertRejected(HelperOperation.LINK, ["sh", "-c", "id"])
+        self.assertRejected(HelperOperation.LINK, ["ip", "link", "show"], netns="x;id")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set
+
+from utils.logger import Logger
+
+
+@dataclass
+class BringupStep:
+    name: str
+    action: Callable[[], None]
+    requires: List[str] = field(default_factory=list)
+
+
+class BringupGraph:
+    def __init__(self, name: str, max_workers: int = 8):
+        self.name = name
+        self.max_workers = max_workers
+        self.steps: Dict[str, BringupStep] = {}
+
+    def add(self, name: str, action: Callable[[], None],
+            requires: Optional[List[str]] = None) -> None:
+        if name in self.steps:
+            raise Exception(f"Duplicate bring-up step '{name}'")
+
+        self.steps[name] = BringupStep(name, action, list(requires or []))
+
+    def __validate(self) -> None:
+        for step in self.steps.values():
+            for required in step.requires:
+                if required not in self.steps:
+                    raise Exception(f"Bring-up step '{step.name}' requires unknown step '{required}'")
+
+        # Kahn's algorithm, all steps must be reachable without cycles
+        pending = {name: len(step.requires) for name, step in self.steps.items()}
+        queue = [name for name, count in pending.items() if count == 0]
+        visited = 0
+        while queue:
+            name = queue.pop()
+            visited += 1
+            for step in self.steps.values():
+                if name in step.requires:
+                    pending[step.name] -= 1
+                    if pending[step.name] == 0:
+                        queue.append(step.name)
+
+        if visited != len(self.steps):
+            raise Exception(f"Bring-up '{self.name}' contains a dependency cycle")
+
+    def __dependents(self, name: str) -> Set[str]:
+        result = set()
+        queue = [name]
+        while queue:
+            current = queue.pop()
+            for step in self.steps.values():
+                if current in step.requires and step.name not in result:
+                    result.add(step.name)
+                    queue.append(step.name)
+        return result
+
+    def __run_step(self, step: BringupStep) -> float:
+        start = time.monotonic()
+        step.action()
+        return time.monotonic() - start
+
+    def run(self) -> Dict[str, float]:
+        # Runs every step as soon as all required steps finished. A failing step
+        # skips its dependents, independent steps still finish. The first error
+        # is raised after all started steps completed.
+        self.__validate()
+        done: Dict[str, float] = {}
+        failed: Set[str] = set()
+        skipped: Set[str] = set()
+        errors: List[Exception] = []
+        running = {}
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix=f"bringup-{self.name}") as executor:
+            while True:
+                for step in self.steps.values():
+                    if step.name in done or step.name in failed or step.name in skipped \
+                            or step.name in running.values():
+                        continue
+                    if all(required in done for required in step.requires):
+                        running[executor.submit(self.__run_step, step)] = step.name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        done[name] = future.result()
+                        Logger.debug(f"Bring-up step '{name}' finished after {done[name]:.2f} s")
+                    except Exception as ex:
+                        errors.append(Exception(f"Bring-up step '{name}' failed: {ex}"))
+                        failed.add(name)
+                        skipped |= self.__dependents(name)
+
+        for name in sorted(skipped):
+            Logger.warning(f"Bring-up step '{name}' skipped due to failed dependencies")
+
+        Logger.debug(f"Bring-up '{self.name}' finished after {time.monotonic() - start:.2f} s")
+        if errors:
+            raise errors[0]
+
+        return done
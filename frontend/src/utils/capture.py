@@ -0,0 +1,123 @@
+import getpass
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from threading import Lock
+from typing import Dict, List, Optional, TextIO
+
+from utils.logger import Logger
+from utils.utils import start_subprocess
+from models.config import CaptureConfig
+
+
+class PacketCapture:
+    def __init__(self, config: CaptureConfig, interfaces: List[str], dryrun: bool = False):
+        self.config = config
+        self.interfaces = interfaces
+        self.dryrun = dryrun
+        self.processes: Dict[str, subprocess.Popen] = {}
+        self.logs: Dict[str, TextIO] = {} # stderr of tcpdump, would block it once a pipe is full
+        self.positions: Optional[TextIO] = None
+        self.lock = Lock() # mark() is called from the replay thread
+        self.metadata: Dict = {}
+
+    def __command(self, interface: str) -> List[str]:
+        # Header-only snaplen, bounded file ring in tmpfs and lowest CPU priority,
+        # so capturing cannot starve the emulated packet path.
+        command = ["nice", "-n", "19", "tcpdump", "-i", interface, "-n", "-p",
+                   "-s", str(self.config.snaplen),
+                   "-B", str(self.config.buffer_size),
+                   "-C", str(self.config.ring_size),
+                   "-W", str(self.config.ring_files),
+                   "-Z", getpass.getuser(),
+                   "-w", os.path.join(self.config.path, f"{interface}.pcap")]
+        if self.config.filter:
+            command.append(self.config.filter)
+        return command
+
+    def start(self) -> None:
+        if self.processes:
+            self.stop()
+
+        shutil.rmtree(self.config.path, ignore_errors=True)
+        os.makedirs(self.config.path, exist_ok=True)
+
+        self.metadata = {
+            "start": time.time(),
+            "end": None,
+            "interfaces": self.interfaces,
+            "snaplen": self.config.snaplen,
+            "ring_size": self.config.ring_size,
+            "ring_files": self.config.ring_files,
+            "filter": self.config.filter,
+        }
+        positions = open(os.path.join(self.config.path, "positions.csv"), "w", buffering=1)
+        positions.write("wall_time,position_time\n")
+        with self.lock:
+            self.positions = positions
+
+        for interface in self.interfaces:
+            log = open(os.path.join(self.config.path, f"{interface}.log"), "w")
+            try:
+                process = start_subprocess(self.__command(interface), shell=False,
+                                           sudo=True, dryrun=self.dryrun, stderr=log)
+            except Exception as ex:
+                Logger.error(f"Unable to start capture on {interface}: {ex}")
+                log.close()
+                continue
+
+            self.logs[interface] = log
+            if process is not None:
+                self.processes[interface] = process
+
+        Logger.info(f"Header capture started on {', '.join(self.interfaces)} (snaplen {self.config.snaplen})")
+
+    def mark(self, position_time: int) -> None:
+        # Maps the wall clock timestamps of the pcap files to the trace position
+        with self.lock:
+            if self.positions is not None:
+                self.positions.write(f"{time.time():.6f},{position_time}\n")
+
+    def stop(self) -> None:
+        for interface, process in self.processes.items():
+            if process.poll() is not None:
+                with open(self.logs[interface].name, encoding="utf-8", errors="replace") as handle:
+                    error = handle.read().strip()
+                Logger.warning(f"Capture on {interface} exited early: {error}")
+                continue
+
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        self.processes.clear()
+
+        for log in self.logs.values():
+            log.close()
+        self.logs.clear()
+
+        with self.lock:
+            if self.positions is not None:
+                self.positions.close()
+                self.positions = None
+                self.metadata["end"] = time.time()
+
+    def export(self, target: str) -> Optional[str]:
+        if not os.path.isdir(self.config.path):
+            return None
+
+        destination = os.path.join(target, "capture")
+        os.makedirs(destination, exist_ok=True)
+        for file in sorted(os.listdir(self.config.path)):
+            shutil.copy2(os.path.join(self.config.path, file), destination)
+
+        with open(os.path.join(destination, "capture.json"), "w", encoding="utf-8") as handle:
+            json.dump(self.metadata, handle, indent=4)
+
+        Logger.info(f"Capture exported to {destination}")
+        return destination
@@ -0,0 +1,254 @@
+import argparse
+import glob
+import os
+import sys
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from models.config import FullConfig, CpuConfig
+from utils.logger import Logger
+from utils.utils import invoke_subprocess
+from utils.helper import HelperClient
+from constants import RIGHT_INTERFACE, LEFT_INTERFACE
+
+
+@dataclass
+class CpuReport:
+    gui_cpus: List[int]
+    packet_cpus: List[int]
+    threads: int = 0 # Pinned threads of the frontend
+    irqs: Dict[int, str] = field(default_factory=dict) # IRQ -> actions (CPU list, see status())
+    queues: Dict[str, str] = field(default_factory=dict) # RPS/XPS mask file -> mask
+    fifo: Dict[int, str] = field(default_factory=dict) # PID -> name (policy, see status())
+    errors: List[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        text = (f"GUI on CPU {format_cpus(self.gui_cpus)}, packet path on CPU {format_cpus(self.packet_cpus)}: "
+                f"{self.threads} threads pinned, {len(self.irqs)} IRQs and {len(self.queues)} queues steered, "
+                f"{len(self.fifo)} threads SCHED_FIFO")
+        if self.errors:
+            text += f", {len(self.errors)} errors"
+        return text
+
+    def details(self) -> str:
+        lines = [str(self)]
+        lines += [f"  IRQ {irq}: {actions}" for irq, actions in sorted(self.irqs.items())]
+        lines += [f"  {path}: {mask}" for path, mask in sorted(self.queues.items())]
+        lines += [f"  PID {pid}: {name}" for pid, name in sorted(self.fifo.items())]
+        lines += [f"  Error: {error}" for error in self.errors]
+        return "\n".join(lines)
+
+
+def format_cpus(cpus: List[int]) -> str:
+    return ",".join(str(cpu) for cpu in sorted(cpus)) if cpus else "-"
+
+
+def cpu_mask(cpus: List[int]) -> str:
+    # Hex bitmap as used by rps_cpus and xps_cpus
+    return f"{sum(1 << cpu for cpu in cpus):x}"
+
+
+class CpuIsolation:
+    # Keeps the GUI (Tk, matplotlib, video decoding, subprocesses) away from the
+    # CPUs that handle the NIC interrupts and the softirq work of the emulated
+    # path. Threads and child processes inherit the affinity, so pinning the
+    # process once at startup covers everything started later.
+    #
+    # Interrupts, RPS and XPS of the emulated interfaces are steered to the packet
+    # CPUs. With fifo, ksoftirqd, IRQ and NAPI threads of the packet path run with
+    # SCHED_FIFO, so a runaway GUI can not delay them even on a shared CPU.
+    # Previous settings are kept for restore().
+    def __init__(self, config: CpuConfig, interfaces: List[str], dryrun: bool = False):
+        self.config = config
+        self.interfaces = interfaces
+        self.dryrun = dryrun
+
+        online = sorted(os.sched_getaffinity(0))
+        self.gui_cpus = [cpu for cpu in config.gui_cpus if cpu in online]
+        if config.packet_cpus is not None:
+            self.packet_cpus = [cpu for cpu in config.packet_cpus if cpu in online]
+        else:
+            self.packet_cpus = [cpu for cpu in online if cpu not in self.gui_cpus]
+
+        self.previous_affinity: Dict[int, set] = {}
+        self.previous_files: Dict[str, str] = {}
+        self.previous_policy: Dict[int, Tuple[int, int]] = {}
+
+    @staticmethod
+    def __read(path: str) -> Optional[str]:
+        try:
+            with open(path, "r") as handle:
+                return handle.read().strip()
+        except OSError:
+            return None
+
+    def __write(self, path: str, value: str, report: CpuReport) -> bool:
+        previous = CpuIsolation.__read(path)
+        if previous is None:
+            report.errors.append(f"{path} not readable")
+            return False
+
+        if not self.dryrun and os.geteuid() != 0 and HelperClient.available():
+            process = HelperClient.write(path, value)
+        else:
+            process = invoke_subprocess(["sh", "-c", f"echo {value} > {path}"], shell=False, sudo=True,
+                                        dryrun=self.dryrun, log_debug=True)
+        if process.returncode != 0:
+            # e.g., kernel managed MSI-X interrupts can not be moved
+            report.errors.append(f"{path}: {process.stderr.decode('utf-8').strip()}")
+            return False
+
+        self.previous_files.setdefault(path, previous)
+        return True
+
+    def irqs(self) -> Dict[int, str]:
+        # /proc/interrupts: "IRQ: <count per CPU> <chip> <hwirq> <type> <actions>"
+        patterns = self.interfaces + self.config.irqs
+        irqs = {}
+        with open("/proc/interrupts", "r") as handle:
+            for line in handle.readlines()[1:]:
+                irq, _, rest = line.partition(":")
+                if not irq.strip().isdigit():
+                    continue
+                actions = rest.split()[-1] if rest.split() else ""
+                if any(pattern in name for name in actions.split(",") for pattern in patterns):
+                    irqs[int(irq)] = actions
+        return irqs
+
+    def queues(self) -> List[str]:
+        paths = []
+        for interface in self.interfaces:
+            paths += sorted(glob.glob(f"/sys/class/net/{interface}/queues/rx-*/rps_cpus"))
+            paths += sorted(glob.glob(f"/sys/class/net/{interface}/queues/tx-*/xps_cpus"))
+        # XPS is not available for single queue devices, the file is not readable then
+        return [path for path in paths if CpuIsolation.__read(path) is not None]
+
+    def packet_threads(self, irqs: List[int]) -> Dict[int, str]:
+        # Kernel threads doing the packet work on the packet CPUs
+        names = [f"ksoftirqd/{cpu}" for cpu in self.packet_cpus]
+        prefixes = [f"irq/{irq}-" for irq in irqs] + [f"napi/{interface}-" for interface in self.interfaces]
+        threads = {}
+        for comm in glob.glob("/proc/[0-9]*/comm"):
+            name = CpuIsolation.__read(comm)
+            if name is not None and (name in names or any(name.startswith(prefix) for prefix in prefixes)):
+                threads[int(comm.split("/")[2])] = name
+        return threads
+
+    def pin(self, pid: int = 0) -> int:
+        # Affinity is per thread, so all existing threads of the process are pinned
+        if len(self.gui_cpus) == 0:
+            return 0
+
+        pid = pid or os.getpid()
+        count = 0
+        for task in os.listdir(f"/proc/{pid}/task"):
+            try:
+                self.previous_affinity.setdefault(int(task), os.sched_getaffinity(int(task)))
+                os.sched_setaffinity(int(task), self.gui_cpus)
+                count += 1
+            except OSError:
+                pass # Thread exited in between
+        return count
+
+    def apply(self, pin_process: bool = True) -> CpuReport:
+        report = CpuReport(gui_cpus=self.gui_cpus, packet_cpus=self.packet_cpus)
+        if len(self.gui_cpus) == 0 or len(self.packet_cpus) == 0:
+            report.errors.append("GUI and packet path need at least one CPU each")
+            return report
+
+        if pin_process:
+            report.threads = self.pin()
+
+        for irq, actions in self.irqs().items():
+            if self.__write(f"/proc/irq/{irq}/smp_affinity_list", format_cpus(self.packet_cpus), report):
+                report.irqs[irq] = actions
+
+        mask = cpu_mask(self.packet_cpus)
+        for path in self.queues():
+            if self.__write(path, mask, report):
+                report.queues[path] = mask
+
+        if self.config.fifo:
+            for pid, name in self.packet_threads(list(report.irqs.keys())).items():
+                try:
+                    self.previous_policy.setdefault(pid, (os.sched_getscheduler(pid),
+                                                          os.sched_getparam(pid).sched_priority))
+                except OSError:
+                    continue
+                process = invoke_subprocess(f"chrt -f -p {self.config.fifo_priority} {pid}", sudo=True,
+                                            dryrun=self.dryrun, log_debug=True)
+                if process.returncode != 0:
+                    report.errors.append(f"SCHED_FIFO for {name}: {process.stderr.decode('utf-8').strip()}")
+                    continue
+                report.fifo[pid] = name
+
+        return report
+
+    def restore(self) -> None:
+        for task, cpus in self.previous_affinity.items():
+            try:
+                os.sched_setaffinity(task, cpus)
+            except OSError:
+                pass
+        self.previous_affinity.clear()
+
+        report = CpuReport(gui_cpus=self.gui_cpus, packet_cpus=self.packet_cpus)
+        for path, value in self.previous_files.items():
+            self.__write(path, value, report)
+        self.previous_files.clear()
+
+        flags = {os.SCHED_FIFO: "-f", os.SCHED_RR: "-r", os.SCHED_BATCH: "-b", os.SCHED_IDLE: "-i"}
+        for pid, (policy, priority) in self.previous_policy.items():
+            invoke_subprocess(f"chrt {flags.get(policy, '-o')} -p {priority} {pid}", sudo=True,
+                              dryrun=self.dryrun, log_debug=True)
+        self.previous_policy.clear()
+
+        for error in report.errors:
+            Logger.warning(f"Unable to restore CPU setting: {error}")
+
+    def status(self) -> CpuReport:
+        # Current kernel state of everything apply() touches
+        report = CpuReport(gui_cpus=self.gui_cpus, packet_cpus=self.packet_cpus)
+        for irq, actions in self.irqs().items():
+            report.irqs[irq] = f"{actions} on CPU {CpuIsolation.__read(f'/proc/irq/{irq}/smp_affinity_list')}"
+        for path in self.queues():
+            report.queues[path] = CpuIsolation.__read(path) or "?"
+
+        policies = {os.SCHED_FIFO: "FIFO", os.SCHED_RR: "RR", os.SCHED_OTHER: "OTHER",
+                    os.SCHED_BATCH: "BATCH", os.SCHED_IDLE: "IDLE"}
+        for pid, name in self.packet_threads(list(report.irqs.keys())).items():
+            try:
+                policy = policies.get(os.sched_getscheduler(pid), "?")
+                report.fifo[pid] = f"{name} {policy} {os.sched_getparam(pid).sched_priority}"
+            except OSError:
+                pass
+        return report
+
+    @staticmethod
+    def interfaces_from_config(config: FullConfig) -> List[str]:
+        interfaces = [RIGHT_INTERFACE, LEFT_INTERFACE]
+        for link in config.links:
+            interfaces += [link.forward_interface, link.return_interface]
+        return list(dict.fromkeys(interfaces))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Emulation Demonstrator CPU Isolation")
+    parser.add_argument("--apply", "-a", action="store_true", help="Steer interrupts and queues as configured")
+    parser.add_argument("--fifo", "-f", action="store_true", help="Use SCHED_FIFO for the packet path")
+    parser.add_argument("CONFIG", type=str, help="Path to config.json")
+    args = parser.parse_args()
+
+    config = FullConfig.from_json_file(args.CONFIG)
+    cpu = config.cpu or CpuConfig()
+    if args.fifo:
+        cpu.fifo = True
+
+    isolation = CpuIsolation(cpu, CpuIsolation.interfaces_from_config(config))
+    if args.apply:
+        report = isolation.apply(pin_process=False)
+        print(report.details())
+        sys.exit(1 if report.errors else 0)
+
+    print(isolation.status().details())
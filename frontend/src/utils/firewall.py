@@ -0,0 +1,169 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from models.config import FullConfig
+from utils.logger import Logger
+from utils.utils import run_fail_on_error, run_log_on_error
+from constants import NFT_TABLE, PUBLIC_NETNS_NAME, NETNS_RIGHT_BRIDGE_NAME
+
+
+class Firewall:
+    # NAT and marking of the extended mode as dedicated nftables tables, one in the
+    # default namespace and one in the public namespace. Both are rendered from
+    # the config and replaced atomically, interfaces are matched by name, so the
+    # tables can be applied before the interfaces exist.
+    #
+    # Unmarked traffic from the left VLAN to the public IP is DNATed directly to
+    # the right endpoint (passthrough and emulator), real paths mark all traffic
+    # so it is routed via their uplink table instead. The active mode is the single
+    # element of the 'mode' map, a switch replaces it in one nft transaction.
+    def __init__(self, config: FullConfig, dryrun: bool = False):
+        self.config = config
+        self.dryrun = dryrun
+        self.left_interface = config.extended.get_left_interface_name()
+        self.active: Optional[int] = None # fwmark, None for direct forwarding
+        self.applied = False
+        self.lock = Lock()
+
+    def render(self) -> str:
+        public_ip = self.config.extended.public_interface.get_public_ip()
+        uplinks = []
+        if self.config.extended.configs:
+            names = ", ".join(f"\"{entry.get_interface_name()}\"" for entry in self.config.extended.configs)
+            uplinks.append(f"        elements = {{ {names} }}")
+
+        elements = []
+        if self.active is not None:
+            elements.append(f"        elements = {{ \"{self.left_interface}\" : {self.active} }}")
+
+        return "\n".join([
+            f"table ip {NFT_TABLE} {{",
+            f"    set uplinks {{",
+            f"        type ifname",
+        ] + uplinks + [
+            f"    }}",
+            f"    map mode {{",
+            f"        type ifname : mark",
+        ] + elements + [
+            f"    }}",
+            f"    chain prerouting-mark {{",
+            f"        type filter hook prerouting priority mangle; policy accept;",
+            f"        meta mark set iifname map @mode",
+            f"    }}",
+            f"    chain prerouting-nat {{",
+            f"        type nat hook prerouting priority dstnat; policy accept;",
+            f"        iifname \"{self.left_interface}\" meta mark 0 ip daddr {public_ip} dnat to {self.config.general.right_endpoint_ip}",
+            f"    }}",
+            f"    chain postrouting-nat {{",
+            f"        type nat hook postrouting priority srcnat; policy accept;",
+            f"        oifname \"{NETNS_RIGHT_BRIDGE_NAME}\" masquerade",
+            f"        oifname @uplinks masquerade",
+            f"    }}",
+            f"}}",
+            ""
+        ])
+
+    def render_public(self) -> str:
+        public_interface = self.config.extended.public_interface.get_public_interface_name()
+        return "\n".join([
+            f"table ip {NFT_TABLE} {{",
+            f"    chain prerouting-nat {{",
+            f"        type nat hook prerouting priority dstnat; policy accept;",
+            f"        iifname \"{public_interface}\" meta l4proto {{ tcp, udp }} dnat to {self.config.general.right_endpoint_ip}",
+            f"    }}",
+            f"    chain postrouting-nat {{",
+            f"        type nat hook postrouting priority srcnat; policy accept;",
+            f"        oifname \"veth-public\" masquerade",
+            f"    }}",
+            f"}}",
+            ""
+        ])
+
+    def __load(self, ruleset: str, netns: Optional[str] = None) -> None:
+        # Adding and deleting the table first replaces a stale one in the same transaction
+        ruleset = f"table ip {NFT_TABLE}\ndelete table ip {NFT_TABLE}\n" + ruleset
+        prefix = f"ip netns exec {netns} " if netns is not None else ""
+        Logger.debug(f"nftables ruleset{f' in {netns}' if netns else ''}:\n{ruleset}")
+        run_fail_on_error(f"{prefix}nft -f -", sudo=True, dryrun=self.dryrun, input=ruleset.encode("utf-8"))
+
+    def apply(self) -> None:
+        with self.lock:
+            self.__load(self.render())
+            self.applied = True
+
+    def apply_public(self) -> None:
+        self.__load(self.render_public(), netns=PUBLIC_NETNS_NAME)
+
+    def select(self, fwmark: Optional[int]) -> None:
+        with self.lock:
+            if fwmark == self.active:
+                return
+
+            # Rendered by apply() if selected during startup
+            if not self.applied:
+                self.active = fwmark
+                return
+
+            start = time.monotonic()
+            command = f"flush map ip {NFT_TABLE} mode"
+            if fwmark is not None:
+                command += f"; add element ip {NFT_TABLE} mode {{ \"{self.left_interface}\" : {fwmark} }}"
+            run_fail_on_error(["nft", command], shell=False, sudo=True, dryrun=self.dryrun, log_debug=True)
+            self.active = fwmark
+
+            # Only flows of the left endpoint are forwarded differently now, all others
+            # (management, probes, uplink DHCP) keep their conntrack entries
+            run_log_on_error(f"conntrack -D -s {self.config.general.left_endpoint_ip}",
+                             sudo=True,
+                             dryrun=self.dryrun,
+                             log_debug=True)
+            Logger.debug(f"Forwarding mode switched after {1000 * (time.monotonic() - start):.1f} ms")
+
+    def remove(self) -> None:
+        # The public table is removed together with its namespace
+        run_log_on_error(f"nft delete table ip {NFT_TABLE}",
+                         sudo=True,
+                         dryrun=self.dryrun,
+                         log_debug=True)
+        self.applied = False
+
+    @staticmethod
+    def ruleset(netns: Optional[str] = None) -> List[Dict[str, Any]]:
+        # Current table as the 'nftables' objects of the libnftables JSON schema
+        command = ["nft", "-j", "list", "table", "ip", NFT_TABLE]
+        if netns is not None:
+            command = ["ip", "netns", "exec", netns] + command
+
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"Unable to list table {NFT_TABLE}: {result.stderr.strip()}")
+        return json.loads(result.stdout)["nftables"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Emulation Demonstrator Firewall")
+    parser.add_argument("--render", "-r", action="store_true", help="Print the rendered rulesets instead of the installed ones")
+    parser.add_argument("--public", "-p", action="store_true", help="Use the table of the public namespace")
+    parser.add_argument("--mark", "-m", type=int, default=None, help="Render with this real path fwmark active")
+    parser.add_argument("CONFIG", type=str, help="Path to config.json")
+    args = parser.parse_args()
+
+    firewall = Firewall(FullConfig.from_json_file(args.CONFIG))
+    if args.render:
+        firewall.active = args.mark
+        print(firewall.render_public() if args.public else firewall.render(), end="")
+        sys.exit(0)
+
+    try:
+        objects = Firewall.ruleset(PUBLIC_NETNS_NAME if args.public else None)
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        sys.exit(1)
+
+    print(json.dumps(objects, indent=2))
@@ -0,0 +1,130 @@
+import socket
+import struct
+
+from threading import Condition, Event, Thread
+from typing import Dict, Optional
+
+from utils.logger import Logger
+
+
+NLMSG_HEADER = struct.Struct("=LHHLL")  # length, type, flags, seq, pid
+RTMSG_HEADER = struct.Struct("=BBBBBBBBI")  # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+RTATTR_HEADER = struct.Struct("=HH")  # length, type
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTMGRP_IPV4_ROUTE = 0x40
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+
+
+class GatewayMonitor:
+    # Tracks the IPv4 default gateways of the main routing table per interface
+    # using rtnetlink route notifications instead of polling 'ip route'.
+    def __init__(self):
+        self.gateways: Dict[str, str] = {}
+        self.condition = Condition()
+        self.stop_event = Event()
+        self.sock = None
+        self.thread = None
+
+    def start(self) -> None:
+        # Subscribe before dumping, routes added in between are not missed
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_IPV4_ROUTE))
+        self.sock.settimeout(0.5)
+
+        request = RTMSG_HEADER.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+        header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), RTM_GETROUTE,
+                                   NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        self.sock.send(header + request)
+
+        self.thread = Thread(target=self.__receive_thread_fn, name="gateway-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def get(self, interface: str) -> Optional[str]:
+        with self.condition:
+            return self.gateways.get(interface)
+
+    def wait(self, interface: str, timeout: float) -> Optional[str]:
+        with self.condition:
+            self.condition.wait_for(lambda: interface in self.gateways, timeout=timeout)
+            return self.gateways.get(interface)
+
+    def __receive_thread_fn(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError as ex:
+                Logger.error(f"Gateway monitor stopped: {ex}")
+                return
+
+            self.__parse(data)
+
+    def __parse(self, data: bytes) -> None:
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if length < NLMSG_HEADER.size:
+                return
+
+            if msg_type in [RTM_NEWROUTE, RTM_DELROUTE]:
+                self.__parse_route(msg_type, data[offset + NLMSG_HEADER.size:offset + length])
+
+            offset += (length + 3) & ~3
+
+    def __parse_route(self, msg_type: int, payload: bytes) -> None:
+        family, dst_len, _, _, table, _, _, _, _ = RTMSG_HEADER.unpack_from(payload)
+        if family != socket.AF_INET or dst_len != 0:
+            return
+
+        interface, gateway = None, None
+        offset = RTMSG_HEADER.size
+        while offset + RTATTR_HEADER.size <= len(payload):
+            length, attr_type = RTATTR_HEADER.unpack_from(payload, offset)
+            if length < RTATTR_HEADER.size:
+                break
+
+            value = payload[offset + RTATTR_HEADER.size:offset + length]
+            if attr_type == RTA_OIF:
+                try:
+                    interface = socket.if_indextoname(struct.unpack("=I", value)[0])
+                except OSError:
+                    interface = None
+            elif attr_type == RTA_GATEWAY:
+                gateway = socket.inet_ntoa(value)
+            elif attr_type == RTA_TABLE:
+                table = struct.unpack("=I", value)[0]
+
+            offset += (length + 3) & ~3
+
+        if interface is None or gateway is None or table != RT_TABLE_MAIN:
+            return
+
+        with self.condition:
+            if msg_type == RTM_NEWROUTE:
+                if self.gateways.get(interface) != gateway:
+                    Logger.debug(f"Default gateway of {interface}: {gateway}")
+                self.gateways[interface] = gateway
+                self.condition.notify_all()
+            elif self.gateways.get(interface) == gateway:
+                del self.gateways[interface]
@@ -4,7 +4,9 @@ import os
 from typing import Dict, Tuple, List
 
 from utils.logger import Logger
+from constants import SESSION_FALLBACK_PATH
 from models.scenario import ScenarioConfig
+from models.trace import TraceTransform
 
 
 class GenericDataProvider:
@@ -39,6 +41,9 @@ class GenericDataProvider:
     def get_base_path(self):
         return self.sample_path
 
+    def get_session_path(self) -> str:
+        return SESSION_FALLBACK_PATH
+
     def load_scenario_config(self, name: str) -> ScenarioConfig:
         basepath = self.get_base_path()
         filename = os.path.join(basepath, self.scenarios[name][0])
@@ -52,5 +57,6 @@ class GenericDataProvider:
                                 trace_format=data["trace"]["format"],
                                 forward_file=data["trace"]["forward"],
                                 return_file=data["trace"]["return"],
-                                video=data["video"])
+                                video=data["video"],
+                                transform=TraceTransform.from_dict(data.get("transform", None)))
         return config
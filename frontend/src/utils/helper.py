@@ -0,0 +1,435 @@
+import argparse
+import base64
+import fnmatch
+import grp
+import json
+import os
+import re
+import select
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import List, Optional, Tuple
+
+from models.trace import Trace
+from utils.logger import Logger
+from utils.trace_buffer import TraceBuffer
+from constants import HELPER_SOCKET_PATH, HELPER_COMMAND_TIMEOUT, TRACE_BUFFER_PATH
+
+
+class HelperOperation(Enum):
+    QDISC = "QDISC"             # tc
+    LINK = "LINK"               # ip link, brctl
+    ADDRESS = "ADDRESS"         # ip address
+    ROUTE = "ROUTE"             # ip route
+    RULE = "RULE"               # ip rule
+    NETNS = "NETNS"             # ip netns (add, del, list)
+    NETFILTER = "NETFILTER"     # nft, conntrack
+    SYSCTL = "SYSCTL"           # sysctl
+    SCHEDULER = "SCHEDULER"     # chrt
+    WRITE = "WRITE"             # procfs/sysfs value, see HelperServer.WRITABLE
+    TRACE_UPLOAD = "TRACE_UPLOAD"
+
+    @staticmethod
+    def from_str(string: str):
+        try: return HelperOperation(string)
+        except Exception:
+            raise Exception(f"Unknown HelperOperation '{string}'")
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+    @staticmethod
+    def classify(argv: List[str]) -> "HelperOperation":
+        # Only bare program names, the helper resolves them with its own PATH
+        if len(argv) == 0:
+            raise ValueError("Empty command")
+
+        program = argv[0]
+        if program == "tc":
+            # Not 'tc exec', it runs other programs
+            objects = [arg for arg in argv[1:] if not arg.startswith("-")]
+            if len(objects) == 0 or objects[0] not in ["qdisc", "class", "filter"]:
+                raise ValueError(f"Unsupported tc command '{' '.join(argv)}'")
+            return HelperOperation.QDISC
+        if program == "brctl":
+            return HelperOperation.LINK
+        if program in ["nft", "conntrack"]:
+            return HelperOperation.NETFILTER
+        if program == "sysctl":
+            return HelperOperation.SYSCTL
+        if program == "chrt":
+            return HelperOperation.SCHEDULER
+        if program != "ip":
+            raise ValueError(f"Command '{program}' is not supported by the helper")
+
+        objects = {"link": HelperOperation.LINK, "address": HelperOperation.ADDRESS,
+                   "addr": HelperOperation.ADDRESS, "a": HelperOperation.ADDRESS,
+                   "route": HelperOperation.ROUTE, "r": HelperOperation.ROUTE,
+                   "rule": HelperOperation.RULE, "netns": HelperOperation.NETNS}
+        index = 1
+        while index < len(argv) and argv[index].startswith("-"):
+            # Options with a value, e.g., 'ip -n <netns> -j link show'
+            index += 2 if argv[index] in ["-n", "-netns", "-f", "-family", "-rc", "-rcvbuf"] else 1
+        if index >= len(argv) or argv[index] not in objects:
+            raise ValueError(f"Unsupported ip command '{' '.join(argv)}'")
+        if argv[index] == "netns" and argv[index + 1:index + 2] not in [[], ["add"], ["del"], ["delete"], ["list"]]:
+            # Commands in a namespace are requested with HelperRequest.netns, never 'ip netns exec'
+            raise ValueError(f"Unsupported ip netns command '{' '.join(argv)}'")
+        return objects[argv[index]]
+
+
+@dataclass
+class HelperRequest:
+    operation: HelperOperation
+    argv: List[str] = field(default_factory=list)
+    netns: Optional[str] = None # Runs argv in the namespace ('ip netns exec')
+    input: Optional[bytes] = None # stdin of argv, e.g., a ruleset for 'nft -f -'
+    path: Optional[str] = None # WRITE target or TheaterQ device
+    value: Optional[str] = None # WRITE value
+    buffer: Optional[str] = None # TRACE_UPLOAD: TraceBuffer file
+    direction: Optional[str] = None # TRACE_UPLOAD: 'forward' or 'reverse' trace of the buffer
+
+    def to_json(self) -> bytes:
+        data = {"operation": str(self.operation), "argv": self.argv, "netns": self.netns,
+                "input": base64.b64encode(self.input).decode("ascii") if self.input is not None else None,
+                "path": self.path, "value": self.value, "buffer": self.buffer, "direction": self.direction}
+        return json.dumps(data).encode("utf-8") + b"\n"
+
+    @staticmethod
+    def from_json(line: bytes) -> "HelperRequest":
+        data = json.loads(line)
+        return HelperRequest(operation=HelperOperation.from_str(data["operation"]),
+                             argv=[str(arg) for arg in data.get("argv") or []],
+                             netns=data.get("netns"),
+                             input=base64.b64decode(data["input"]) if data.get("input") is not None else None,
+                             path=data.get("path"),
+                             value=data.get("value"),
+                             buffer=data.get("buffer"),
+                             direction=data.get("direction"))
+
+    @staticmethod
+    def from_command(command: List[str] | str, input: Optional[bytes] = None) -> "HelperRequest":
+        argv = shlex.split(command) if isinstance(command, str) else list(command)
+        netns = None
+        if argv[:3] == ["ip", "netns", "exec"] and len(argv) > 4:
+            netns, argv = argv[3], argv[4:]
+        return HelperRequest(HelperOperation.classify(argv), argv, netns=netns, input=input)
+
+
+@dataclass
+class HelperResponse:
+    returncode: int
+    stdout: bytes = b""
+    stderr: bytes = b""
+
+    def to_json(self) -> bytes:
+        data = {"returncode": self.returncode,
+                "stdout": base64.b64encode(self.stdout).decode("ascii"),
+                "stderr": base64.b64encode(self.stderr).decode("ascii")}
+        return json.dumps(data).encode("utf-8") + b"\n"
+
+    @staticmethod
+    def from_json(line: bytes) -> "HelperResponse":
+        data = json.loads(line)
+        return HelperResponse(int(data["returncode"]), base64.b64decode(data["stdout"]),
+                              base64.b64decode(data["stderr"]))
+
+    @staticmethod
+    def error(message: str) -> "HelperResponse":
+        return HelperResponse(1, stderr=message.encode("utf-8"))
+
+
+def write_trace(device: str, trace: Trace) -> None:
+    # Formatted in chunks from the shared buffer, one entry per write
+    with open(device, "w") as handle:
+        for chunk in trace.format_chunks(rows=4096):
+            for entry in chunk.splitlines(keepends=True):
+                handle.write(entry)
+                handle.flush()
+
+
+class HelperClient:
+    # Sends privileged operations to the HelperServer instead of running them
+    # with sudo. Every thread keeps its own connection, so concurrent bring-up
+    # steps are executed concurrently by the helper as well. A connection closed
+    # by a restarted helper is detected before a request is sent and replaced.
+    __local = threading.local()
+
+    @staticmethod
+    def available(path: str = HELPER_SOCKET_PATH) -> bool:
+        return os.path.exists(path)
+
+    @staticmethod
+    def __connection(path: str) -> Tuple[socket.socket, object]:
+        connection = getattr(HelperClient.__local, "connection", None)
+        if connection is not None:
+            # Readable while idle means closed by the helper
+            readable, _, _ = select.select([connection[0]], [], [], 0)
+            if not readable:
+                return connection
+            HelperClient.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        connection = (sock, sock.makefile("rwb"))
+        HelperClient.__local.connection = connection
+        return connection
+
+    @staticmethod
+    def close() -> None:
+        connection = getattr(HelperClient.__local, "connection", None)
+        HelperClient.__local.connection = None
+        if connection is not None:
+            try:
+                connection[1].close()
+                connection[0].close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def call(request: HelperRequest, path: str = HELPER_SOCKET_PATH) -> HelperResponse:
+        _, stream = HelperClient.__connection(path)
+        try:
+            stream.write(request.to_json())
+            stream.flush()
+            line = stream.readline()
+        except OSError:
+            HelperClient.close()
+            raise
+
+        if not line:
+            HelperClient.close()
+            raise ConnectionError("Helper closed the connection")
+        return HelperResponse.from_json(line)
+
+    @staticmethod
+    def run(command: List[str] | str, input: Optional[bytes] = None,
+            path: str = HELPER_SOCKET_PATH) -> subprocess.CompletedProcess:
+        try:
+            request = HelperRequest.from_command(command, input=input)
+        except ValueError as ex:
+            response = HelperResponse.error(str(ex))
+        else:
+            response = HelperClient.call(request, path)
+        return subprocess.CompletedProcess(command, response.returncode, response.stdout, response.stderr)
+
+    @staticmethod
+    def write(target: str, value: str, path: str = HELPER_SOCKET_PATH) -> subprocess.CompletedProcess:
+        response = HelperClient.call(HelperRequest(HelperOperation.WRITE, path=target, value=value), path)
+        return subprocess.CompletedProcess(["write", target, value], response.returncode,
+                                           response.stdout, response.stderr)
+
+    @staticmethod
+    def upload(device: str, buffer: str, direction: str, path: str = HELPER_SOCKET_PATH) -> None:
+        response = HelperClient.call(HelperRequest(HelperOperation.TRACE_UPLOAD, path=device,
+                                                   buffer=buffer, direction=direction), path)
+        if response.returncode != 0:
+            raise Exception(f"Helper unable to upload trace: {response.stderr.decode('utf-8').strip()}")
+
+
+class HelperServer:
+    # Privileged side, started once as root by emulator-helper.service. The
+    # frontend runs unprivileged and sends typed requests over a Unix socket that
+    # only root and the frontend group can connect to. Commands are executed
+    # from an argument vector without a shell, only for the programs known to
+    # HelperOperation.classify() and without options that read files or run other
+    # programs ('ip netns exec', 'tc exec', chrt and sysctl only in fixed forms). Plain
+    # values can only be written to the files steered by CpuIsolation, traces
+    # only be uploaded from TraceBuffer files to TheaterQ devices.
+    WRITABLE = ["/proc/irq/*/smp_affinity_list",
+                "/sys/class/net/*/queues/rx-*/rps_cpus",
+                "/sys/class/net/*/queues/tx-*/xps_cpus"]
+    DEVICES = ["/dev/theaterq:*"]
+    # Global options of ip and tc before the object, everything else is rejected.
+    # iproute2 accepts any prefix of an option (e.g., '-ba' for '-batch').
+    OPTIONS = {"ip": ["-j", "-json", "-s", "-stats", "-d", "-details", "-br", "-brief",
+                      "-p", "-pretty", "-4", "-6"],
+               "tc": ["-j", "-json", "-s", "-stats", "-d", "-details", "-p", "-pretty"]}
+    VALUE_OPTIONS = ["-n", "-netns"]
+    # nft and conntrack accept abbreviated long options anywhere (e.g., '--fi' for
+    # '--file'), only these arguments may start with '-'
+    DASHED_ARGUMENTS = {"nft": ["-j", "-f", "-"], "conntrack": ["-D", "-L", "-s", "-d"]}
+    # Exact forms, chrt and sysctl would otherwise run programs as root (trailing
+    # command, kernel.core_pattern)
+    SCHEDULER_FORM = ["chrt", r"-[fobir]", "-p", r"[0-9]+", r"[0-9]+"]
+    SYSCTL_FORM = ["sysctl", "-w", r"net\.[A-Za-z0-9_.-]+=[A-Za-z0-9_.:-]*"]
+    NETNS_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+    def __init__(self, path: str = HELPER_SOCKET_PATH, group: Optional[str] = "emulator",
+                 timeout: float = HELPER_COMMAND_TIMEOUT):
+        self.path = path
+        self.group = group
+        self.timeout = timeout
+
+    @staticmethod
+    def __matches(argv: List[str], form: List[str]) -> bool:
+        return len(argv) == len(form) and all(re.fullmatch(pattern, arg) for pattern, arg in zip(form, argv))
+
+    def __validate(self, request: HelperRequest) -> None:
+        if request.operation == HelperOperation.WRITE:
+            if request.path is None or request.value is None:
+                raise ValueError("WRITE needs a path and a value")
+            if ".." in request.path.split("/"):
+                raise ValueError(f"Path {request.path} is not allowed")
+            if not any(fnmatch.fnmatch(request.path, pattern) for pattern in HelperServer.WRITABLE):
+                raise ValueError(f"Writing {request.path} is not allowed")
+            if not re.match(r"^[0-9a-fA-F,-]+$", request.value):
+                raise ValueError(f"Invalid value '{request.value}'")
+            return
+
+        if request.operation == HelperOperation.TRACE_UPLOAD:
+            if request.path is None or not any(fnmatch.fnmatch(request.path, pattern)
+                                               for pattern in HelperServer.DEVICES):
+                raise ValueError(f"Uploading to {request.path} is not allowed")
+            if request.buffer is None or \
+                    os.path.dirname(os.path.realpath(request.buffer)) != os.path.realpath(TRACE_BUFFER_PATH):
+                raise ValueError(f"Trace buffer {request.buffer} is not in {TRACE_BUFFER_PATH}")
+            if request.direction not in ["forward", "reverse"]:
+                raise ValueError(f"Invalid direction '{request.direction}'")
+            return
+
+        if HelperOperation.classify(request.argv) != request.operation:
+            raise ValueError(f"Command does not match operation {request.operation}")
+        if request.argv[0] in HelperServer.OPTIONS:
+            index = 1
+            while index < len(request.argv) and request.argv[index].startswith("-"):
+                option = request.argv[index]
+                if option in HelperServer.VALUE_OPTIONS:
+                    index += 2
+                elif option in HelperServer.OPTIONS[request.argv[0]]:
+                    index += 1
+                else:
+                    raise ValueError(f"Option {option} not allowed: {' '.join(request.argv)}")
+        if request.argv[0] in HelperServer.DASHED_ARGUMENTS:
+            allowed = HelperServer.DASHED_ARGUMENTS[request.argv[0]]
+            if any(arg.startswith("-") and arg not in allowed for arg in request.argv[1:]):
+                raise ValueError(f"Option not allowed: {' '.join(request.argv)}")
+        if request.input is not None and request.argv != ["nft", "-f", "-"]:
+            raise ValueError("Only 'nft -f -' reads from stdin")
+        if request.operation == HelperOperation.SCHEDULER and \
+                not HelperServer.__matches(request.argv, HelperServer.SCHEDULER_FORM):
+            raise ValueError("Only 'chrt -<policy> -p <priority> <pid>' is allowed")
+        if request.operation == HelperOperation.SYSCTL and \
+                not HelperServer.__matches(request.argv, HelperServer.SYSCTL_FORM):
+            raise ValueError("Only 'sysctl -w net.<key>=<value>' is allowed")
+        if request.argv[0] == "nft" and "-f" in request.argv and request.argv != ["nft", "-f", "-"]:
+            raise ValueError("nft rulesets are only read from stdin")
+        if request.netns is not None and not HelperServer.NETNS_PATTERN.match(request.netns):
+            raise ValueError(f"Invalid namespace '{request.netns}'")
+
+    def execute(self, request: HelperRequest) -> HelperResponse:
+        try:
+            self.__validate(request)
+        except ValueError as ex:
+            Logger.warning(f"Rejected {request.operation} request: {ex}")
+            return HelperResponse.error(f"Rejected by helper: {ex}")
+
+        if request.operation == HelperOperation.WRITE:
+            try:
+                with open(request.path, "w") as handle:
+                    handle.write(f"{request.value}\n")
+                return HelperResponse(0)
+            except OSError as ex:
+                return HelperResponse.error(str(ex))
+
+        if request.operation == HelperOperation.TRACE_UPLOAD:
+            try:
+                # Maps the same file as the frontend, nothing is copied through the socket
+                buffer = TraceBuffer.open(request.buffer)
+                write_trace(request.path, getattr(buffer, request.direction))
+                return HelperResponse(0)
+            except Exception as ex:
+                return HelperResponse.error(str(ex))
+
+        argv = request.argv
+        if request.netns is not None:
+            argv = ["ip", "netns", "exec", request.netns] + argv
+        try:
+            process = subprocess.run(argv, input=request.input, capture_output=True, timeout=self.timeout)
+            return HelperResponse(process.returncode, process.stdout, process.stderr)
+        except subprocess.TimeoutExpired:
+            return HelperResponse.error(f"Timeout after {self.timeout} s")
+        except OSError as ex:
+            return HelperResponse.error(str(ex))
+
+    def __handle(self, connection: socket.socket) -> None:
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+        pid, uid, _ = (int.from_bytes(credentials[i:i + 4], sys.byteorder) for i in range(0, 12, 4))
+        Logger.debug(f"Connection from PID {pid} (UID {uid})")
+
+        with connection, connection.makefile("rwb") as stream:
+            for line in stream:
+                try:
+                    request = HelperRequest.from_json(line)
+                except Exception as ex:
+                    response = HelperResponse.error(f"Invalid request: {ex}")
+                else:
+                    Logger.debug(f"{request.operation}: {' '.join(request.argv) or request.path}")
+                    response = self.execute(request)
+                try:
+                    stream.write(response.to_json())
+                    stream.flush()
+                except OSError:
+                    break
+
+    def serve(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o660)
+        if self.group is not None:
+            try:
+                os.chown(self.path, 0, grp.getgrnam(self.group).gr_gid)
+            except (KeyError, PermissionError) as ex:
+                Logger.warning(f"Socket not accessible for group {self.group}: {ex}")
+        server.listen()
+        Logger.info(f"Privileged helper listening on {self.path}")
+
+        try:
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=self.__handle, args=(connection,), daemon=True).start()
+        finally:
+            server.close()
+            os.remove(self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Emulation Demonstrator Privileged Helper")
+    parser.add_argument("--socket", "-s", type=str, default=HELPER_SOCKET_PATH, help="Path of the Unix socket")
+    parser.add_argument("--group", "-g", type=str, default="emulator", help="Group allowed to connect")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Log every request")
+    parser.add_argument("--call", "-c", type=str, default=None,
+                        help="Send a command to a running helper instead of serving, e.g., 'tc qdisc show'")
+    parser.add_argument("--repeat", "-r", type=int, default=1, help="Repetitions of --call, reports the latency")
+    args = parser.parse_args()
+
+    Logger.set_logger(None, None, verbose=args.verbose)
+
+    if args.call is None:
+        HelperServer(args.socket, args.group).serve()
+        sys.exit(0)
+
+    durations = []
+    for _ in range(max(1, args.repeat)):
+        start = time.perf_counter()
+        process = HelperClient.run(args.call, path=args.socket)
+        durations.append(time.perf_counter() - start)
+
+    sys.stdout.write(process.stdout.decode("utf-8", errors="replace"))
+    sys.stderr.write(process.stderr.decode("utf-8", errors="replace"))
+    if args.repeat > 1:
+        durations.sort()
+        print(f"{len(durations)} calls: median {1000 * durations[len(durations) // 2]:.2f} ms, "
+              f"max {1000 * durations[-1]:.2f} ms", file=sys.stderr)
+    sys.exit(process.returncode)
@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from models.config import LinkConfig
+from utils.logger import Logger
+from utils.telemetry import TelemetrySampler
+from utils.theaterq import TheaterQHandler, TheaterQDualLinkSettings, TheaterQState
+from utils.theaterq_mock import MockTheaterQ
+
+
+@dataclass
+class EmulatedLink:
+    config: LinkConfig
+    handler: TheaterQHandler
+    telemetry: TelemetrySampler = field(default_factory=TelemetrySampler)
+    state: Optional[TheaterQState] = None
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+
+class LinkRegistry:
+    def __init__(self, dryrun: bool = False, mock: Optional[MockTheaterQ] = None,
+                 max_workers: int = 4):
+        self.dryrun = dryrun
+        self.mock = mock
+        self.links: Dict[str, EmulatedLink] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="theaterq-link")
+
+    def add(self, config: LinkConfig, telemetry: Optional[TelemetrySampler] = None,
+            adopt: bool = False) -> EmulatedLink:
+        if config.name in self.links:
+            raise Exception(f"Duplicate link name '{config.name}'")
+
+        if config.syncgroup is None:
+            used = [link.config.syncgroup for link in self.links.values()]
+            config.syncgroup = max(used, default=0) + 1
+
+        options = self.mock.handler_options() if self.mock is not None else {"dryrun": self.dryrun}
+        handler = TheaterQHandler(forward_interface=config.forward_interface,
+                                  return_interface=config.return_interface,
+                                  syncgroup=config.syncgroup,
+                                  handle=config.handle,
+                                  parent=config.parent,
+                                  adopt=adopt,
+                                  **options)
+
+        link = EmulatedLink(config=config, handler=handler,
+                            telemetry=telemetry or TelemetrySampler())
+        self.links[config.name] = link
+        Logger.info(f"Link '{config.name}' added: {config.forward_interface}/{config.return_interface}, "
+                    f"handle {config.handle}, syncgroup {config.syncgroup}")
+        return link
+
+    @property
+    def primary(self) -> Optional[EmulatedLink]:
+        return next(iter(self.links.values()), None)
+
+    @property
+    def adopted(self) -> bool:
+        return len(self.links) > 0 and all(link.handler.adopted for link in self.links.values())
+
+    def get(self, name: str) -> Optional[EmulatedLink]:
+        return self.links.get(name)
+
+    def __run_all(self, target: Callable[[EmulatedLink], object],
+                  links: Optional[List[EmulatedLink]] = None) -> Dict[str, object]:
+        # Runs target for all links in parallel, raises the first error after all finished
+        links = list(self.links.values()) if links is None else links
+        futures = {link.name: self.executor.submit(target, link) for link in links}
+        results, errors = {}, []
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as ex:
+                errors.append(Exception(f"Link '{name}': {ex}"))
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def update(self, settings: Dict[str, TheaterQDualLinkSettings]) -> None:
+        # Uploads are independent per device, run them in parallel
+        self.__run_all(lambda link: link.handler.update(settings[link.name]),
+                       [link for link in self.links.values() if link.name in settings])
+
+    def start(self, arm: bool = False) -> bool:
+        # Only the first link of each syncgroup triggers, the kernel starts the rest.
+        # Preparation is done for all links first, so the triggers follow back-to-back.
+        leaders = set()
+        followed: Dict[str, bool] = {}
+        for link in self.links.values():
+            if link.handler.settings is None:
+                continue
+            followed[link.name] = link.config.syncgroup in leaders
+            leaders.add(link.config.syncgroup)
+
+        prepared = self.__run_all(lambda link: link.handler.prepare_start(followed[link.name]),
+                                  [link for link in self.links.values() if link.name in followed])
+        if not all(prepared.values()):
+            return False
+
+        for name, is_followed in followed.items():
+            self.links[name].handler.trigger_start(arm, followed=is_followed)
+
+        return True
+
+    def stop(self) -> None:
+        self.__run_all(lambda link: link.handler.stop())
+
+    def poll(self) -> Dict[str, TheaterQState]:
+        # One shared poller for all links, failing links are skipped
+        futures = {link.name: self.executor.submit(link.handler.get_details)
+                   for link in self.links.values()}
+        states = {}
+        for name, future in futures.items():
+            try:
+                states[name] = future.result()
+                self.links[name].state = states[name]
+            except Exception as ex:
+                Logger.debug(f"Unable to poll link '{name}': {ex}")
+        return states
+
+    def record_telemetry(self, states: Dict[str, TheaterQState]) -> None:
+        for name, state in states.items():
+            self.links[name].telemetry.record(state)
+
+    def reset_telemetry(self) -> None:
+        for link in self.links.values():
+            link.telemetry.reset()
+
+    def clean(self) -> None:
+        for link in self.links.values():
+            try:
+                link.handler.clean()
+            except Exception as ex:
+                Logger.error(f"Unable to clean link '{link.name}': {ex}")
+
+        self.links.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,261 @@
+import re
+import subprocess
+import time
+import numpy as np
+
+from dataclasses import dataclass
+from enum import Enum
+from threading import Event, Lock, Thread
+from typing import Dict, Optional, Tuple
+
+from models.trace import Trace, TraceField
+from utils.logger import Logger
+from utils.utils import start_subprocess
+
+
+class PathStatus(Enum):
+    UNKNOWN = "unknown"
+    UP = "up"
+    DEGRADED = "degraded"
+    DOWN = "down"
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+
+@dataclass
+class PathHealth:
+    status: PathStatus
+    samples: int
+    rtt_median: float # ms
+    rtt_p95: float # ms
+    jitter: float # ms, mean difference of consecutive RTTs
+    loss: float # 0 .. 1
+
+    def __str__(self) -> str:
+        if self.samples == 0:
+            return f"Status: {self.status}"
+
+        return (f"Status: {self.status}, RTT {self.rtt_median:.1f} ms (p95 {self.rtt_p95:.1f} ms), "
+                f"jitter {self.jitter:.1f} ms, loss {100 * self.loss:.1f} %")
+
+
+class ProbeRingBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.time = np.zeros(capacity, dtype=np.float64) # Unix time in s
+        self.rtt = np.zeros(capacity, dtype=np.float64) # ms, NaN if lost
+        self.head = 0
+        self.size = 0
+
+    def append(self, timestamp: float, rtt: float) -> None:
+        self.time[self.head] = timestamp
+        self.rtt[self.head] = rtt
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.size < self.capacity:
+            return self.time[:self.size].copy(), self.rtt[:self.size].copy()
+
+        return np.roll(self.time, -self.head), np.roll(self.rtt, -self.head)
+
+
+class PathProber:
+    # One long-running fwmark-tagged ping per real path, replies and timeouts
+    # are parsed from its output into a ring buffer. Probes reported without
+    # answer (-O) are pending until the reply timeout (-W) expired, only then
+    # they are counted as lost.
+    REPLY = re.compile(r"^\[(?P<time>[\d.]+)\].*icmp_seq=(?P<seq>\d+).*time=(?P<rtt>[\d.]+) ms")
+    TIMEOUT = re.compile(r"^(\[(?P<time>[\d.]+)\] )?no answer yet for icmp_seq=(?P<seq>\d+)")
+    SEQ_MODULO = 1 << 16 # icmp_seq wraps
+
+    def __init__(self, name: str, interface: str, fwmark: int, target: str,
+                 interval: float = 0.5, timeout: float = 1.0, capacity: int = 7200,
+                 dryrun: bool = False):
+        self.name = name
+        self.interface = interface
+        self.fwmark = fwmark
+        self.target = target
+        self.interval = interval
+        self.timeout = timeout
+        self.dryrun = dryrun
+        self.buffer = ProbeRingBuffer(capacity)
+        self.lock = Lock()
+        self.last_seq = -1
+        self.pending: Dict[int, float] = {} # seq -> time of the timeout report
+        self.process: Optional[subprocess.Popen] = None
+        self.thread: Optional[Thread] = None
+        self.stop_event = Event()
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        self.stop_event.clear()
+        with self.lock:
+            self.last_seq = -1
+            self.pending.clear()
+
+        if self.dryrun:
+            self.thread = Thread(target=self.__simulate_thread_fn, name=f"prober-{self.name}", daemon=True)
+        else:
+            self.process = start_subprocess(f"ping -n -D -O -i {self.interval} -W {self.timeout:g} -m {self.fwmark} "
+                                            f"-I {self.interface} {self.target}",
+                                            sudo=True, stdout=subprocess.PIPE, log_debug=True)
+            self.thread = Thread(target=self.__read_thread_fn, name=f"prober-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def record(self, seq: int, timestamp: float, rtt: float) -> None:
+        # A NaN RTT reports a probe without answer yet
+        with self.lock:
+            self.__expire(timestamp)
+            seq %= PathProber.SEQ_MODULO
+            if seq in self.pending:
+                if not np.isnan(rtt):
+                    del self.pending[seq]
+                    self.buffer.append(timestamp, rtt)
+                return
+
+            # Duplicates and replies for probes already counted as lost are ignored
+            if self.last_seq >= 0 and not \
+                    0 < (seq - self.last_seq) % PathProber.SEQ_MODULO < PathProber.SEQ_MODULO // 2:
+                return
+
+            self.last_seq = seq
+            if np.isnan(rtt):
+                self.pending[seq] = timestamp
+            else:
+                self.buffer.append(timestamp, rtt)
+
+    def __expire(self, now: float) -> None:
+        for seq, timestamp in list(self.pending.items()):
+            if now - timestamp >= self.timeout:
+                del self.pending[seq]
+                self.buffer.append(timestamp, np.nan)
+
+    def __read_thread_fn(self) -> None:
+        for raw in self.process.stdout:
+            line = raw.decode("utf-8", errors="replace").strip()
+            match = PathProber.REPLY.match(line)
+            if match is not None:
+                self.record(int(match["seq"]), float(match["time"]), float(match["rtt"]))
+                continue
+
+            match = PathProber.TIMEOUT.match(line)
+            if match is not None:
+                timestamp = float(match["time"]) if match["time"] else time.time()
+                self.record(int(match["seq"]), timestamp, np.nan)
+
+        if not self.stop_event.is_set():
+            Logger.error(f"Prober for {self.name} stopped unexpectedly")
+
+    def __simulate_thread_fn(self) -> None:
+        rng = np.random.default_rng()
+        seq = 0
+        while not self.stop_event.wait(self.interval):
+            rtt = np.nan if rng.random() < 0.01 else 30.0 + rng.gamma(2.0, 2.0)
+            self.record(seq, time.time(), rtt)
+            seq += 1
+
+    def snapshot(self, since: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            self.__expire(time.time())
+            times, rtts = self.buffer.snapshot()
+
+        if since is not None:
+            selected = times >= since
+            times, rtts = times[selected], rtts[selected]
+        return times, rtts
+
+    def health(self, window: float = 30.0) -> PathHealth:
+        now = time.time()
+        times, rtts = self.snapshot(now - window)
+        if len(times) == 0:
+            return PathHealth(PathStatus.UNKNOWN, 0, np.nan, np.nan, np.nan, np.nan)
+
+        received = rtts[~np.isnan(rtts)]
+        loss = 1.0 - len(received) / len(rtts)
+        recent = rtts[times >= now - max(5.0, 4 * self.interval)]
+
+        if len(recent) > 0 and np.isnan(recent).all():
+            status = PathStatus.DOWN
+        elif loss > 0.05:
+            status = PathStatus.DEGRADED
+        else:
+            status = PathStatus.UP
+
+        if len(received) == 0:
+            return PathHealth(status, len(rtts), np.nan, np.nan, np.nan, loss)
+
+        return PathHealth(status=status, samples=len(rtts),
+                          rtt_median=float(np.median(received)),
+                          rtt_p95=float(np.percentile(received, 95)),
+                          jitter=float(np.abs(np.diff(received)).mean()) if len(received) > 1 else 0.0,
+                          loss=loss)
+
+    def histograms(self, window: float = 300.0, bins: int = 20) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        # RTT and jitter in ms, loss in % per block of 10 probes
+        times, rtts = self.snapshot(time.time() - window)
+        received = rtts[~np.isnan(rtts)]
+        blocks = np.isnan(rtts[:len(rtts) // 10 * 10]).reshape(-1, 10).mean(axis=1) * 100
+        return {
+            "rtt": np.histogram(received, bins=bins),
+            "jitter": np.histogram(np.abs(np.diff(received)), bins=bins),
+            "loss": np.histogram(blocks, bins=10, range=(0, 100)),
+        }
+
+    def to_trace(self, since: float, until: float, granularity: int, limit: int = 200) -> Trace:
+        # Extended trace from the probes between since and until (Unix time in s), the
+        # RTT is split evenly between both directions. Rate is left unlimited.
+        times, rtts = self.snapshot(since)
+        selected = times < until
+        times, rtts = times[selected], rtts[selected]
+
+        entries = max(1, int(np.ceil((until - since) * 1e6 / granularity)))
+        buckets = ((times - since) * 1e6 // granularity).astype(np.int64)
+
+        data = np.zeros((entries, Trace.FIELDS), dtype=np.int64)
+        data[:, TraceField.KEEP] = granularity
+        data[:, TraceField.LIMIT] = limit
+        data[:, TraceField.ROUTE] = 1
+
+        valid = ~np.isnan(rtts)
+        sent = np.bincount(buckets, minlength=entries)[:entries]
+        received = np.bincount(buckets[valid], minlength=entries)[:entries]
+        total = np.bincount(buckets[valid], weights=rtts[valid], minlength=entries)[:entries]
+        squares = np.bincount(buckets[valid], weights=rtts[valid] ** 2, minlength=entries)[:entries]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            loss = np.where(sent > 0, 1.0 - received / sent, 0.0)
+            mean = np.where(received > 0, total / received, np.nan)
+            jitter = np.sqrt(np.maximum(np.where(received > 0, squares / received, 0.0) - np.nan_to_num(mean) ** 2, 0.0)) / 2
+        latency = mean / 2
+
+        # Buckets without a reply keep the previous latency
+        valid = ~np.isnan(latency)
+        if valid.any():
+            index = np.where(valid, np.arange(entries), 0)
+            np.maximum.accumulate(index, out=index)
+            latency = np.where(valid[index], latency[index], latency[valid][0])
+        else:
+            latency = np.zeros(entries)
+
+        data[:, TraceField.LATENCY] = np.rint(latency * 1e6) # ms to ns
+        data[:, TraceField.JITTER] = np.rint(jitter * 1e6)
+        data[:, TraceField.LOSS] = np.rint(loss * 0xFFFFFFFF)
+        return Trace(data)
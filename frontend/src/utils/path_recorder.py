@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+
+import argparse
+import math
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+from models.trace import Trace, TraceField
+from utils.logger import Logger
+from utils.trace_generator import write_scenario
+
+
+SO_MARK = 36
+SO_TIMESTAMPNS = 35
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_TIMESTAMP_REQUEST = 13
+ICMP_TIMESTAMP_REPLY = 14
+ICMP_HEADER = struct.Struct("!BBHHH") # type, code, checksum, id, sequence
+ICMP_TIMESTAMPS = struct.Struct("!III") # originate, receive, transmit (ms since midnight UTC)
+IP_ICMP_OVERHEAD = 28 # bytes
+PROBE_SIZE = 84 # bytes on the wire, like ping
+U32_MAX = 4294967295
+MS_PER_DAY = 86400000
+
+
+class ProbeKind(Enum):
+    ECHO = "echo"
+    TIMESTAMP = "timestamp"
+    TRAIN = "train"
+
+
+@dataclass
+class SentProbe:
+    kind: ProbeKind
+    interval: int # index of the trace entry
+    train: Optional[int] # index of the probe train
+    sent: float # s, CLOCK_REALTIME
+    received: Optional[float] = None # s, kernel receive timestamp
+    timestamps: Optional[Tuple[int, int, int]] = None
+
+
+@dataclass
+class RecorderSettings:
+    granularity: int = 1000000 # µs per trace entry
+    probes: int = 5 # echo probes per entry
+    train_length: int = 16 # packets per rate probe train
+    train_size: int = 1200 # bytes per train packet
+    budget: float = 200.0 # kbit/s, upper bound of the measurement traffic
+    one_way: bool = False # use ICMP timestamps for the forward/return split
+    limit: int = 200 # pkts, queue limit written to the trace
+
+    def probe_rate(self) -> float:
+        # bit/s used by echo and timestamp probes
+        per_entry = self.probes + (1 if self.one_way else 0)
+        return per_entry * PROBE_SIZE * 8 / (self.granularity / 1e6)
+
+    def train_interval(self) -> float:
+        # Trains are spaced so the total stays within the budget
+        remaining = self.budget * 1000 - self.probe_rate()
+        if remaining <= 0:
+            raise ValueError(f"Budget of {self.budget} kbit/s is too low for {self.probes} probes per entry")
+
+        return max(self.granularity / 1e6, self.train_length * self.train_size * 8 / remaining)
+
+
+@dataclass
+class RecordedPath:
+    forward: Trace
+    reverse: Trace
+    forward_share: float
+    rate_samples: int
+    probes_sent: int
+    probes_lost: int
+    summary: Dict[str, float] = field(default_factory=dict)
+
+
+def icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def ms_since_midnight(timestamp: float) -> int:
+    return int(timestamp * 1000) % MS_PER_DAY
+
+
+class PathRecorder:
+    # Actively measures a real path through a VLAN uplink with fwmark-tagged raw ICMP:
+    # echo probes for RTT and loss, optional ICMP timestamps for the one-way delay
+    # split and short packet trains for the available rate (reply dispersion).
+    def __init__(self, interface: str, fwmark: int, target: str,
+                 settings: RecorderSettings = RecorderSettings()):
+        self.interface = interface
+        self.fwmark = fwmark
+        self.target = target
+        self.settings = settings
+        self.identifier = os.getpid() & 0xFFFF
+        self.probes: List[SentProbe] = [] # the ICMP sequence is the index modulo 2^16
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.deadline = math.inf
+        self.start_time = 0.0
+        self.entries = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_MARK, fwmark)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self.sock.settimeout(0.2)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def __send(self, kind: ProbeKind, interval: int, train: Optional[int] = None) -> None:
+        sequence = len(self.probes) & 0xFFFF
+        now = time.time()
+        if kind == ProbeKind.TIMESTAMP:
+            icmp_type, payload = ICMP_TIMESTAMP_REQUEST, ICMP_TIMESTAMPS.pack(ms_since_midnight(now), 0, 0)
+        else:
+            size = self.settings.train_size if kind == ProbeKind.TRAIN else PROBE_SIZE
+            icmp_type, payload = ICMP_ECHO_REQUEST, bytes(size - IP_ICMP_OVERHEAD - ICMP_HEADER.size)
+
+        header = ICMP_HEADER.pack(icmp_type, 0, 0, self.identifier, sequence)
+        checksum = icmp_checksum(header + payload)
+        packet = ICMP_HEADER.pack(icmp_type, 0, checksum, self.identifier, sequence) + payload
+
+        with self.lock:
+            self.probes.append(SentProbe(kind, interval, train, now))
+        try:
+            self.sock.sendto(packet, (self.target, 0))
+        except OSError as ex:
+            Logger.debug(f"Unable to send probe: {ex}")
+
+    def __receive_thread_fn(self) -> None:
+        ancillary = socket.CMSG_SPACE(16)
+        while not self.stop_event.is_set() or time.time() < self.deadline:
+            try:
+                data, cmsgs, _, _ = self.sock.recvmsg(65535, ancillary)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+
+            received = time.time()
+            for level, kind, value in cmsgs:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                    seconds, nanoseconds = struct.unpack("qq", value[:16])
+                    received = seconds + nanoseconds / 1e9
+
+            offset = (data[0] & 0x0F) * 4
+            if len(data) < offset + ICMP_HEADER.size:
+                continue
+            icmp_type, _, _, identifier, sequence = ICMP_HEADER.unpack_from(data, offset)
+            if identifier != self.identifier or icmp_type not in [ICMP_ECHO_REPLY, ICMP_TIMESTAMP_REPLY]:
+                continue
+
+            with self.lock:
+                # Replies are at most seconds late, the sequence is unwrapped to the latest
+                # probe with these low bits
+                newest = len(self.probes) - 1
+                index = newest - ((newest - sequence) & 0xFFFF)
+                if index < 0:
+                    continue
+                probe = self.probes[index]
+                if probe.received is not None or \
+                        (icmp_type == ICMP_TIMESTAMP_REPLY) != (probe.kind == ProbeKind.TIMESTAMP):
+                    continue
+                probe.received = received
+                if icmp_type == ICMP_TIMESTAMP_REPLY and len(data) >= offset + ICMP_HEADER.size + ICMP_TIMESTAMPS.size:
+                    probe.timestamps = ICMP_TIMESTAMPS.unpack_from(data, offset + ICMP_HEADER.size)
+
+    def run(self, duration: Optional[float] = None) -> None:
+        # Sends until duration elapsed or stop() is called, then waits for late replies
+        granularity = self.settings.granularity / 1e6
+        train_interval = self.settings.train_interval()
+        Logger.info(f"Recording {self.target} via {self.interface} (fwmark {self.fwmark}): "
+                    f"{self.settings.probes} probes per {granularity:.3f} s, train every {train_interval:.1f} s, "
+                    f"at most {(self.settings.probe_rate() + self.settings.train_length * self.settings.train_size * 8 / train_interval) / 1000:.1f} kbit/s")
+
+        receiver = threading.Thread(target=self.__receive_thread_fn, name="recorder-receive", daemon=True)
+        receiver.start()
+
+        # Schedule of (offset, kind) within one entry, echo probes evenly spaced
+        schedule = [(index * granularity / self.settings.probes, ProbeKind.ECHO)
+                    for index in range(self.settings.probes)]
+        if self.settings.one_way:
+            schedule.append((granularity / (2 * self.settings.probes), ProbeKind.TIMESTAMP))
+        schedule.sort(key=lambda entry: entry[0])
+
+        self.start_time = time.time()
+        start = time.monotonic()
+        next_train, trains, interval = 0.0, 0, 0
+        while not self.stop_event.is_set() and (duration is None or interval * granularity < duration):
+            for offset, kind in schedule:
+                if self.stop_event.wait(max(0.0, start + interval * granularity + offset - time.monotonic())):
+                    break
+                self.__send(kind, interval)
+
+            # Trains go out back-to-back after the regular probes
+            if not self.stop_event.is_set() and interval * granularity >= next_train:
+                for _ in range(self.settings.train_length):
+                    self.__send(ProbeKind.TRAIN, interval, trains)
+                trains += 1
+                next_train += train_interval
+
+            interval += 1
+
+        self.entries = interval
+        self.deadline = time.time() + 2.0
+        self.stop_event.set()
+        receiver.join()
+        self.sock.close()
+
+    def result(self) -> RecordedPath:
+        settings = self.settings
+        entries = max(self.entries, 1)
+        probes = self.probes
+
+        echo = [probe for probe in probes if probe.kind == ProbeKind.ECHO and probe.interval < entries]
+        index = np.array([probe.interval for probe in echo], dtype=np.int64)
+        rtt = np.array([(probe.received - probe.sent) * 1000 if probe.received is not None else np.nan
+                        for probe in echo]) # ms
+        valid = ~np.isnan(rtt)
+
+        sent = np.bincount(index, minlength=entries)[:entries]
+        received = np.bincount(index[valid], minlength=entries)[:entries]
+        total = np.bincount(index[valid], weights=rtt[valid], minlength=entries)[:entries]
+        squares = np.bincount(index[valid], weights=rtt[valid] ** 2, minlength=entries)[:entries]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            loss = np.where(sent > 0, 1.0 - received / sent, 0.0)
+            mean = np.where(received > 0, total / received, np.nan)
+            variance = np.where(received > 0, squares / received, 0.0) - np.nan_to_num(mean) ** 2
+        jitter = np.sqrt(np.maximum(variance, 0.0))
+
+        # Entries without any reply keep the previous RTT
+        if valid.any():
+            filled = np.where(~np.isnan(mean), np.arange(entries), 0)
+            np.maximum.accumulate(filled, out=filled)
+            first = mean[~np.isnan(mean)][0]
+            mean = np.where(np.isnan(mean[filled]), first, mean[filled])
+        else:
+            mean = np.zeros(entries)
+
+        share = self.__forward_share()
+        rate, rate_samples = self.__rates(entries)
+
+        # ICMP cannot tell in which direction a probe was lost, split evenly
+        loss_direction = 1.0 - np.sqrt(1.0 - loss)
+
+        traces = []
+        for fraction in [share, 1.0 - share]:
+            data = np.zeros((entries, Trace.FIELDS), dtype=np.int64)
+            data[:, TraceField.KEEP] = settings.granularity
+            data[:, TraceField.LATENCY] = np.rint(mean * fraction * 1e6) # ms to ns
+            data[:, TraceField.JITTER] = np.rint(jitter * fraction * 1e6)
+            data[:, TraceField.RATE] = rate
+            data[:, TraceField.LOSS] = np.rint(loss_direction * U32_MAX)
+            data[:, TraceField.LIMIT] = settings.limit
+            data[:, TraceField.ROUTE] = 1
+            traces.append(Trace(data))
+
+        lost = int((~valid).sum())
+        return RecordedPath(forward=traces[0], reverse=traces[1], forward_share=share,
+                            rate_samples=rate_samples, probes_sent=len(echo), probes_lost=lost,
+                            summary={"rtt_mean_ms": float(np.nanmean(rtt)) if valid.any() else float("nan"),
+                                     "loss": lost / max(len(echo), 1),
+                                     "rate_median_mbps": float(np.median(rate[rate > 0]) / 1e6) if (rate > 0).any() else float("nan")})
+
+    def __forward_share(self) -> float:
+        # Forward share of the RTT from ICMP timestamps, only if the remote clock is
+        # plausibly synchronized (both one-way delays within the measured RTT)
+        shares = []
+        for probe in self.probes:
+            if probe.kind != ProbeKind.TIMESTAMP or probe.timestamps is None or probe.received is None:
+                continue
+
+            originate, remote_receive, remote_transmit = probe.timestamps
+            if remote_receive & 0x80000000 or remote_transmit & 0x80000000:
+                continue # Non-standard time reference
+            rtt = (probe.received - probe.sent) * 1000
+            forward = (remote_receive - originate) % MS_PER_DAY
+            reverse = (ms_since_midnight(probe.received) - remote_transmit) % MS_PER_DAY
+            # Timestamps have a resolution of 1 ms, short paths cannot be split
+            if rtt >= 10 and forward + reverse <= rtt + 2:
+                shares.append(forward / max(forward + reverse, 1))
+
+        if len(shares) < 3:
+            return 0.5
+
+        return float(np.clip(np.median(shares), 0.0, 1.0))
+
+    def __rates(self, entries: int) -> Tuple[np.ndarray, int]:
+        # Rate per train from the dispersion of the replies, held until the next train
+        trains: Dict[int, List[SentProbe]] = {}
+        for probe in self.probes:
+            if probe.kind == ProbeKind.TRAIN:
+                trains.setdefault(probe.train, []).append(probe)
+
+        rate = np.zeros(entries, dtype=np.int64)
+        samples = 0
+        for train in sorted(trains):
+            arrivals = sorted(probe.received for probe in trains[train] if probe.received is not None)
+            if len(arrivals) < 2 or arrivals[-1] <= arrivals[0]:
+                continue
+
+            estimate = (len(arrivals) - 1) * self.settings.train_size * 8 / (arrivals[-1] - arrivals[0])
+            first = trains[train][0].interval
+            rate[first if samples > 0 else 0:] = int(estimate)
+            samples += 1
+
+        return rate, samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Real Path Recorder")
+    parser.add_argument("INTERFACE", type=str, help="VLAN uplink interface of the real path")
+    parser.add_argument("--fwmark", "-m", type=int, required=True, help="fwmark of the real path")
+    parser.add_argument("--target", "-t", type=str, default="1.1.1.1", help="Probe target")
+    parser.add_argument("--output", "-o", type=str, required=True, help="Output directory for traces and scenario")
+    parser.add_argument("--name", "-n", type=str, default=None, help="Scenario name")
+    parser.add_argument("--duration", "-d", type=float, default=None,
+                        help="Recording duration in seconds, otherwise until SIGINT/SIGTERM")
+    parser.add_argument("--granularity", "-g", type=int, default=1000000, help="Trace entry length in µs")
+    parser.add_argument("--probes", type=int, default=5, help="Echo probes per trace entry")
+    parser.add_argument("--train-length", type=int, default=16, help="Packets per rate probe train")
+    parser.add_argument("--train-size", type=int, default=1200, help="Bytes per rate probe packet")
+    parser.add_argument("--budget", type=float, default=200.0, help="Maximum measurement traffic in kbit/s")
+    parser.add_argument("--one-way", action="store_true", help="Split the RTT using ICMP timestamps")
+    parser.add_argument("--limit", type=int, default=200, help="Queue limit written to the trace")
+    args = parser.parse_args()
+
+    settings = RecorderSettings(granularity=args.granularity, probes=args.probes,
+                                train_length=args.train_length, train_size=args.train_size,
+                                budget=args.budget, one_way=args.one_way, limit=args.limit)
+    recorder = PathRecorder(args.INTERFACE, args.fwmark, args.target, settings)
+    signal.signal(signal.SIGTERM, lambda *_: recorder.stop())
+    signal.signal(signal.SIGINT, lambda *_: recorder.stop())
+
+    started = time.strftime("%Y%m%d-%H%M%S")
+    recorder.run(args.duration)
+    result = recorder.result()
+
+    name = args.name or f"{args.INTERFACE} {started}"
+    description = (f"Recorded via {args.INTERFACE} to {args.target} at {started}: "
+                   f"mean RTT {result.summary['rtt_mean_ms']:.1f} ms, loss {100 * result.summary['loss']:.1f} %, "
+                   f"median rate {result.summary['rate_median_mbps']:.1f} Mbps ({result.rate_samples} trains), "
+                   f"forward share {100 * result.forward_share:.0f} %.")
+    path = write_scenario(args.output, name, description, result.forward, result.reverse)
+    print(f"Recorded {recorder.entries} entries, scenario written to {path}")
@@ -0,0 +1,430 @@
+import argparse
+import ipaddress
+import json
+import sys
+import time
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from models.config import FullConfig
+from models.operation import OperationMode
+from utils.logger import Logger
+from utils.utils import invoke_subprocess, run_fail_on_error
+from constants import *
+
+
+LinkKey = Tuple[Optional[str], str] # netns, name
+
+
+@dataclass(frozen=True)
+class LinkSpec:
+    name: str
+    kind: Optional[str] = None # None for physical interfaces, which are never created or deleted
+    parent: Optional[str] = None # vlan only
+    vlan: Optional[int] = None
+    peer: Optional[str] = None # veth only
+    master: Optional[str] = None
+    netns: Optional[str] = None
+
+    @property
+    def key(self) -> LinkKey:
+        return (self.netns, self.name)
+
+    def matches(self, current: "LinkSpec") -> bool:
+        # The parent of links moved to another namespace is not visible by name
+        return (self.kind == current.kind and self.vlan == current.vlan
+                and (current.parent is None or self.parent == current.parent))
+
+
+@dataclass(frozen=True)
+class AddressSpec:
+    interface: str
+    address: str # CIDR
+    netns: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class RouteSpec:
+    # Default routes only, table None is main
+    interface: str
+    gateway: str
+    table: Optional[int] = None
+    netns: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class RuleSpec:
+    fwmark: int
+    table: int
+
+
+@dataclass
+class NetworkState:
+    netns: Set[str] = field(default_factory=set)
+    links: Dict[LinkKey, LinkSpec] = field(default_factory=dict)
+    up: Set[LinkKey] = field(default_factory=set)
+    addresses: Set[AddressSpec] = field(default_factory=set)
+    routes: Set[RouteSpec] = field(default_factory=set)
+    rules: Set[RuleSpec] = field(default_factory=set)
+    qdiscs: Dict[str, str] = field(default_factory=dict) # interface -> root qdisc kind
+
+    def add_link(self, link: LinkSpec, up: bool = True) -> None:
+        self.links[link.key] = link
+        if up:
+            self.up.add(link.key)
+
+    def union(self, other: "NetworkState") -> "NetworkState":
+        return NetworkState(netns=self.netns | other.netns,
+                            links={**self.links, **other.links},
+                            up=self.up | other.up,
+                            addresses=self.addresses | other.addresses,
+                            routes=self.routes | other.routes,
+                            rules=self.rules | other.rules,
+                            qdiscs={**self.qdiscs, **other.qdiscs})
+
+
+@dataclass
+class Change:
+    description: str
+    commands: List[str]
+
+
+@dataclass
+class ReconcilePlan:
+    removals: List[Change] = field(default_factory=list)
+    additions: List[Change] = field(default_factory=list)
+    bringup_missing: List[str] = field(default_factory=list) # Left to the real path bring-up
+
+    def __len__(self) -> int:
+        return len(self.removals) + len(self.additions) + len(self.bringup_missing)
+
+    def __str__(self) -> str:
+        lines = [f"- {change.description}" for change in self.removals]
+        lines += [f"+ {change.description}" for change in self.additions]
+        lines += [f"+ {description} (bring-up)" for description in self.bringup_missing]
+        return "\n".join(lines) if lines else "Network state is up to date"
+
+
+def normalize_address(address: str) -> str:
+    try:
+        return str(ipaddress.ip_interface(address))
+    except ValueError:
+        return address
+
+
+class Reconciler:
+    # Compares the current links, addresses, default routes, rules, namespaces and
+    # root qdiscs (read as JSON from iproute2, i.e., netlink dumps) with the state
+    # required by the config and operation mode. Only objects this tool may have
+    # created are changed, everything else on the host is left untouched.
+    #
+    # The extended topology (left VLAN, public namespace, uplinks) is only checked,
+    # it is created by the real path bring-up, which knows its ordering quirks.
+    def __init__(self, config: FullConfig, mode: Optional[OperationMode],
+                 right_interface: str, left_interface: str, dryrun: bool = False):
+        self.config = config
+        self.mode = mode
+        self.right_interface = right_interface
+        self.left_interface = left_interface
+        self.dryrun = dryrun
+
+    def desired(self, mode: Optional[OperationMode]) -> Tuple[NetworkState, NetworkState]:
+        # Returns the state applied by the reconciler and the one of the bring-up
+        base, bringup = NetworkState(), NetworkState()
+        if mode is None:
+            return base, bringup
+
+        general = self.config.general
+        master = BRIDGE_MODE_BRIDGE_NAME if mode == OperationMode.BRIDGED else None
+        if mode == OperationMode.BRIDGED:
+            base.add_link(LinkSpec(BRIDGE_MODE_BRIDGE_NAME, kind="bridge"))
+        for name in [self.right_interface, self.left_interface]:
+            base.add_link(LinkSpec(name, master=master))
+
+        if mode == OperationMode.ROUTED:
+            base.addresses.add(AddressSpec(self.right_interface, normalize_address(general.right_interface_address)))
+            base.addresses.add(AddressSpec(self.left_interface, normalize_address(general.left_interface_address)))
+
+        # Additional links are always transparent bridges between their interfaces
+        for link in self.config.links:
+            base.add_link(LinkSpec(link.get_bridge_name(), kind="bridge"))
+            base.add_link(LinkSpec(link.forward_interface, master=link.get_bridge_name()))
+            base.add_link(LinkSpec(link.return_interface, master=link.get_bridge_name()))
+
+        if mode != OperationMode.EXTENDED:
+            return base, bringup
+
+        extended = self.config.extended
+        public = extended.public_interface
+        left_vlan = extended.get_left_interface_name()
+        bringup.add_link(LinkSpec(left_vlan, kind="vlan", parent=self.left_interface, vlan=extended.left_vlan))
+        bringup.addresses.add(AddressSpec(left_vlan, normalize_address(general.left_interface_address)))
+
+        # The public VLAN ends up on the left interface, see RealpathMode.config_interfaces
+        bringup.netns.add(PUBLIC_NETNS_NAME)
+        bringup.add_link(LinkSpec(public.get_public_interface_name(), kind="vlan", parent=self.left_interface,
+                                  vlan=public.vlan, netns=PUBLIC_NETNS_NAME))
+        bringup.addresses.add(AddressSpec(public.get_public_interface_name(), normalize_address(public.address),
+                                          PUBLIC_NETNS_NAME))
+        bringup.routes.add(RouteSpec(public.get_public_interface_name(), public.gateway, netns=PUBLIC_NETNS_NAME))
+
+        bringup.add_link(LinkSpec(NETNS_RIGHT_BRIDGE_NAME, kind="bridge"))
+        bringup.addresses.add(AddressSpec(NETNS_RIGHT_BRIDGE_NAME, normalize_address(general.right_interface_address)))
+        bringup.add_link(LinkSpec(extended.get_right_interface_name(), kind="vlan", parent=self.right_interface,
+                                  vlan=extended.right_vlan, master=NETNS_RIGHT_BRIDGE_NAME))
+        bringup.add_link(LinkSpec("veth-host", kind="veth", peer="veth-public", master=NETNS_RIGHT_BRIDGE_NAME))
+        bringup.add_link(LinkSpec("veth-public", kind="veth", peer="veth-host", netns=PUBLIC_NETNS_NAME))
+        bringup.addresses.add(AddressSpec("veth-public", normalize_address(extended.right_netns_address),
+                                          PUBLIC_NETNS_NAME))
+
+        # Gateway routes of the uplink tables are dynamic and installed by the bring-up
+        for entry in extended.configs:
+            bringup.add_link(LinkSpec(entry.get_interface_name(), kind="vlan", parent=self.right_interface,
+                                      vlan=entry.vlan))
+            bringup.rules.add(RuleSpec(entry.vlan, entry.vlan))
+            if entry.address is not None:
+                bringup.addresses.add(AddressSpec(entry.get_interface_name(), normalize_address(entry.address)))
+                bringup.routes.add(RouteSpec(entry.get_interface_name(), entry.gateway))
+
+        return base, bringup
+
+    def __managed(self) -> NetworkState:
+        managed = NetworkState()
+        for mode in OperationMode:
+            base, bringup = self.desired(mode)
+            managed = managed.union(base).union(bringup)
+        return managed
+
+    def __query(self, command: List[str], netns: Optional[str] = None) -> List[Dict[str, Any]]:
+        if netns is not None:
+            command = [command[0], "-n", netns] + command[1:]
+
+        process = invoke_subprocess(command, capture_output=True, shell=False, sudo=True, log_debug=True)
+        if process.returncode != 0:
+            raise Exception(f"Command failed: {process.stderr.decode('utf-8').strip()}")
+
+        output = process.stdout.decode("utf-8").strip()
+        return json.loads(output) if output else []
+
+    def read(self) -> NetworkState:
+        state = NetworkState()
+        if self.dryrun:
+            return state
+
+        state.netns = {entry["name"] for entry in self.__query(["ip", "-j", "netns", "list"])}
+        for netns in [None] + sorted(state.netns & {PUBLIC_NETNS_NAME}):
+            for item in self.__query(["ip", "-j", "-d", "address", "show"], netns):
+                info = item.get("linkinfo", {})
+                kind = info.get("info_kind")
+                link = LinkSpec(name=item["ifname"], kind=kind,
+                                parent=item.get("link") if kind == "vlan" else None,
+                                vlan=info.get("info_data", {}).get("id") if kind == "vlan" else None,
+                                master=item.get("master"), netns=netns)
+                state.add_link(link, up="UP" in item.get("flags", []))
+                for address in item.get("addr_info", []):
+                    if address.get("family") == "inet":
+                        state.addresses.add(AddressSpec(item["ifname"], f"{address['local']}/{address['prefixlen']}", netns))
+
+            for item in self.__query(["ip", "-j", "route", "show", "table", "all", "default"], netns):
+                table = item.get("table", "main")
+                if "gateway" not in item or "dev" not in item or not (table == "main" or table.isdigit()):
+                    continue
+                state.routes.add(RouteSpec(item["dev"], item["gateway"],
+                                           None if table == "main" else int(table), netns))
+
+        for item in self.__query(["ip", "-j", "rule", "show"]):
+            if "fwmark" in item and str(item.get("table", "")).isdigit():
+                state.rules.add(RuleSpec(int(item["fwmark"], 0), int(item["table"])))
+
+        for item in self.__query(["tc", "-j", "qdisc", "show"]):
+            if item.get("root"):
+                state.qdiscs[item["dev"]] = item["kind"]
+
+        return state
+
+    def plan(self, current: Optional[NetworkState] = None) -> ReconcilePlan:
+        current = current if current is not None else self.read()
+        base, bringup = self.desired(self.mode)
+        desired = base.union(bringup)
+        managed = self.__managed()
+        plan = ReconcilePlan()
+
+        def ip(netns: Optional[str]) -> str:
+            return "ip" if netns is None else f"ip -n {netns}"
+
+        # Removals: managed objects that are not desired (or of the wrong type)
+        stale_netns = (current.netns & managed.netns) - desired.netns
+        for netns in sorted(stale_netns):
+            plan.removals.append(Change(f"namespace {netns}", [f"ip netns del {netns}"]))
+
+        recreate: Set[LinkKey] = set()
+        removed: Set[str] = set()
+        for key, link in sorted(current.links.items(), key=lambda item: str(item[0])):
+            if key not in managed.links or link.netns in stale_netns:
+                continue
+
+            wanted = desired.links.get(key)
+            if link.kind is None or managed.links[key].kind is None:
+                # Physical interfaces are only detached and set down
+                if wanted is None and link.master is not None and link.master not in removed \
+                        and link.master in [spec.name for spec in managed.links.values()]:
+                    plan.removals.append(Change(f"bridge port {link.name}", [f"ip link set dev {link.name} nomaster"]))
+                if wanted is None and key in current.up:
+                    plan.removals.append(Change(f"link state of {link.name}", [f"ip link set down dev {link.name}"]))
+                continue
+
+            if wanted is None or not wanted.matches(link):
+                plan.removals.append(Change(f"link {link.name}", [f"{ip(link.netns)} link del {link.name}"]))
+                removed.add(link.name)
+                recreate.add(key)
+                # Peers of deleted veths vanish as well
+                if link.kind == "veth" and wanted is not None and wanted.peer is not None:
+                    recreate |= {other for other, spec in desired.links.items() if spec.name == wanted.peer}
+
+        managed_addresses = {address.address for address in managed.addresses}
+        for address in sorted(current.addresses, key=str):
+            if address.address in managed_addresses and address not in desired.addresses \
+                    and address.netns not in stale_netns and (address.netns, address.interface) not in recreate:
+                plan.removals.append(Change(f"address {address.address} on {address.interface}",
+                                            [f"{ip(address.netns)} address del {address.address} dev {address.interface}"]))
+
+        for route in sorted((current.routes & managed.routes) - desired.routes, key=str):
+            if route.netns not in stale_netns and (route.netns, route.interface) not in recreate:
+                plan.removals.append(Change(f"default route via {route.gateway}",
+                                            [f"{ip(route.netns)} route del default via {route.gateway} dev {route.interface}"]))
+
+        managed_marks = {rule.fwmark for rule in managed.rules}
+        for rule in sorted(current.rules, key=str):
+            if rule.fwmark in managed_marks and rule not in desired.rules:
+                plan.removals.append(Change(f"rule fwmark {rule.fwmark}",
+                                            [f"ip rule del fwmark {rule.fwmark} table {rule.table}"]))
+
+        emulated = [self.right_interface, self.left_interface] + \
+            [name for link in self.config.links for name in [link.forward_interface, link.return_interface]]
+        # TheaterQ qdiscs on emulated interfaces are owned by TheaterQHandler
+        qdiscs = ["theaterq"]
+        if self.mode is None and self.config.classful is not None:
+            qdiscs.append(self.config.classful.root)
+        for interface, kind in sorted(current.qdiscs.items()):
+            if kind in qdiscs and (self.mode is None or interface not in emulated):
+                plan.removals.append(Change(f"{kind} qdisc on {interface}", [f"tc qdisc del dev {interface} root"]))
+
+        # Additions: desired objects that are missing after the removals
+        def missing(key: LinkKey) -> bool:
+            return key not in current.links or key in recreate or current.links[key].netns in stale_netns
+
+        def add(state: NetworkState, description: str, commands: List[str]) -> None:
+            if state is base:
+                plan.additions.append(Change(description, commands))
+            else:
+                plan.bringup_missing.append(description)
+
+        for state in [base, bringup]:
+            for netns in sorted(state.netns - (current.netns - stale_netns)):
+                add(state, f"namespace {netns}", [f"ip netns add {netns}"])
+
+            # Bridges first, VLANs need their parent, ports their master
+            links = sorted(state.links.values(), key=lambda link: [None, "bridge", "vlan", "veth"].index(link.kind))
+            for link in links:
+                if link.kind is None or not missing(link.key):
+                    continue
+
+                if link.kind == "vlan":
+                    commands = [f"ip link add link {link.parent} name {link.name} type vlan id {link.vlan}"]
+                elif link.kind == "veth":
+                    if link.netns is not None:
+                        continue # Created with its peer
+                    commands = [f"ip link add {link.name} type veth peer name {link.peer}"]
+                    peers = [spec for spec in state.links.values() if spec.name == link.peer and spec.netns is not None]
+                    commands += [f"ip link set dev {peer.name} netns {peer.netns}" for peer in peers]
+                else:
+                    commands = [f"ip link add name {link.name} type {link.kind}"]
+
+                if link.netns is not None:
+                    commands.append(f"ip link set dev {link.name} netns {link.netns}")
+                add(state, f"link {link.name}", commands)
+
+            for key, link in sorted(state.links.items(), key=lambda item: str(item[0])):
+                current_master = current.links[key].master if not missing(key) else None
+                if current_master in removed:
+                    current_master = None
+                if link.master != current_master:
+                    target = f"master {link.master}" if link.master is not None else "nomaster"
+                    add(state, f"bridge port {link.name}", [f"{ip(link.netns)} link set dev {link.name} {target}"])
+                if key in state.up and (key not in current.up or missing(key)):
+                    add(state, f"link state of {link.name}", [f"{ip(link.netns)} link set up dev {link.name}"])
+
+            for address in sorted(state.addresses - current.addresses, key=str):
+                add(state, f"address {address.address} on {address.interface}",
+                    [f"{ip(address.netns)} address add {address.address} dev {address.interface}"])
+            for address in sorted(state.addresses & current.addresses, key=str):
+                if (address.netns, address.interface) in recreate:
+                    add(state, f"address {address.address} on {address.interface}",
+                        [f"{ip(address.netns)} address add {address.address} dev {address.interface}"])
+
+            for route in sorted(state.routes, key=str):
+                if route not in current.routes or (route.netns, route.interface) in recreate:
+                    table = f" table {route.table}" if route.table is not None else ""
+                    add(state, f"default route via {route.gateway}",
+                        [f"{ip(route.netns)} route replace default via {route.gateway} dev {route.interface}{table}"])
+
+            for rule in sorted(state.rules - current.rules, key=str):
+                add(state, f"rule fwmark {rule.fwmark}", [f"ip rule add fwmark {rule.fwmark} table {rule.table}"])
+
+        return plan
+
+    def apply(self, plan: Optional[ReconcilePlan] = None) -> ReconcilePlan:
+        start = time.monotonic()
+        plan = plan if plan is not None else self.plan()
+
+        # Removals are best effort, objects may vanish with others (e.g., bridge ports)
+        for change in plan.removals:
+            try:
+                for command in change.commands:
+                    run_fail_on_error(command, sudo=True, dryrun=self.dryrun, log_debug=True)
+            except Exception as ex:
+                Logger.debug(f"Unable to remove {change.description}: {ex}")
+
+        for change in plan.additions:
+            for command in change.commands:
+                run_fail_on_error(command, sudo=True, dryrun=self.dryrun)
+
+        changes = len(plan.removals) + len(plan.additions)
+        if changes == 0 and not plan.bringup_missing:
+            Logger.info(f"Network state already up to date ({time.monotonic() - start:.2f} s)")
+        else:
+            Logger.info(f"Network state reconciled: {len(plan.removals)} removed, {len(plan.additions)} added, "
+                        f"{len(plan.bringup_missing)} left to bring-up ({time.monotonic() - start:.2f} s)")
+        return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Emulation Demonstrator Network Reconciler")
+    parser.add_argument("--mode", "-m", type=str, choices=[str(mode) for mode in OperationMode] + ["clean"],
+                        required=True, help="Operation mode to compare with, clean for none")
+    parser.add_argument("--apply", "-a", action="store_true", help="Apply the changes, bring-up changes excluded")
+    parser.add_argument("--state", "-s", action="store_true", help="Print the current state instead of the changes")
+    parser.add_argument("CONFIG", type=str, help="Path to config.json")
+    args = parser.parse_args()
+
+    mode = None if args.mode == "clean" else OperationMode.from_str(args.mode)
+    reconciler = Reconciler(FullConfig.from_json_file(args.CONFIG), mode, RIGHT_INTERFACE, LEFT_INTERFACE)
+
+    try:
+        state = reconciler.read()
+    except Exception as ex:
+        print(f"Unable to read network state: {ex}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.state:
+        for name, value in vars(state).items():
+            print(f"{name}:")
+            for entry in (sorted(value.items(), key=str) if isinstance(value, dict) else sorted(value, key=str)):
+                print(f"  {entry}")
+        sys.exit(0)
+
+    plan = reconciler.plan(state)
+    print(plan)
+    if args.apply:
+        reconciler.apply(plan)
@@ -0,0 +1,85 @@
+import time
+
+from threading import Lock
+from typing import Optional, Tuple
+
+from utils.theaterq import TheaterQState, TheaterQStage, TheaterQContMode
+
+
+class ReplayClock:
+    def __init__(self, tolerance: float = 0.05, tight_interval: float = 0.05,
+                 boundary_window: float = 0.5):
+        self.tolerance = int(tolerance * 1e9) # ns
+        self.tight_interval = tight_interval # s
+        self.boundary_window = boundary_window # s
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self, total_time: int = 0) -> None:
+        with self.lock:
+            self.stage = TheaterQStage.UNKNOWN
+            self.contmode = TheaterQContMode.LOOP
+            self.total_time = total_time
+            self.anchor_time: Optional[float] = None
+            self.anchor_position = 0
+
+    def __position(self, now: float) -> int:
+        if self.stage == TheaterQStage.FINISH:
+            return self.total_time if self.contmode == TheaterQContMode.HOLD else 0
+
+        if self.stage != TheaterQStage.RUN or self.anchor_time is None:
+            return self.anchor_position
+
+        position = self.anchor_position + int((now - self.anchor_time) * 1e9)
+        if self.total_time <= 0:
+            return position
+
+        if self.contmode == TheaterQContMode.LOOP:
+            return position % self.total_time
+
+        return min(position, self.total_time)
+
+    def reconcile(self, state: TheaterQState, now: Optional[float] = None) -> bool:
+        # 'now' should be the midpoint of the query, returns True on stage changes
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            changed = state.stage != self.stage
+            expected = self.__position(now)
+
+            self.stage = state.stage
+            self.contmode = state.contmode
+            if state.total_time > 0:
+                self.total_time = state.total_time
+
+            if changed or self.anchor_time is None or abs(expected - state.position_time) > self.tolerance:
+                self.anchor_time = now
+                self.anchor_position = state.position_time
+
+            return changed
+
+    def position(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return self.__position(now)
+
+    def snapshot(self, now: Optional[float] = None) -> Tuple[TheaterQStage, int, int]:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return self.stage, self.__position(now), self.total_time
+
+    def next_poll(self, sparse_interval: float, now: Optional[float] = None) -> float:
+        # Tight polling while a transition is imminent, sparse otherwise
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.stage == TheaterQStage.ARM or self.anchor_time is None:
+                return self.tight_interval
+
+            if self.stage != TheaterQStage.RUN or self.total_time <= 0:
+                return sparse_interval
+
+            # LOOP wraps and HOLD/CLEAN finishes both happen at the end of the trace
+            remaining = (self.total_time - self.__position(now)) / 1e9
+            if remaining <= self.boundary_window:
+                return self.tight_interval
+
+            return min(sparse_interval, remaining - self.boundary_window)
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from utils.logger import Logger
+from constants import REPLAY_STATE_PATH
+
+
+@dataclass
+class ReplayState:
+    # Written when a replay starts and removed when it is stopped. A frontend
+    # started while the file exists attaches to the running TheaterQ instances
+    # instead of replacing them. Kept in tmpfs, so it does not survive a reboot,
+    # just like the qdiscs.
+    scenario: str # Name in the scenario list of the data provider
+    contmode: str
+    armed: bool
+    links: List[str] = field(default_factory=list)
+    started: float = field(default_factory=time.time)
+
+    def save(self, path: str = REPLAY_STATE_PATH) -> None:
+        # Replaced atomically, a crash never leaves a partial file
+        temp = f"{path}.tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as handle:
+                json.dump(asdict(self), handle)
+            os.replace(temp, path)
+        except Exception as ex:
+            Logger.warning(f"Unable to persist replay state: {ex}")
+
+    @staticmethod
+    def load(path: str = REPLAY_STATE_PATH) -> Optional["ReplayState"]:
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                return ReplayState(**json.load(handle))
+        except Exception as ex:
+            Logger.warning(f"Ignoring invalid replay state {path}: {ex}")
+            ReplayState.clear(path)
+            return None
+
+    @staticmethod
+    def clear(path: str = REPLAY_STATE_PATH) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            Logger.warning(f"Unable to remove replay state: {ex}")
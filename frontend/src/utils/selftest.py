@@ -0,0 +1,423 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+from dataclasses import dataclass, asdict, field
+from typing import Callable, List, Optional
+
+from models.config import CpuConfig
+from models.scenario import ScenarioConfig
+from models.trace import Trace, TraceField, ResamplePolicy
+from utils.logger import Logger
+from utils.theaterq import TheaterQHandler, TheaterQDualLinkSettings, TheaterQContMode
+from utils.cpu_isolation import CpuIsolation
+from utils.utils import run_fail_on_error, run_log_on_error
+
+
+U32_MAX = 4294967295
+PROBE_PORT = 47000
+BULK_PORT = 47001
+PROBE_HEADER = struct.Struct("!IQ") # sequence, send time (ns, CLOCK_MONOTONIC)
+BULK_PAYLOAD = 1200 # bytes
+
+
+class VethHarness:
+    # left ns --- veth --- host (TheaterQ on both host ends) --- veth --- right ns
+    def __init__(self, prefix: str = "tqst", subnet: str = "10.199"):
+        self.left_ns = f"{prefix}-left"
+        self.right_ns = f"{prefix}-right"
+        self.left_host = f"{prefix}-l1"
+        self.left_peer = f"{prefix}-l0"
+        self.right_host = f"{prefix}-r1"
+        self.right_peer = f"{prefix}-r0"
+        self.left_gateway = f"{subnet}.1.1"
+        self.right_gateway = f"{subnet}.2.1"
+        self.left_address = f"{subnet}.1.2"
+        self.right_address = f"{subnet}.2.2"
+
+    def setup(self) -> None:
+        self.teardown()
+
+        def exec_in(netns: Optional[str], cmd: str) -> None:
+            prefix = f"ip netns exec {netns} " if netns is not None else ""
+            run_fail_on_error(prefix + cmd, sudo=True, log_debug=True)
+
+        exec_in(None, "sysctl -w net.ipv4.ip_forward=1")
+        for netns, host, peer, gateway, address in [
+                (self.left_ns, self.left_host, self.left_peer, self.left_gateway, self.left_address),
+                (self.right_ns, self.right_host, self.right_peer, self.right_gateway, self.right_address)]:
+            exec_in(None, f"ip netns add {netns}")
+            exec_in(None, f"ip link add {host} type veth peer name {peer} netns {netns}")
+            # IPv6 autoconfiguration traffic would trigger an armed TheaterQ instance
+            exec_in(None, f"sysctl -w net.ipv6.conf.{host}.disable_ipv6=1")
+            exec_in(netns, f"sysctl -w net.ipv6.conf.{peer}.disable_ipv6=1")
+            exec_in(None, f"ip addr add {gateway}/24 dev {host}")
+            exec_in(None, f"ip link set up dev {host}")
+            exec_in(netns, "ip link set up dev lo")
+            exec_in(netns, f"ip addr add {address}/24 dev {peer}")
+            exec_in(netns, f"ip link set up dev {peer}")
+            exec_in(netns, f"ip route add default via {gateway}")
+
+    def teardown(self) -> None:
+        # Deleting the namespaces also removes the veth pairs
+        for netns in [self.left_ns, self.right_ns]:
+            run_log_on_error(f"ip netns del {netns}", sudo=True, log_debug=True)
+
+    @staticmethod
+    def run_in(netns: str, target: Callable, *args) -> threading.Thread:
+        def wrapper():
+            # setns only affects the calling thread
+            fd = os.open(f"/run/netns/{netns}", os.O_RDONLY)
+            try:
+                os.setns(fd, os.CLONE_NEWNET)
+            finally:
+                os.close(fd)
+            target(*args)
+
+        thread = threading.Thread(target=wrapper, daemon=True)
+        thread.start()
+        return thread
+
+
+class UDPReceiver:
+    def __init__(self, port: int, expect_header: bool):
+        self.port = port
+        self.expect_header = expect_header
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.sequence: List[int] = []
+        self.sent: List[int] = []
+        self.received: List[int] = []
+        self.sizes: List[int] = []
+
+    def __call__(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUFFORCE, 8 << 20)
+        sock.bind(("0.0.0.0", self.port))
+        sock.settimeout(0.2)
+        self.ready.set()
+
+        while not self.stop_event.is_set():
+            try:
+                data = sock.recv(65535)
+            except socket.timeout:
+                continue
+
+            self.received.append(time.monotonic_ns())
+            self.sizes.append(len(data))
+            if self.expect_header and len(data) >= PROBE_HEADER.size:
+                sequence, sent = PROBE_HEADER.unpack_from(data)
+                self.sequence.append(sequence)
+                self.sent.append(sent)
+
+        sock.close()
+
+
+class UDPSender:
+    def __init__(self, target: str, port: int, packet_rate: float, duration: float,
+                 payload: int = PROBE_HEADER.size):
+        self.target = target
+        self.port = port
+        self.packet_rate = packet_rate
+        self.duration = duration
+        self.payload = max(payload, PROBE_HEADER.size)
+        self.first_sent: Optional[int] = None
+        self.count = 0
+
+    def __call__(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        padding = bytes(self.payload - PROBE_HEADER.size)
+        interval = 1e9 / self.packet_rate
+        start = time.monotonic_ns()
+        end = start + int(self.duration * 1e9)
+
+        while True:
+            now = time.monotonic_ns()
+            if now >= end:
+                break
+
+            # Catch up in bursts if the scheduler woke us up late
+            due = int((now - start) / interval) + 1
+            while self.count < due:
+                sent = time.monotonic_ns()
+                if self.first_sent is None:
+                    self.first_sent = sent
+                try:
+                    sock.sendto(PROBE_HEADER.pack(self.count, sent) + padding, (self.target, self.port))
+                except OSError:
+                    pass # Local qdisc drops surface as ENOBUFS
+                self.count += 1
+
+            wait = start + self.count * interval - time.monotonic_ns()
+            if wait > 0:
+                time.sleep(wait / 1e9)
+
+        sock.close()
+
+
+def cpu_load(stop_event) -> None:
+    # Stand-in for GUI redraws and video decoding competing with the packet path
+    data = np.random.rand(256, 256)
+    while not stop_event.is_set():
+        np.fft.fft2(data)
+
+
+@dataclass
+class SegmentResult:
+    start: float # s
+    end: float # s
+    latency: float # ms, configured
+    latency_measured: float # ms
+    jitter_measured: float # ms (stddev of the one-way delay)
+    loss: float # %, configured
+    loss_measured: float # %
+    rate: float # Mbps, configured
+    rate_measured: float # Mbps
+
+
+@dataclass
+class SelfTestReport:
+    scenario: str
+    segment: float
+    probes: int
+    isolation: Optional[str] = None # CPU isolation report, None if not applied
+    load: int = 0 # Processes generating CPU load
+    segments: List[SegmentResult] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        if len(self.segments) == 0:
+            return {}
+
+        latency_error = np.array([abs(s.latency_measured - s.latency) for s in self.segments])
+        loss_error = np.array([abs(s.loss_measured - s.loss) for s in self.segments])
+        rates = np.array([s.rate_measured / s.rate for s in self.segments if s.rate > 0])
+        jitter = np.array([s.jitter_measured for s in self.segments])
+        return {
+            "latency_error_mean_ms": float(np.nanmean(latency_error)),
+            "latency_error_max_ms": float(np.nanmax(latency_error)),
+            "jitter_mean_ms": float(np.nanmean(jitter)),
+            "jitter_max_ms": float(np.nanmax(jitter)),
+            "loss_error_mean_pct": float(np.nanmean(loss_error)),
+            "rate_ratio_median": float(np.nanmedian(rates)) if len(rates) > 0 else None,
+        }
+
+    def print(self) -> None:
+        print(f"{'segment (s)':>16}{'lat cfg':>10}{'lat meas':>10}{'jitter':>9}"
+              f"{'loss cfg':>10}{'loss meas':>10}{'rate cfg':>10}{'rate meas':>10}")
+        for s in self.segments:
+            print(f"{s.start:>7.1f} - {s.end:<6.1f}{s.latency:>10.2f}{s.latency_measured:>10.2f}"
+                  f"{s.jitter_measured:>9.2f}{s.loss:>10.2f}{s.loss_measured:>10.2f}"
+                  f"{s.rate:>10.2f}{s.rate_measured:>10.2f}")
+        print(json.dumps(self.summary(), indent=4))
+
+
+class SelfTest:
+    def __init__(self, scenario: ScenarioConfig, segment: float = 1.0,
+                 duration: Optional[float] = None, probe_rate: float = 200.0,
+                 harness: Optional[VethHarness] = None, isolation: Optional[CpuConfig] = None,
+                 load: int = 0):
+        self.scenario = scenario
+        self.segment = segment
+        self.probe_rate = probe_rate
+        self.harness = harness or VethHarness()
+        self.isolation = isolation
+        self.load = load
+        self.forward = scenario.forward_trace
+        self.duration = self.forward.get_length_us() / 1e6
+        if duration is not None:
+            self.duration = min(duration, self.duration)
+
+    def __replay(self, handler: TheaterQHandler, sender: UDPSender, receiver: UDPReceiver) -> None:
+        handler.update(TheaterQDualLinkSettings(self.scenario.forward_trace,
+                                                self.scenario.return_trace,
+                                                contmode=TheaterQContMode.HOLD))
+        # Armed: the first probe packet starts the replay, this aligns both time axes
+        handler.start(arm=True)
+
+        receiver_thread = VethHarness.run_in(self.harness.right_ns, receiver)
+        receiver.ready.wait(timeout=5)
+        sender_thread = VethHarness.run_in(self.harness.left_ns, sender)
+        sender_thread.join()
+
+        # Wait for packets still delayed by the emulated link
+        time.sleep(max(1.0, float(self.forward[TraceField.LATENCY].max()) / 1e9 + 0.5))
+        receiver.stop_event.set()
+        receiver_thread.join()
+        handler.stop()
+
+    def __warmup(self) -> None:
+        # Resolve neighbors before TheaterQ is armed
+        receiver = UDPReceiver(PROBE_PORT, expect_header=True)
+        thread = VethHarness.run_in(self.harness.right_ns, receiver)
+        receiver.ready.wait(timeout=5)
+        VethHarness.run_in(self.harness.left_ns,
+                           UDPSender(self.harness.right_address, PROBE_PORT, 10, 0.3)).join()
+        receiver.stop_event.set()
+        thread.join()
+
+    def __start_load(self, isolation: Optional[CpuIsolation]) -> List[multiprocessing.Process]:
+        # With isolation, the load is confined to the GUI CPUs like the frontend,
+        # the probe endpoints are not pinned, they stand in for external hosts
+        workers = []
+        for _ in range(self.load):
+            worker = multiprocessing.Process(target=cpu_load, args=(self.stop_load,), daemon=True)
+            worker.start()
+            if isolation is not None:
+                isolation.pin(worker.pid)
+            workers.append(worker)
+        return workers
+
+    def run(self) -> SelfTestReport:
+        self.harness.setup()
+        handler = None
+        isolation = None
+        report = None
+        self.stop_load = multiprocessing.Event()
+        workers = []
+        try:
+            if self.isolation is not None:
+                isolation = CpuIsolation(self.isolation, [self.harness.left_host, self.harness.right_host])
+                report = isolation.apply(pin_process=False)
+                Logger.info(f"Self-test: CPU isolation: {report}")
+            workers = self.__start_load(isolation)
+
+            self.__warmup()
+            handler = TheaterQHandler(forward_interface=self.harness.right_host,
+                                      return_interface=self.harness.left_host)
+
+            Logger.info("Self-test: latency and loss pass")
+            probe_sender = UDPSender(self.harness.right_address, PROBE_PORT, self.probe_rate, self.duration)
+            probe_receiver = UDPReceiver(PROBE_PORT, expect_header=True)
+            self.__replay(handler, probe_sender, probe_receiver)
+
+            # Saturate the link with 1.5 times the highest configured rate
+            Logger.info("Self-test: rate pass")
+            peak = float(self.forward[TraceField.RATE].max())
+            bulk_rate = max(1000.0, 1.5 * peak / (BULK_PAYLOAD * 8)) if peak > 0 else 10000.0
+            bulk_sender = UDPSender(self.harness.right_address, BULK_PORT, bulk_rate,
+                                    self.duration, payload=BULK_PAYLOAD)
+            bulk_receiver = UDPReceiver(BULK_PORT, expect_header=False)
+            self.__replay(handler, bulk_sender, bulk_receiver)
+
+            result = self.__analyze(probe_sender, probe_receiver, bulk_sender, bulk_receiver)
+            result.isolation = str(report) if report is not None else None
+            result.load = self.load
+            return result
+        finally:
+            self.stop_load.set()
+            for worker in workers:
+                worker.join()
+            if isolation is not None:
+                isolation.restore()
+            if handler is not None:
+                handler.clean()
+            self.harness.teardown()
+
+    def __analyze(self, probe_sender: UDPSender, probe_receiver: UDPReceiver,
+                  bulk_sender: UDPSender, bulk_receiver: UDPReceiver) -> SelfTestReport:
+        segments = self.forward.resample(int(self.segment * 1e6), ResamplePolicy.MEAN)
+        ends = segments.end_times() * 1000 # ns
+        starts = ends - segments[TraceField.KEEP] * 1000
+
+        # Probe send times of all probes are implied by the constant send rate
+        probe_offsets = np.arange(probe_sender.count) * (1e9 / self.probe_rate)
+        probe_segment = np.searchsorted(ends, probe_offsets, side="right")
+        received = np.zeros(probe_sender.count, dtype=bool)
+        delay = np.full(probe_sender.count, np.nan)
+        if len(probe_receiver.sequence) > 0:
+            sequence = np.array(probe_receiver.sequence)
+            valid = sequence < probe_sender.count
+            received[sequence[valid]] = True
+            delay[sequence[valid]] = (np.array(probe_receiver.received)[valid] -
+                                      np.array(probe_receiver.sent)[valid]) / 1e6 # ms
+
+        bulk_start = bulk_sender.first_sent or 0
+        bulk_offsets = np.array(bulk_receiver.received, dtype=np.float64) - bulk_start
+        bulk_bytes = np.array(bulk_receiver.sizes, dtype=np.float64)
+        bulk_segment = np.searchsorted(ends, bulk_offsets, side="right")
+
+        report = SelfTestReport(scenario=self.scenario.name, segment=self.segment,
+                                probes=probe_sender.count)
+        for index in range(len(segments)):
+            if starts[index] >= self.duration * 1e9:
+                break
+
+            length = (min(ends[index], self.duration * 1e9) - starts[index]) / 1e9
+            in_segment = probe_segment == index
+            segment_delay = delay[in_segment & received]
+            measured_bits = bulk_bytes[bulk_segment == index].sum() * 8
+
+            report.segments.append(SegmentResult(
+                start=starts[index] / 1e9,
+                end=starts[index] / 1e9 + length,
+                latency=segments[TraceField.LATENCY][index] / 1e6,
+                latency_measured=float(np.mean(segment_delay)) if len(segment_delay) > 0 else float("nan"),
+                jitter_measured=float(np.std(segment_delay)) if len(segment_delay) > 0 else float("nan"),
+                loss=segments[TraceField.LOSS][index] / U32_MAX * 100,
+                loss_measured=float(100 * (1 - received[in_segment].mean())) if in_segment.any() else float("nan"),
+                rate=segments[TraceField.RATE][index] / 1e6,
+                rate_measured=measured_bits / max(length, 1e-9) / 1e6))
+
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="TheaterQ Self-Test")
+    parser.add_argument("SCENARIO", type=str, help="Path to scenario JSON")
+    parser.add_argument("--segment", "-s", type=float, default=1.0, help="Report segment length in seconds")
+    parser.add_argument("--duration", "-t", type=float, default=None, help="Limit the replay to the first seconds")
+    parser.add_argument("--probe-rate", "-r", type=float, default=200.0, help="Latency probes per second")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the report as JSON to this path")
+    parser.add_argument("--max-latency-error", type=float, default=None,
+                        help="Fail if the mean latency error (ms) exceeds this value")
+    parser.add_argument("--min-rate-ratio", type=float, default=None,
+                        help="Fail if the median measured/configured rate ratio is below this value")
+    parser.add_argument("--isolation", "-i", type=str, choices=["off", "on", "compare"], default="off",
+                        help="Apply the CPU isolation of the frontend, compare: run without and with it")
+    parser.add_argument("--gui-cpus", type=int, nargs="+", default=[0], help="CPUs of the GUI and the load")
+    parser.add_argument("--fifo", action="store_true", help="Use SCHED_FIFO for the packet path")
+    parser.add_argument("--load", "-l", type=int, default=0, help="Number of processes generating CPU load")
+    args = parser.parse_args()
+
+    scenario = ScenarioConfig.from_json_file(args.SCENARIO)
+    cpu = CpuConfig(gui_cpus=args.gui_cpus, fifo=args.fifo)
+    passes = {"off": [None], "on": [cpu], "compare": [None, cpu]}[args.isolation]
+
+    reports = []
+    for isolation in passes:
+        report = SelfTest(scenario, segment=args.segment, duration=args.duration,
+                          probe_rate=args.probe_rate, isolation=isolation, load=args.load).run()
+        report.print()
+        reports.append(report)
+
+    if len(reports) > 1:
+        baseline, isolated = reports[0].summary(), reports[1].summary()
+        for key in ["jitter_mean_ms", "jitter_max_ms"]:
+            print(f"{key}: {baseline.get(key, float('nan')):.3f} without, "
+                  f"{isolated.get(key, float('nan')):.3f} with CPU isolation")
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump({"report": asdict(report), "summary": report.summary(),
+                       "baseline": {"report": asdict(reports[0]), "summary": reports[0].summary()}
+                                   if len(reports) > 1 else None}, handle, indent=4)
+
+    summary = report.summary()
+    failed = False
+    if args.max_latency_error is not None and summary.get("latency_error_mean_ms", 0) > args.max_latency_error:
+        Logger.error(f"Mean latency error exceeds {args.max_latency_error} ms")
+        failed = True
+    if args.min_rate_ratio is not None and (summary.get("rate_ratio_median") or 0) < args.min_rate_ratio:
+        Logger.error(f"Median rate ratio below {args.min_rate_ratio}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
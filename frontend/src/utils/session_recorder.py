@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import json
+import os
+import queue
+import re
+import time
+import numpy as np
+
+from datetime import datetime
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
+
+from models.trace import Trace, TraceField
+from utils.logger import Logger
+from utils.theaterq import TheaterQState, TheaterQStage, TheaterQQdiscStats
+
+
+SESSION_FORMAT_VERSION = 1
+SESSION_META_FILE = "session.json"
+SESSION_DATA_FILE = "samples.bin"
+
+STAGES: List[TheaterQStage] = list(TheaterQStage)
+LINK_FIELDS = [("latency", TraceField.LATENCY), ("jitter", TraceField.JITTER),
+               ("rate", TraceField.RATE), ("loss", TraceField.LOSS),
+               ("limit", TraceField.LIMIT)]
+COUNTER_FIELDS = ["bytes", "packets", "drops", "overlimits", "backlog", "qlen"]
+
+
+def build_record_dtype() -> np.dtype:
+    fields = [("wall_time", "<f8"), ("stage", "u1"),
+              ("position_time", "<i8"), ("position_count", "<i8")]
+    for direction in ["forward", "return"]:
+        fields += [(f"{direction}_{name}", "<i8") for name, _ in LINK_FIELDS]
+        fields += [(f"{direction}_{name}", "<u8") for name in COUNTER_FIELDS]
+    return np.dtype(fields)
+
+
+SESSION_RECORD = build_record_dtype()
+
+
+class SessionRecorder:
+    def __init__(self, path: str, scenario_name: str, forward_trace: Trace,
+                 return_trace: Trace, metadata: Optional[Dict] = None,
+                 fsync_interval: float = 10.0, batch_size: int = 64, queue_size: int = 1024):
+        self.path = path
+        self.forward_trace = forward_trace
+        self.return_trace = return_trace
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        # Bounded, samples are dropped (and counted) if the writer falls behind
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.thread: Optional[Thread] = None
+        self.dropped = 0
+        self.failed = False
+
+        self.metadata = {
+            "version": SESSION_FORMAT_VERSION,
+            "scenario": scenario_name,
+            "start": time.time(),
+            "end": None,
+            "records": 0,
+            "dropped": 0,
+            "stages": [str(stage) for stage in STAGES],
+        }
+        self.metadata.update(metadata or {})
+
+    @staticmethod
+    def create_session_path(basepath: str, scenario_name: str) -> str:
+        slug = re.sub(r"[^a-z0-9]+", "-", scenario_name.lower()).strip("-")
+        path = os.path.join(basepath, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{slug}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def start(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        self.__write_metadata()
+        self.failed = False
+        self.thread = Thread(target=self.__writer_thread_fn, daemon=True)
+        self.thread.start()
+        Logger.info(f"Recording replay session to {self.path}")
+
+    def record(self, state: TheaterQState) -> None:
+        # Called from the replay loop: only hand over, all work is done by the writer
+        thread = self.thread
+        if thread is None or not thread.is_alive():
+            if not self.failed:
+                self.failed = True
+                Logger.error(f"Session writer for {self.path} is not running, samples are discarded")
+            return
+
+        try:
+            self.queue.put_nowait((time.time(), state))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        if self.thread is None:
+            return
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+
+        if self.dropped > 0:
+            Logger.warning(f"Replay session dropped {self.dropped} samples, the writer fell behind")
+
+    def __write_metadata(self) -> None:
+        temp = os.path.join(self.path, SESSION_META_FILE + ".tmp")
+        with open(temp, "w", encoding="utf-8") as handle:
+            json.dump(self.metadata, handle, indent=4)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp, os.path.join(self.path, SESSION_META_FILE))
+
+    @staticmethod
+    def __fill_direction(record: np.void, direction: str, trace: Trace,
+                         position: int, stats: Optional[TheaterQQdiscStats]) -> None:
+        if len(trace) > 0:
+            entry = trace.data[min(max(position, 0), len(trace) - 1)]
+            for name, field in LINK_FIELDS:
+                record[f"{direction}_{name}"] = entry[field]
+
+        if stats is not None:
+            for name in COUNTER_FIELDS:
+                record[f"{direction}_{name}"] = getattr(stats, name)
+
+    def __writer_thread_fn(self) -> None:
+        forward = self.forward_trace
+        reverse = self.return_trace
+        end_times = forward.end_times() if len(forward) > 0 else reverse.end_times()
+        batch = np.zeros(self.batch_size, dtype=SESSION_RECORD)
+        filled = 0
+        last_sync = time.monotonic()
+
+        with open(os.path.join(self.path, SESSION_DATA_FILE), "ab", buffering=1 << 16) as handle:
+            def flush(sync: bool) -> None:
+                nonlocal filled, last_sync
+                if filled > 0:
+                    handle.write(batch[:filled].tobytes())
+                    self.metadata["records"] += filled
+                    filled = 0
+
+                if sync:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                    last_sync = time.monotonic()
+
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.fsync_interval)
+                except queue.Empty:
+                    item = False
+
+                if item is None:
+                    break
+
+                if item:
+                    wall_time, state = item
+                    batch[filled] = 0
+                    record = batch[filled]
+                    record["wall_time"] = wall_time
+                    stage = state.stage if isinstance(state.stage, TheaterQStage) \
+                        else TheaterQStage.from_str(state.stage)
+                    record["stage"] = STAGES.index(stage)
+                    record["position_time"] = state.position_time
+                    # Samples between kernel queries only carry the clock position
+                    position_count = state.position_count if state.position_count >= 0 else \
+                        int(np.searchsorted(end_times, state.position_time // 1000, side="right"))
+                    record["position_count"] = position_count
+                    SessionRecorder.__fill_direction(record, "forward", forward,
+                                                     position_count, state.forward_stats)
+                    SessionRecorder.__fill_direction(record, "return", reverse,
+                                                     position_count, state.return_stats)
+                    filled += 1
+
+                if filled == self.batch_size:
+                    flush(sync=False)
+
+                if time.monotonic() - last_sync >= self.fsync_interval:
+                    flush(sync=True)
+
+            flush(sync=True)
+
+        self.metadata["end"] = time.time()
+        self.metadata["dropped"] = self.dropped
+        self.__write_metadata()
+        Logger.info(f"Replay session recorded: {self.metadata['records']} samples")
+
+
+def load_session(path: str) -> Tuple[Dict, np.ndarray]:
+    with open(os.path.join(path, SESSION_META_FILE), "r", encoding="utf-8") as handle:
+        metadata = json.load(handle)
+
+    if metadata.get("version") != SESSION_FORMAT_VERSION:
+        raise Exception(f"Unsupported session format version: {metadata.get('version')}")
+
+    # A crash may leave a partially written record at the end of the file
+    raw = np.fromfile(os.path.join(path, SESSION_DATA_FILE), dtype=np.uint8)
+    usable = raw.size - raw.size % SESSION_RECORD.itemsize
+    return metadata, raw[:usable].view(SESSION_RECORD)
+
+
+def export_csv(records: np.ndarray, metadata: Dict, output: str) -> None:
+    stages = metadata["stages"]
+    with open(output, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(SESSION_RECORD.names)
+        for row in records.tolist():
+            row = list(row)
+            row[0] = f"{row[0]:.6f}"
+            row[1] = stages[row[1]]
+            writer.writerow(row)
+
+
+def export_parquet(records: np.ndarray, metadata: Dict, output: str) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Parquet export requires pyarrow (python3-pyarrow).")
+
+    columns = {name: records[name] for name in SESSION_RECORD.names}
+    columns["stage"] = np.array(metadata["stages"])[records["stage"]]
+    table = pa.table(columns).replace_schema_metadata({"session": json.dumps(metadata)})
+    pq.write_table(table, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Session Export")
+    parser.add_argument("SESSION", type=str, help="Path to a recorded session directory")
+    parser.add_argument("--format", "-f", choices=["csv", "parquet"], type=str, default="csv",
+                        help="Export format")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Output file")
+    args = parser.parse_args()
+
+    metadata, records = load_session(args.SESSION)
+    output = args.output or os.path.join(args.SESSION, f"samples.{args.format}")
+
+    if args.format == "csv":
+        export_csv(records, metadata, output)
+    else:
+        export_parquet(records, metadata, output)
+
+    print(f"Exported {len(records)} samples of '{metadata['scenario']}' to {output}")
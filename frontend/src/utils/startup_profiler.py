@@ -0,0 +1,71 @@
+import os
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterator, List
+
+from utils.logger import Logger
+
+
+@dataclass
+class StartupPhase:
+    name: str
+    start: float # s since process start
+    end: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class StartupProfiler:
+    def __init__(self):
+        self.origin = StartupProfiler.__process_start()
+        self.lock = Lock()
+        self.phases: List[StartupPhase] = []
+        self.last = 0.0
+        self.mark("interpreter")
+
+    @staticmethod
+    def __process_start() -> float:
+        # Start of this process on the monotonic clock, includes interpreter startup.
+        # /proc/self/stat field 22 is the start time after boot in clock ticks.
+        try:
+            with open("/proc/self/stat", "r") as handle:
+                fields = handle.read().rsplit(")", 1)[1].split()
+            started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+            elapsed = time.clock_gettime(time.CLOCK_BOOTTIME) - started
+            return time.monotonic() - max(elapsed, 0.0)
+        except Exception:
+            return time.monotonic()
+
+    def now(self) -> float:
+        return time.monotonic() - self.origin
+
+    def mark(self, name: str) -> None:
+        # Sequential phase from the previous mark until now
+        with self.lock:
+            end = self.now()
+            self.phases.append(StartupPhase(name, self.last, end))
+            self.last = end
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # Phase that may run in parallel to others
+        start = self.now()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append(StartupPhase(name, start, self.now()))
+
+    def report(self) -> None:
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase.start)
+
+        details = ", ".join(f"{phase.name} {phase.duration:.2f} s" for phase in phases)
+        Logger.info(f"Startup finished after {self.now():.2f} s ({details})")
+        for phase in phases:
+            Logger.debug(f"Startup phase '{phase.name}': {phase.start:.3f} s - {phase.end:.3f} s")
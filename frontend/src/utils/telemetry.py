@@ -0,0 +1,111 @@
+import time
+import numpy as np
+
+from enum import IntEnum
+from threading import Lock
+from typing import Optional
+
+from utils.theaterq import TheaterQState, TheaterQQdiscStats
+
+
+class TelemetryChannel(IntEnum):
+    POSITION = 0            # s (trace time)
+    FORWARD_RATE = 1        # bps
+    FORWARD_PPS = 2         # pkts/s
+    FORWARD_DROPS = 3       # drops/s
+    FORWARD_OVERLIMITS = 4  # overlimits/s
+    FORWARD_BACKLOG = 5     # bytes
+    FORWARD_QLEN = 6        # pkts
+    RETURN_RATE = 7
+    RETURN_PPS = 8
+    RETURN_DROPS = 9
+    RETURN_OVERLIMITS = 10
+    RETURN_BACKLOG = 11
+    RETURN_QLEN = 12
+
+
+class TelemetryRingBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, len(TelemetryChannel)), dtype=np.float64)
+        self.head = 0
+        self.size = 0
+
+    def append(self, row: np.ndarray) -> None:
+        self.data[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def clear(self) -> None:
+        self.head = 0
+        self.size = 0
+
+    def snapshot(self) -> np.ndarray:
+        if self.size < self.capacity:
+            return self.data[:self.size].copy()
+
+        return np.roll(self.data, -self.head, axis=0)
+
+
+class TelemetrySampler:
+    def __init__(self, capacity: int = 3600):
+        self.buffer = TelemetryRingBuffer(capacity)
+        self.lock = Lock()
+        self.previous: Optional[TheaterQState] = None
+        self.previous_time = 0.0
+
+    def reset(self) -> None:
+        with self.lock:
+            self.buffer.clear()
+            self.previous = None
+
+    @staticmethod
+    def __direction(current: TheaterQQdiscStats, previous: TheaterQQdiscStats,
+                    elapsed: float) -> Optional[list]:
+        deltas = [current.bytes - previous.bytes,
+                  current.packets - previous.packets,
+                  current.drops - previous.drops,
+                  current.overlimits - previous.overlimits]
+
+        # Counters only decrease if the qdisc was recreated in between
+        if min(deltas) < 0:
+            return None
+
+        return [deltas[0] * 8 / elapsed, deltas[1] / elapsed, deltas[2] / elapsed,
+                deltas[3] / elapsed, current.backlog, current.qlen]
+
+    def record(self, state: TheaterQState, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            previous, previous_time = self.previous, self.previous_time
+            self.previous, self.previous_time = state, now
+
+            if previous is None or state.forward_stats is None or state.return_stats is None \
+                    or previous.forward_stats is None or previous.return_stats is None:
+                return
+
+            # Restart the overlay when the replay loops or was restarted
+            if state.position_time < previous.position_time:
+                self.buffer.clear()
+
+            elapsed = now - previous_time
+            if elapsed <= 0:
+                return
+
+            forward = TelemetrySampler.__direction(state.forward_stats, previous.forward_stats, elapsed)
+            reverse = TelemetrySampler.__direction(state.return_stats, previous.return_stats, elapsed)
+            if forward is None or reverse is None:
+                return
+
+            self.buffer.append(np.array([state.position_time / 1e9] + forward + reverse))
+
+    def snapshot(self) -> np.ndarray:
+        with self.lock:
+            return self.buffer.snapshot()
+
+    def latest(self) -> Optional[np.ndarray]:
+        with self.lock:
+            if self.buffer.size == 0:
+                return None
+            return self.buffer.data[(self.buffer.head - 1) % self.buffer.capacity].copy()
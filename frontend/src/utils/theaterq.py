@@ -1,11 +1,15 @@
 import json
+import time
 
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
 
+from models.trace import Trace
 from utils.utils import run_fail_on_error, invoke_subprocess
+from utils.helper import HelperClient, write_trace
 from utils.logger import Logger
+from constants import THEATERQ_DEVICE_TEMPLATE
 
 
 class TheaterQContMode(Enum):
@@ -43,14 +47,34 @@ class TheaterQStage(Enum):
 
 @dataclass
 class TheaterQDualLinkSettings:
-    forward_trace: List[str]
-    return_trace: List[str]
+    forward_trace: Trace
+    return_trace: Trace
     contmode: TheaterQContMode
+    buffer: Optional[str] = None # TraceBuffer file both traces are views of
 
     def __str__(self) -> str:
         return f"TheaterQDualLinkSettings (forward={len(self.forward_trace)}, return={len(self.return_trace)}, mode={self.contmode})"
 
 
+@dataclass
+class TheaterQQdiscStats:
+    bytes: int = 0
+    packets: int = 0
+    drops: int = 0
+    overlimits: int = 0
+    backlog: int = 0 # bytes
+    qlen: int = 0 # pkts
+
+    @staticmethod
+    def from_json(entry: dict) -> "TheaterQQdiscStats":
+        return TheaterQQdiscStats(bytes=entry.get("bytes", 0),
+                                  packets=entry.get("packets", 0),
+                                  drops=entry.get("drops", 0),
+                                  overlimits=entry.get("overlimits", 0),
+                                  backlog=entry.get("backlog", 0),
+                                  qlen=entry.get("qlen", 0))
+
+
 @dataclass
 class TheaterQState:
     stage: TheaterQStage
@@ -59,18 +83,23 @@ class TheaterQState:
     position_count: int
     total_time: int
     total_count: int
+    forward_stats: Optional[TheaterQQdiscStats] = None
+    return_stats: Optional[TheaterQQdiscStats] = None
 
 
 class TheaterQHandler:
-    __THEATERQ_INIT_TEMPLATE = "tc qdisc add dev {dev} root handle {handle} theaterq stage LOAD syncgroup {syncgroup} ingest EXTENDED"
-    __THEATERQ_START_TEMPLATE = "tc qdisc change dev {dev} handle {handle} theaterq stage {runmode} cont {contmode}"
-    __THEATERQ_PREP_TEMPLATE = "tc qdisc change dev {dev} handle {handle} theaterq cont {contmode}"
-    __THEATERQ_STOP_TEMPLATE = "tc qdisc change dev {dev} handle {handle} theaterq stage CLEAR"
-    __THEATERQ_REMOVE_TEMPLATE = "tc qdisc del dev {dev} root handle {handle}"
-    __THEATERQ_INFO_TEMPLATE = "tc -j qdisc sh dev {dev} handle {handle}"
+    __THEATERQ_INIT_TEMPLATE = "{tc} qdisc add dev {dev} {attach} handle {handle} theaterq stage LOAD syncgroup {syncgroup} ingest EXTENDED"
+    __THEATERQ_START_TEMPLATE = "{tc} qdisc change dev {dev} handle {handle} theaterq stage {runmode} cont {contmode}"
+    __THEATERQ_PREP_TEMPLATE = "{tc} qdisc change dev {dev} handle {handle} theaterq cont {contmode}"
+    __THEATERQ_STOP_TEMPLATE = "{tc} qdisc change dev {dev} handle {handle} theaterq stage CLEAR"
+    __THEATERQ_REMOVE_TEMPLATE = "{tc} qdisc del dev {dev} {attach} handle {handle}"
+    __THEATERQ_INFO_TEMPLATE = "{tc} -s -j qdisc sh dev {dev} handle {handle}"
 
     def __init__(self, forward_interface: str, return_interface: str, 
-                 syncgroup: int = 1, handle: int = 1, dryrun: bool = False) -> None:
+                 syncgroup: int = 1, handle: int = 1, dryrun: bool = False,
+                 device_template: str = THEATERQ_DEVICE_TEMPLATE,
+                 tc_command: str = "tc", privileged: bool = True,
+                 parent: Optional[str] = None, adopt: bool = False) -> None:
         self.running = False
         self.settings: Optional[TheaterQDualLinkSettings] = None
         self.forward_interface = forward_interface
@@ -78,77 +107,112 @@ class TheaterQHandler:
         self.syncgroup = syncgroup
         self.handle = handle
         self.dryrun = dryrun
+        self.device_template = device_template
+        self.tc_command = tc_command
+        self.privileged = privileged
+        self.attach = "root" if parent is None else f"parent {parent}"
+
+        # A replay of a previous frontend instance keeps running, see ReplayState
+        self.adopted = adopt and self.__is_adoptable()
+        if self.adopted:
+            self.running = True
+            Logger.info(f"Attached to running TheaterQ on {self.forward_interface}/{self.return_interface}, "
+                        f"handle {self.handle}")
+            return
 
         self.clean()
         
-        cmd = self.__THEATERQ_INIT_TEMPLATE.format(dev=self.forward_interface,
+        cmd = self.__THEATERQ_INIT_TEMPLATE.format(tc=self.tc_command, dev=self.forward_interface,
+                                                   attach=self.attach,
                                                    handle=self.handle,
                                                    syncgroup=self.syncgroup)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
+        run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
 
-        cmd = self.__THEATERQ_INIT_TEMPLATE.format(dev=self.return_interface,
+        cmd = self.__THEATERQ_INIT_TEMPLATE.format(tc=self.tc_command, dev=self.return_interface,
+                                                   attach=self.attach,
                                                    handle=self.handle,
                                                    syncgroup=self.syncgroup)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
+        run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
         
     def __del__(self) -> None:
-        self.clean()
+        # Running replays are only ended by stop(), they survive a crashed frontend
+        if not self.running:
+            self.clean()
+
+    def __is_adoptable(self) -> bool:
+        try:
+            return self.is_qdisc_running()
+        except Exception:
+            return False
     
     def clean(self) -> None:
         if self.running:
             self.stop()
 
-        cmd = self.__THEATERQ_REMOVE_TEMPLATE.format(dev=self.forward_interface,
-                                                     handle=self.handle)
+        cmd = self.__THEATERQ_REMOVE_TEMPLATE.format(tc=self.tc_command, dev=self.forward_interface,
+                                                     attach=self.attach, handle=self.handle)
         try:
-            invoke_subprocess(cmd, capture_output=True, sudo=True, dryrun=self.dryrun)
+            invoke_subprocess(cmd, capture_output=True, sudo=self.privileged, dryrun=self.dryrun)
         except Exception: pass
 
-        cmd = self.__THEATERQ_REMOVE_TEMPLATE.format(dev=self.return_interface,
-                                                     handle=self.handle)
+        cmd = self.__THEATERQ_REMOVE_TEMPLATE.format(tc=self.tc_command, dev=self.return_interface,
+                                                     attach=self.attach, handle=self.handle)
         try:
-            invoke_subprocess(cmd, capture_output=True, sudo=True, dryrun=self.dryrun)
+            invoke_subprocess(cmd, capture_output=True, sudo=self.privileged, dryrun=self.dryrun)
         except Exception: pass
 
-    def __get_details(self, interface: str) -> TheaterQState:
-        cmd = self.__THEATERQ_INFO_TEMPLATE.format(dev=interface, handle=self.handle)
+    def __get_details(self, interface: str) -> Tuple[TheaterQState, TheaterQQdiscStats]:
+        cmd = self.__THEATERQ_INFO_TEMPLATE.format(tc=self.tc_command, dev=interface, handle=self.handle)
         try:
-            process = invoke_subprocess(cmd, capture_output=True, sudo=True, 
+            process = invoke_subprocess(cmd, capture_output=True, sudo=self.privileged, 
                                         dryrun=self.dryrun, log_debug=True)
 
             if process.returncode != 0:
                 raise Exception("Qdisc show command failed.")
             
             if self.dryrun:
+                # Fake 40 Mbps of 1250 byte packets with a slowly oscillating queue
+                now = time.monotonic()
+                packets = int(now * 4000)
                 return TheaterQState(stage=(TheaterQStage.RUN if self.settings is not None else TheaterQStage.CLEAR),
                                      contmode=(self.settings.contmode if self.settings is not None else TheaterQContMode.LOOP),
                                      position_count=100,
                                      position_time=100000000,
                                      total_count=1000,
-                                     total_time=1000000000)
+                                     total_time=1000000000), \
+                       TheaterQQdiscStats(bytes=packets * 1250,
+                                          packets=packets,
+                                          drops=int(now * 5),
+                                          qlen=int(now * 10) % 100,
+                                          backlog=(int(now * 10) % 100) * 1250)
             
             data = json.loads(process.stdout.decode("utf-8"))
 
+            # Leaf instances of a classful setup are not root, match by handle
             for entry in data:
-                if entry["kind"] == "theaterq" and entry["root"]:
+                if entry["kind"] == "theaterq" and entry["handle"] == f"{self.handle}:":
                     options = entry["options"]
                     return TheaterQState(stage=options["stage"],
                                          contmode=options["cont_mode"],
                                          position_time=options["position_time"],
                                          position_count=options["position"],
                                          total_time=options["entries_time"],
-                                         total_count=options["entries"])
+                                         total_count=options["entries"]), \
+                           TheaterQQdiscStats.from_json(entry)
             
             raise Exception("Unable to find theaterq qdisc.")
 
         except Exception as ex:
             raise Exception("Unable to retrieve qdisc stats!") from ex
         
-    def __load_trace_file(self, interface: str, trace: List[str]) -> None:
-        with open(f"/dev/theaterq:{interface}:{self.handle}:0", "w") as handle:
-            for entry in trace:
-                handle.write(entry + ("\n" if not entry.endswith("\n") else ""))
-                handle.flush()
+    def load_trace_file(self, interface: str, trace: Trace, buffer: Optional[str] = None,
+                        direction: str = "forward") -> None:
+        device = self.device_template.format(dev=interface, handle=self.handle)
+        if buffer is not None and self.privileged and HelperClient.available():
+            # The helper maps the same file, formatting does not hold the GIL of the GUI
+            HelperClient.upload(device, buffer, direction)
+            return
+        write_trace(device, trace)
 
     def update(self, settings: TheaterQDualLinkSettings) -> None:
         if self.running or self.is_qdisc_running():
@@ -161,14 +225,14 @@ class TheaterQHandler:
             return
 
         try:
-            self.__load_trace_file(self.forward_interface, settings.forward_trace)
-            self.__load_trace_file(self.return_interface, settings.return_trace)
+            self.load_trace_file(self.forward_interface, settings.forward_trace, settings.buffer, "forward")
+            self.load_trace_file(self.return_interface, settings.return_trace, settings.buffer, "reverse")
         except Exception as ex:
             raise Exception("Unable to load trace file") from ex
 
     def get_details(self) -> TheaterQState:
-        forward_instance = self.__get_details(self.forward_interface)
-        return_instance = self.__get_details(self.return_interface)
+        forward_instance, forward_stats = self.__get_details(self.forward_interface)
+        return_instance, return_stats = self.__get_details(self.return_interface)
 
         entries = max(forward_instance.position_count, return_instance.position_count)
         time = max(forward_instance.position_time, return_instance.position_time)
@@ -180,7 +244,9 @@ class TheaterQHandler:
                              position_count=entries,
                              position_time=time,
                              total_count=entries_total,
-                             total_time=time_total)
+                             total_time=time_total,
+                             forward_stats=forward_stats,
+                             return_stats=return_stats)
 
     def is_running(self) -> bool:
         return self.is_running
@@ -190,8 +256,8 @@ class TheaterQHandler:
             return False
 
         for interface in [self.forward_interface, self.return_interface]:
-            status = self.__get_details(interface)
-            if status.stage in [TheaterQStage.RUN, TheaterQStage.ARM, TheaterQStage.FINISH]:
+            status, _ = self.__get_details(interface)
+            if TheaterQStage.from_str(status.stage) in [TheaterQStage.RUN, TheaterQStage.ARM, TheaterQStage.FINISH]:
                 return True
             
         return False
@@ -200,34 +266,182 @@ class TheaterQHandler:
         if not self.running and not self.is_qdisc_running():
             return False
         
-        cmd = self.__THEATERQ_STOP_TEMPLATE.format(dev=self.forward_interface, 
+        cmd = self.__THEATERQ_STOP_TEMPLATE.format(tc=self.tc_command, dev=self.forward_interface, 
                                                    handle=self.handle)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
+        run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
 
-        cmd = self.__THEATERQ_STOP_TEMPLATE.format(dev=self.return_interface, 
+        cmd = self.__THEATERQ_STOP_TEMPLATE.format(tc=self.tc_command, dev=self.return_interface, 
                                                    handle=self.handle)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
+        run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
 
         self.settings = None
         self.running = False
         return True
 
-    def start(self, arm: bool = False) -> bool:
+    def prepare_start(self, followed: bool = False) -> bool:
         if self.settings is None or self.running or self.is_qdisc_running(fake=self.dryrun):
             return False
-        
-        cmd = self.__THEATERQ_PREP_TEMPLATE.format(dev=self.return_interface,
-                                                    handle=self.handle,
-                                                    contmode=self.settings.contmode)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
 
+        # Instances started by another member of their syncgroup also need the cont mode
+        interfaces = [self.return_interface, self.forward_interface] if followed else [self.return_interface]
+        for interface in interfaces:
+            cmd = self.__THEATERQ_PREP_TEMPLATE.format(tc=self.tc_command, dev=interface,
+                                                        handle=self.handle,
+                                                        contmode=self.settings.contmode)
+            run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
+
+        return True
+
+    def trigger_start(self, arm: bool = False, followed: bool = False) -> None:
         # We are in a syncgroup, only start forward one, rest will follow.
-        runmode = TheaterQStage.ARM if arm else TheaterQStage.RUN
-        cmd = self.__THEATERQ_START_TEMPLATE.format(dev=self.forward_interface,
-                                                    handle=self.handle,
-                                                    contmode=self.settings.contmode,
-                                                    runmode=runmode)
-        run_fail_on_error(cmd, sudo=True, dryrun=self.dryrun)
+        if not followed:
+            runmode = TheaterQStage.ARM if arm else TheaterQStage.RUN
+            cmd = self.__THEATERQ_START_TEMPLATE.format(tc=self.tc_command, dev=self.forward_interface,
+                                                        handle=self.handle,
+                                                        contmode=self.settings.contmode,
+                                                        runmode=runmode)
+            run_fail_on_error(cmd, sudo=self.privileged, dryrun=self.dryrun)
+
         self.running = True
-        
+
+    def start(self, arm: bool = False) -> bool:
+        if not self.prepare_start():
+            return False
+
+        self.trigger_start(arm)
         return True
+
+
+class TheaterQClassifier:
+    # Classful root on both interfaces: unmatched (management) traffic uses class 1:1
+    # without emulation, every traffic class gets its own TheaterQ leaf (1:2, 1:3, ...).
+    __ROOT_HANDLE = 1
+    __DEFAULT_CLASS = 1
+    __PRIO_BANDS_MAX = 16
+    __HTB_RATE = "100gbit"
+    __IP_PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17}
+
+    def __init__(self, forward_interface: str, return_interface: str, 
+                 root: str = "prio", filter_type: str = "flower",
+                 matches: Optional[List[dict]] = None, dryrun: bool = False,
+                 tc_command: str = "tc", privileged: bool = True) -> None:
+        self.forward_interface = forward_interface
+        self.return_interface = return_interface
+        self.root = root
+        self.filter_type = filter_type
+        self.matches = matches or []
+        self.dryrun = dryrun
+        self.tc_command = tc_command
+        self.privileged = privileged
+
+        if root == "prio" and len(self.matches) + 1 > self.__PRIO_BANDS_MAX:
+            raise Exception(f"prio supports at most {self.__PRIO_BANDS_MAX - 1} traffic classes")
+
+    @staticmethod
+    def leaf_handle(index: int) -> int:
+        # Handle 1 is the classful root
+        return index + 2
+
+    def class_id(self, index: int) -> str:
+        return f"{self.__ROOT_HANDLE}:{index + self.__DEFAULT_CLASS + 1:x}"
+
+    def __run(self, command: str) -> None:
+        run_fail_on_error(f"{self.tc_command} {command}", sudo=self.privileged, dryrun=self.dryrun)
+
+    @staticmethod
+    def __directional(match: dict, reverse: bool) -> dict:
+        # Matches are given for the forward direction, the return path sees swapped endpoints
+        if not reverse:
+            return match
+
+        swap = {"src_port": "dst_port", "dst_port": "src_port", "src": "dst", "dst": "src"}
+        return {swap.get(key, key): value for key, value in match.items()}
+
+    def __filter_commands(self, device: str, flowid: str, priority: int, match: dict) -> List[str]:
+        # 'port' matches either direction and requires two filters
+        if "port" in match:
+            rest = {key: value for key, value in match.items() if key != "port"}
+            return self.__filter_commands(device, flowid, priority, {**rest, "src_port": match["port"]}) + \
+                   self.__filter_commands(device, flowid, priority, {**rest, "dst_port": match["port"]})
+
+        prefix = f"filter add dev {device} parent {self.__ROOT_HANDLE}: protocol ip prio {priority}"
+        protocol = match.get("ip_proto")
+        if protocol is not None and protocol not in self.__IP_PROTOCOLS:
+            raise Exception(f"Unsupported ip_proto '{protocol}'")
+        if ("src_port" in match or "dst_port" in match) and protocol not in ["tcp", "udp"]:
+            raise Exception("Port matches require ip_proto tcp or udp")
+
+        if self.filter_type == "flower":
+            keys = []
+            if protocol is not None:
+                keys.append(f"ip_proto {protocol}")
+            for key in ["src_port", "dst_port"]:
+                if key in match:
+                    keys.append(f"{key} {int(match[key])}")
+            if "dscp" in match:
+                keys.append(f"ip_tos {int(match['dscp']) << 2:#x}/0xfc")
+            for key in ["src", "dst"]:
+                if key in match:
+                    keys.append(f"{key}_ip {match[key]}")
+            return [f"{prefix} flower {' '.join(keys)} flowid {flowid}"]
+
+        keys = []
+        if protocol is not None:
+            keys.append(f"match ip protocol {self.__IP_PROTOCOLS[protocol]} 0xff")
+        if "src_port" in match:
+            keys.append(f"match ip sport {int(match['src_port'])} 0xffff")
+        if "dst_port" in match:
+            keys.append(f"match ip dport {int(match['dst_port'])} 0xffff")
+        if "dscp" in match:
+            keys.append(f"match ip tos {int(match['dscp']) << 2:#x} 0xfc")
+        for key in ["src", "dst"]:
+            if key in match:
+                keys.append(f"match ip {key} {match[key]}")
+        return [f"{prefix} u32 {' '.join(keys)} flowid {flowid}"]
+
+    def is_installed(self) -> bool:
+        # Root qdiscs left by a previous frontend instance, see ReplayState
+        if self.dryrun:
+            return False
+
+        for device in [self.forward_interface, self.return_interface]:
+            process = invoke_subprocess(f"{self.tc_command} -j qdisc show dev {device} root", capture_output=True,
+                                        sudo=self.privileged, log_debug=True)
+            if process.returncode != 0:
+                return False
+
+            entries = json.loads(process.stdout.decode("utf-8"))
+            if not any(entry["kind"] == self.root and entry["handle"] == f"{self.__ROOT_HANDLE}:" for entry in entries):
+                return False
+
+        return True
+
+    def install(self) -> None:
+        self.clean()
+
+        for device, reverse in [(self.forward_interface, False), (self.return_interface, True)]:
+            if self.root == "prio":
+                bands = len(self.matches) + 1
+                # All TOS values map to the default band, only filters select the others
+                priomap = " ".join(["0"] * 16)
+                self.__run(f"qdisc add dev {device} root handle {self.__ROOT_HANDLE}: prio bands {bands} priomap {priomap}")
+            else:
+                self.__run(f"qdisc add dev {device} root handle {self.__ROOT_HANDLE}: htb default {self.__DEFAULT_CLASS}")
+                self.__run(f"class add dev {device} parent {self.__ROOT_HANDLE}: classid {self.__ROOT_HANDLE}:{self.__DEFAULT_CLASS} "
+                           f"htb rate {self.__HTB_RATE}")
+                for index in range(len(self.matches)):
+                    # TheaterQ shapes itself, HTB must never be the bottleneck
+                    self.__run(f"class add dev {device} parent {self.__ROOT_HANDLE}: classid {self.class_id(index)} "
+                               f"htb rate {self.__HTB_RATE}")
+
+            for index, match in enumerate(self.matches):
+                for command in self.__filter_commands(device, self.class_id(index), index + 1,
+                                                      TheaterQClassifier.__directional(match, reverse)):
+                    self.__run(command)
+
+    def clean(self) -> None:
+        for device in [self.forward_interface, self.return_interface]:
+            try:
+                invoke_subprocess(f"{self.tc_command} qdisc del dev {device} root", capture_output=True,
+                                  sudo=self.privileged, dryrun=self.dryrun, log_debug=True)
+            except Exception: pass
@@ -0,0 +1,469 @@
+#!/usr/bin/python3
+
+import argparse
+import bisect
+import fcntl
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+
+from array import array
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+MOCK_STATE_FILE = "state.json"
+MOCK_LOCK_FILE = "state.lock"
+MOCK_DEVICE_NAME = "theaterq:{dev}:{handle}:0"
+MOCK_TRACE_SUFFIX = ".trace"
+MOCK_PACKET_SIZE = 1250 # bytes
+MOCK_UNLIMITED_RATE = 100000000 # bps, offered load for entries without rate limit
+MOCK_LOAD = 0.8 # fraction of the configured rate used by the simulated traffic
+U32_MAX = 4294967295
+
+
+class MockTimeline:
+    # Per-entry end times (ns) and the parameters required for the counters,
+    # cached in a binary sidecar so polling does not reparse the trace.
+    def __init__(self, ends: array, rates: array, losses: array, limits: array):
+        self.ends = ends
+        self.rates = rates
+        self.losses = losses
+        self.limits = limits
+
+    @property
+    def total_time(self) -> int:
+        return self.ends[-1] if len(self.ends) > 0 else 0
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    @staticmethod
+    def empty() -> "MockTimeline":
+        return MockTimeline(array("q"), array("q"), array("q"), array("q"))
+
+    @staticmethod
+    def load(trace_path: str) -> "MockTimeline":
+        if not os.path.exists(trace_path):
+            return MockTimeline.empty()
+
+        cache_path = trace_path + ".idx"
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(trace_path):
+            with open(cache_path, "rb") as handle:
+                count = array("q")
+                count.fromfile(handle, 1)
+                columns = []
+                for _ in range(4):
+                    column = array("q")
+                    column.fromfile(handle, count[0])
+                    columns.append(column)
+            return MockTimeline(*columns)
+
+        # Only a cache miss requires numpy
+        from models.trace import Trace, TraceField
+
+        with open(trace_path, "r") as handle:
+            trace = Trace.from_lines(handle)
+
+        ends = array("q", (trace.end_times() * 1000).tolist())
+        timeline = MockTimeline(ends, array("q", trace[TraceField.RATE].tolist()),
+                                array("q", trace[TraceField.LOSS].tolist()),
+                                array("q", trace[TraceField.LIMIT].tolist()))
+
+        temp = cache_path + ".tmp"
+        with open(temp, "wb") as handle:
+            array("q", [len(ends)]).tofile(handle)
+            for column in [timeline.ends, timeline.rates, timeline.losses, timeline.limits]:
+                column.tofile(handle)
+        os.replace(temp, cache_path)
+        return timeline
+
+    def position(self, elapsed: int) -> int:
+        return min(bisect.bisect_right(self.ends, elapsed), len(self.ends) - 1)
+
+
+class MockTheaterQ:
+    def __init__(self, basedir: str, fifo: bool = False, arm_delay: float = 1.0):
+        self.basedir = os.path.abspath(basedir)
+        self.fifo = fifo
+        self.arm_delay = arm_delay
+        self.readers: List[threading.Thread] = []
+        self.devices: List[str] = []
+        self.stop_event = threading.Event()
+        os.makedirs(self.basedir, exist_ok=True)
+
+    @property
+    def device_template(self) -> str:
+        return os.path.join(self.basedir, MOCK_DEVICE_NAME)
+
+    @property
+    def tc_command(self) -> str:
+        source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return (f"PYTHONPATH={shlex.quote(source)} {shlex.quote(sys.executable)} -m utils.theaterq_mock "
+                f"--dir {shlex.quote(self.basedir)} --arm-delay {self.arm_delay} tc")
+
+    def handler_options(self) -> Dict:
+        return {"device_template": self.device_template,
+                "tc_command": self.tc_command,
+                "privileged": False}
+
+    def classifier_options(self) -> Dict:
+        return {"tc_command": self.tc_command,
+                "privileged": False}
+
+    def start(self, interfaces: List[str], handle: int = 1) -> None:
+        for interface in interfaces:
+            device = self.device_template.format(dev=interface, handle=handle)
+            trace = os.path.join(self.basedir, f"{interface}:{handle}{MOCK_TRACE_SUFFIX}")
+
+            if not self.fifo:
+                # Regular file device: uploads land directly in the trace file
+                if os.path.lexists(device):
+                    os.unlink(device)
+                os.symlink(os.path.basename(trace), device)
+                continue
+
+            if os.path.lexists(device):
+                os.unlink(device)
+            os.mkfifo(device)
+
+            reader = threading.Thread(target=self.__drain_fn, args=(device, trace), daemon=True)
+            reader.start()
+            self.readers.append(reader)
+            self.devices.append(device)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        for reader, device in zip(self.readers, self.devices):
+            # Unblock readers waiting for a writer
+            try:
+                fd = os.open(device, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            reader.join(timeout=1)
+        self.readers.clear()
+        self.devices.clear()
+
+    def __drain_fn(self, device: str, trace: str) -> None:
+        # Like the character device, the writer blocks until everything is consumed
+        while not self.stop_event.is_set():
+            with open(device, "rb") as source:
+                temp = trace + ".tmp"
+                with open(temp, "wb") as target:
+                    while True:
+                        chunk = source.read(1 << 16)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+
+            if self.stop_event.is_set():
+                return
+            os.replace(temp, trace)
+
+
+class MockTC:
+    def __init__(self, basedir: str, arm_delay: float = 1.0):
+        self.basedir = basedir
+        self.arm_delay = arm_delay
+
+    @contextmanager
+    def __locked_state(self):
+        with open(os.path.join(self.basedir, MOCK_LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(self.basedir, MOCK_STATE_FILE)
+            try:
+                with open(path, "r") as handle:
+                    state = json.load(handle)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = {}
+
+            yield state
+
+            temp = path + ".tmp"
+            with open(temp, "w") as handle:
+                json.dump(state, handle)
+            os.replace(temp, path)
+
+    def __trace_path(self, key: str) -> str:
+        return os.path.join(self.basedir, key + MOCK_TRACE_SUFFIX)
+
+    def __timeline(self, key: str, cache: Dict[str, MockTimeline]) -> MockTimeline:
+        if key not in cache:
+            cache[key] = MockTimeline.load(self.__trace_path(key))
+        return cache[key]
+
+    def __advance(self, qdisc: Dict, now: float, timeline: MockTimeline) -> None:
+        # Lazily moves the qdisc forward to 'now', as if the kernel had been running
+        if qdisc["stage"] == "ARM" and self.arm_delay >= 0 and now >= qdisc["armed"] + self.arm_delay:
+            qdisc["stage"] = "RUN"
+            qdisc["start"] = qdisc["armed"] + self.arm_delay
+            qdisc["updated"] = qdisc["start"]
+
+        if qdisc["stage"] not in ["RUN", "FINISH"] or len(timeline) == 0:
+            qdisc["updated"] = now
+            return
+
+        elapsed = int((now - qdisc["start"]) * 1e9)
+        total = timeline.total_time
+        if qdisc["stage"] == "RUN" and elapsed >= total:
+            if qdisc["contmode"] == "LOOP":
+                elapsed %= max(total, 1)
+            else:
+                qdisc["stage"] = "FINISH"
+
+        if qdisc["stage"] == "FINISH":
+            elapsed = total
+            if qdisc["contmode"] == "CLEAN":
+                qdisc["position"] = 0
+                qdisc["position_time"] = 0
+                qdisc["updated"] = now
+                return
+
+        index = timeline.position(elapsed)
+        qdisc["position"] = index
+        qdisc["position_time"] = elapsed
+
+        # Synthetic traffic at a fraction of the configured rate of the current entry
+        interval = max(now - qdisc["updated"], 0.0)
+        rate = timeline.rates[index] or MOCK_UNLIMITED_RATE
+        sent = int(rate * MOCK_LOAD * interval / 8)
+        packets = sent // MOCK_PACKET_SIZE
+        dropped = int(packets * timeline.losses[index] / U32_MAX)
+        qdisc["bytes"] += (packets - dropped) * MOCK_PACKET_SIZE
+        qdisc["packets"] += packets - dropped
+        qdisc["drops"] += dropped
+        qdisc["qlen"] = int(timeline.limits[index] * MOCK_LOAD / 4)
+        qdisc["backlog"] = qdisc["qlen"] * MOCK_PACKET_SIZE
+        qdisc["updated"] = now
+
+    @staticmethod
+    def __parse_options(arguments: List[str]) -> Dict[str, str]:
+        options = {}
+        for index in range(0, len(arguments) - 1, 2):
+            options[arguments[index]] = arguments[index + 1]
+        return options
+
+    @staticmethod
+    def __parse_target(arguments: List[str]) -> Tuple[str, str, List[str]]:
+        device, handle, rest = None, None, []
+        index = 0
+        while index < len(arguments):
+            if arguments[index] == "dev":
+                device = arguments[index + 1]
+                index += 2
+            elif arguments[index] == "handle":
+                handle = arguments[index + 1].rstrip(":")
+                index += 2
+            elif arguments[index] == "parent":
+                index += 2
+            elif arguments[index] == "root":
+                index += 1
+            else:
+                rest.append(arguments[index])
+                index += 1
+
+        if device is None:
+            raise ValueError("Expected 'dev'")
+        return device, handle, rest
+
+    def run(self, arguments: List[str]) -> int:
+        # Supports the subset of 'tc' used by TheaterQHandler
+        json_output = False
+        while arguments and arguments[0].startswith("-"):
+            json_output |= arguments[0] == "-j"
+            arguments = arguments[1:]
+
+        # Classful roots, their classes and filters are accepted but not emulated
+        if len(arguments) >= 2 and arguments[0] in ["class", "filter"] and arguments[1] in ["add", "del"]:
+            return 0
+
+        if len(arguments) < 2 or arguments[0] != "qdisc":
+            print(f"Unsupported command: {' '.join(arguments)}", file=sys.stderr)
+            return 1
+
+        try:
+            action = arguments[1]
+            device, handle, rest = MockTC.__parse_target(arguments[2:])
+        except (ValueError, IndexError) as ex:
+            print(f"Invalid command: {ex}", file=sys.stderr)
+            return 1
+
+        key = f"{device}:{handle}"
+        now = time.monotonic()
+        cache: Dict[str, MockTimeline] = {}
+
+        with self.__locked_state() as state:
+            if action == "add" and (len(rest) == 0 or rest[0] != "theaterq"):
+                return 0
+
+            if action == "del" and handle is None:
+                # Deleting the root removes the whole tree of the device
+                for other in [other for other in state if other.startswith(f"{device}:")]:
+                    del state[other]
+                return 0
+
+            if handle is None:
+                print("Error: Expected 'handle'.", file=sys.stderr)
+                return 1
+
+            if action == "add":
+                if key in state:
+                    print("Error: Exclusivity flag on, cannot modify.", file=sys.stderr)
+                    return 2
+
+                options = MockTC.__parse_options(rest[1:])
+                if os.path.exists(self.__trace_path(key)):
+                    os.unlink(self.__trace_path(key))
+                state[key] = {"stage": "LOAD", "contmode": "LOOP",
+                              "syncgroup": int(options.get("syncgroup", 0)),
+                              "ingest": options.get("ingest", "SIMPLE"),
+                              "armed": None, "start": None, "updated": now,
+                              "position": 0, "position_time": 0,
+                              "bytes": 0, "packets": 0, "drops": 0, "overlimits": 0,
+                              "backlog": 0, "qlen": 0}
+                return 0
+
+            if key not in state:
+                print("Error: Cannot find specified qdisc on specified device.", file=sys.stderr)
+                return 2
+
+            if action == "del":
+                del state[key]
+                return 0
+
+            for other, qdisc in state.items():
+                self.__advance(qdisc, now, self.__timeline(other, cache))
+
+            if action == "change":
+                return self.__change(state, key, MockTC.__parse_options(rest[1:]), now)
+
+            if action in ["sh", "show"]:
+                print(self.__show(key, state[key], self.__timeline(key, cache), json_output))
+                return 0
+
+        print(f"Unsupported action: {action}", file=sys.stderr)
+        return 1
+
+    def __change(self, state: Dict, key: str, options: Dict[str, str], now: float) -> int:
+        qdisc = state[key]
+        if "cont" in options:
+            qdisc["contmode"] = options["cont"]
+
+        stage = options.get("stage")
+        if stage is None:
+            return 0
+
+        if stage == "CLEAR":
+            # Clearing drops the trace, the next upload starts from scratch
+            qdisc.update({"stage": "LOAD", "armed": None, "start": None,
+                          "position": 0, "position_time": 0, "qlen": 0, "backlog": 0})
+            for path in [self.__trace_path(key), self.__trace_path(key) + ".idx"]:
+                if os.path.exists(path):
+                    os.unlink(path)
+            return 0
+
+        if stage not in ["RUN", "ARM"]:
+            print(f"Error: Invalid stage transition to {stage}.", file=sys.stderr)
+            return 2
+
+        if qdisc["stage"] != "LOAD":
+            print(f"Error: Cannot change stage from {qdisc['stage']} to {stage}.", file=sys.stderr)
+            return 2
+
+        # All members of the syncgroup follow the instance that was started
+        members = [other for other in state.values()
+                   if qdisc["syncgroup"] != 0 and other["syncgroup"] == qdisc["syncgroup"]
+                   and other["stage"] == "LOAD"]
+        for member in members or [qdisc]:
+            member["stage"] = stage
+            member["armed"] = now if stage == "ARM" else None
+            member["start"] = now if stage == "RUN" else None
+            member["updated"] = now
+        return 0
+
+    def trigger(self) -> int:
+        now = time.monotonic()
+        with self.__locked_state() as state:
+            for qdisc in state.values():
+                if qdisc["stage"] == "ARM":
+                    qdisc.update({"stage": "RUN", "start": now, "updated": now})
+        return 0
+
+    @staticmethod
+    def __show(key: str, qdisc: Dict, timeline: MockTimeline, json_output: bool) -> str:
+        entry = {
+            "kind": "theaterq",
+            "handle": key.split(":")[1] + ":",
+            "root": True,
+            "refcnt": 2,
+            "options": {
+                "stage": qdisc["stage"],
+                "cont_mode": qdisc["contmode"],
+                "syncgroup": qdisc["syncgroup"],
+                "ingest": qdisc["ingest"],
+                "position": qdisc["position"],
+                "position_time": qdisc["position_time"],
+                "entries": len(timeline),
+                "entries_time": timeline.total_time,
+            },
+            "bytes": qdisc["bytes"],
+            "packets": qdisc["packets"],
+            "drops": qdisc["drops"],
+            "overlimits": qdisc["overlimits"],
+            "requeues": 0,
+            "backlog": qdisc["backlog"],
+            "qlen": qdisc["qlen"],
+        }
+
+        if json_output:
+            return json.dumps([entry])
+
+        options = entry["options"]
+        return (f"qdisc theaterq {entry['handle']} root refcnt 2 stage {options['stage']} "
+                f"cont {options['cont_mode']} syncgroup {options['syncgroup']} "
+                f"position {options['position']}/{options['entries']}\n"
+                f" Sent {entry['bytes']} bytes {entry['packets']} pkt (dropped {entry['drops']}, "
+                f"overlimits {entry['overlimits']} requeues 0)\n"
+                f" backlog {entry['backlog']}b {entry['qlen']}p requeues 0")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="TheaterQ Mock")
+    parser.add_argument("--dir", "-D", type=str, required=True, help="State and device directory of the mock")
+    parser.add_argument("--arm-delay", type=float, default=1.0,
+                        help="Seconds until an armed instance sees its first packet, negative to wait for 'trigger'")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tc_parser = subparsers.add_parser("tc", help="Fake 'tc' invocation")
+    tc_parser.add_argument("ARGS", nargs=argparse.REMAINDER)
+
+    serve_parser = subparsers.add_parser("serve", help="Provide the fake TheaterQ devices")
+    serve_parser.add_argument("INTERFACES", nargs="+", type=str)
+    serve_parser.add_argument("--handle", type=int, default=1)
+    serve_parser.add_argument("--fifo", action="store_true", help="Use FIFOs instead of regular files as devices")
+
+    subparsers.add_parser("trigger", help="Simulate the first packet for all armed instances")
+
+    # tc options such as '-s -j' are not known to the parser
+    args, extra = parser.parse_known_args()
+    if extra and args.command != "tc":
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    if args.command == "tc":
+        sys.exit(MockTC(args.dir, args.arm_delay).run(extra + args.ARGS))
+    elif args.command == "trigger":
+        sys.exit(MockTC(args.dir, args.arm_delay).trigger())
+    else:
+        mock = MockTheaterQ(args.dir, fifo=args.fifo, arm_delay=args.arm_delay)
+        mock.start(args.INTERFACES, args.handle)
+        print(f"Mock devices: {mock.device_template}")
+        print(f"Mock tc: {mock.tc_command}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            mock.stop()
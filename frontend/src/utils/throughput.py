@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from dataclasses import dataclass, asdict, field
+from typing import List, Optional, Tuple
+
+from models.operation import OperationMode
+from models.trace import Trace
+from utils.logger import Logger
+from utils.selftest import VethHarness
+from utils.theaterq import TheaterQHandler, TheaterQDualLinkSettings, TheaterQContMode
+from utils.utils import run_fail_on_error, run_log_on_error, invoke_subprocess
+from constants import RIGHT_INTERFACE, LEFT_INTERFACE
+
+
+BENCHMARK_PORT = 47002
+HEADER_SIZE = 28 # bytes, IPv4 + UDP
+VLAN_ID = 20
+DEFAULT_SIZES = [64, 512, 1500] # bytes, IP packet
+# One entry without latency and rate limit (0), replayed in a loop
+WIDE_OPEN_TRACE = Trace.from_lines(["1000000,0,0,0,0,10000,0,0,1\n"])
+
+
+class ModeHarness(VethHarness):
+    # Local stand-in for the datapath of an operation mode, TheaterQ is installed
+    # on the host ends of the veth pairs just like on eth0/eth1:
+    # - bridged: both host ends in a bridge, endpoints in one subnet
+    # - routed: routed via the host (see VethHarness)
+    # - extended: VLAN subinterfaces on both sides, the right endpoint is reached
+    #   by a public address DNATed and masqueraded by nftables
+    def __init__(self, mode: OperationMode, prefix: str = "tqtp", subnet: str = "10.198"):
+        super().__init__(prefix=prefix, subnet=subnet)
+        self.mode = mode
+        self.bridge = f"{prefix}-br"
+        self.table = prefix
+        self.public_address = f"{subnet}.3.1"
+        if mode == OperationMode.BRIDGED:
+            self.right_address = f"{subnet}.1.3"
+
+    @property
+    def target(self) -> str:
+        return self.public_address if self.mode == OperationMode.EXTENDED else self.right_address
+
+    @property
+    def receive_interface(self) -> Tuple[str, str]:
+        # Namespace and interface of the right endpoint
+        if self.mode == OperationMode.EXTENDED:
+            return self.right_ns, f"{self.right_peer}.{VLAN_ID + 1}"
+        return self.right_ns, self.right_peer
+
+    def setup(self) -> None:
+        if self.mode == OperationMode.ROUTED:
+            super().setup()
+            return
+
+        self.teardown()
+
+        def exec_in(netns: Optional[str], cmd: str) -> None:
+            prefix = f"ip netns exec {netns} " if netns is not None else ""
+            run_fail_on_error(prefix + cmd, sudo=True, log_debug=True)
+
+        exec_in(None, "sysctl -w net.ipv4.ip_forward=1")
+        if self.mode == OperationMode.BRIDGED:
+            exec_in(None, f"ip link add {self.bridge} type bridge")
+            exec_in(None, f"ip link set up dev {self.bridge}")
+
+        for index, (netns, host, peer, gateway, address) in enumerate([
+                (self.left_ns, self.left_host, self.left_peer, self.left_gateway, self.left_address),
+                (self.right_ns, self.right_host, self.right_peer, self.right_gateway, self.right_address)]):
+            exec_in(None, f"ip netns add {netns}")
+            exec_in(None, f"ip link add {host} type veth peer name {peer} netns {netns}")
+            exec_in(None, f"sysctl -w net.ipv6.conf.{host}.disable_ipv6=1")
+            exec_in(netns, f"sysctl -w net.ipv6.conf.{peer}.disable_ipv6=1")
+            exec_in(None, f"ip link set up dev {host}")
+            exec_in(netns, "ip link set up dev lo")
+            exec_in(netns, f"ip link set up dev {peer}")
+
+            if self.mode == OperationMode.BRIDGED:
+                exec_in(None, f"ip link set {host} master {self.bridge}")
+                exec_in(netns, f"ip addr add {address}/24 dev {peer}")
+                continue
+
+            vlan = VLAN_ID + index
+            exec_in(None, f"ip link add link {host} name {host}.{vlan} type vlan id {vlan}")
+            exec_in(None, f"ip addr add {gateway}/24 dev {host}.{vlan}")
+            exec_in(None, f"ip link set up dev {host}.{vlan}")
+            exec_in(netns, f"ip link add link {peer} name {peer}.{vlan} type vlan id {vlan}")
+            exec_in(netns, f"ip addr add {address}/24 dev {peer}.{vlan}")
+            exec_in(netns, f"ip link set up dev {peer}.{vlan}")
+            exec_in(netns, f"ip route add default via {gateway}")
+
+        if self.mode == OperationMode.EXTENDED:
+            left, right = f"{self.left_host}.{VLAN_ID}", f"{self.right_host}.{VLAN_ID + 1}"
+            run_fail_on_error(["nft", f"add table ip {self.table}; "
+                               f"add chain ip {self.table} prerouting {{ type nat hook prerouting priority dstnat; }}; "
+                               f"add chain ip {self.table} postrouting {{ type nat hook postrouting priority srcnat; }}; "
+                               f"add rule ip {self.table} prerouting iifname \"{left}\" ip daddr {self.public_address} "
+                               f"dnat to {self.right_address}; "
+                               f"add rule ip {self.table} postrouting oifname \"{right}\" masquerade"],
+                              shell=False, sudo=True, log_debug=True)
+
+    def teardown(self) -> None:
+        super().teardown()
+        run_log_on_error(f"ip link del {self.bridge}", sudo=True, log_debug=True)
+        run_log_on_error(f"nft delete table ip {self.table}", sudo=True, log_debug=True)
+
+
+@dataclass
+class CpuSample:
+    busy: List[int] = field(default_factory=list) # jiffies per core
+    softirq: List[int] = field(default_factory=list)
+    total: List[int] = field(default_factory=list)
+
+    @staticmethod
+    def read() -> "CpuSample":
+        # /proc/stat: cpuN user nice system idle iowait irq softirq steal ...
+        sample = CpuSample()
+        with open("/proc/stat", "r") as handle:
+            for line in handle:
+                if not line.startswith("cpu") or line.startswith("cpu "):
+                    continue
+                values = [int(value) for value in line.split()[1:]]
+                sample.total.append(sum(values[:8]))
+                sample.busy.append(sum(values[:8]) - values[3] - values[4])
+                sample.softirq.append(values[6])
+        return sample
+
+    def usage(self, before: "CpuSample") -> Tuple[List[float], List[float]]:
+        # Percent busy and percent softirq per core since 'before'
+        busy, softirq = [], []
+        for index in range(len(self.total)):
+            total = max(self.total[index] - before.total[index], 1)
+            busy.append(round(100 * (self.busy[index] - before.busy[index]) / total, 1))
+            softirq.append(round(100 * (self.softirq[index] - before.softirq[index]) / total, 1))
+        return busy, softirq
+
+
+@dataclass
+class ThroughputResult:
+    mode: str
+    variant: str # passthrough, theaterq or live
+    size: int # bytes, IP packet
+    seconds: float # Generator runtime
+    sent: int # packets offered by the generator
+    received: int # packets at the right endpoint
+    pps: float # received
+    mbps: float # received, including the Ethernet header
+    lost: int # sent - received
+    qdisc_drops: int
+    cpu: List[float] = field(default_factory=list) # % per core
+    softirq: List[float] = field(default_factory=list) # % per core
+
+
+def blast(netns: str, target: str, payload: int, duration: float, counter) -> None:
+    # Generator process, a Python loop per core is the cheapest sender without dependencies
+    fd = os.open(f"/run/netns/{netns}", os.O_RDONLY)
+    try:
+        os.setns(fd, os.CLONE_NEWNET)
+    finally:
+        os.close(fd)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = bytes(payload)
+    address = (target, BENCHMARK_PORT)
+    sent = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for _ in range(256):
+            try:
+                sock.sendto(data, address)
+                sent += 1
+            except OSError:
+                pass # ENOBUFS, the local queue is full
+    sock.close()
+    with counter.get_lock():
+        counter.value += sent
+
+
+def link_counters(netns: Optional[str], interface: str) -> Tuple[int, int]:
+    prefix = f"ip -n {netns}" if netns is not None else "ip"
+    process = invoke_subprocess(f"{prefix} -s -j link show dev {interface}", capture_output=True,
+                                sudo=True, log_debug=True)
+    if process.returncode != 0:
+        raise Exception(f"Unable to read counters of {interface}: {process.stderr.decode('utf-8').strip()}")
+    stats = json.loads(process.stdout.decode("utf-8"))[0]["stats64"]["rx"]
+    return stats["packets"], stats["bytes"]
+
+
+def qdisc_drops(interfaces: List[str]) -> int:
+    drops = 0
+    for interface in interfaces:
+        process = invoke_subprocess(f"tc -s -j qdisc show dev {interface}", capture_output=True,
+                                    sudo=True, log_debug=True)
+        if process.returncode == 0:
+            drops += sum(entry.get("drops", 0) for entry in json.loads(process.stdout.decode("utf-8")))
+    return drops
+
+
+class ThroughputBenchmark:
+    def __init__(self, modes: List[OperationMode], sizes: List[int], duration: float = 10.0,
+                 senders: int = 1, theaterq: bool = True):
+        self.modes = modes
+        self.sizes = sizes
+        self.duration = duration
+        self.senders = senders
+        self.variants = ["passthrough", "theaterq"] if theaterq else ["passthrough"]
+        self.sink_stop = threading.Event()
+
+    def __generate(self, harness: ModeHarness, size: int, duration: float) -> int:
+        counter = multiprocessing.Value("Q", 0)
+        workers = [multiprocessing.Process(target=blast, daemon=True,
+                                           args=(harness.left_ns, harness.target,
+                                                 max(size - HEADER_SIZE, 1), duration, counter))
+                   for _ in range(self.senders)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return counter.value
+
+    def __measure(self, harness: ModeHarness, variant: str, size: int) -> ThroughputResult:
+        netns, interface = harness.receive_interface
+        qdisc_interfaces = [harness.left_host, harness.right_host]
+
+        # Resolves neighbors and conntrack entries before the measurement
+        self.__generate(harness, size, 0.2)
+        time.sleep(0.2)
+
+        packets, octets = link_counters(netns, interface)
+        drops = qdisc_drops(qdisc_interfaces)
+        cpu = CpuSample.read()
+
+        sent = self.__generate(harness, size, self.duration)
+        time.sleep(0.2) # In flight packets
+
+        busy, softirq = CpuSample.read().usage(cpu)
+        received, received_octets = [after - before for after, before in
+                                     zip(link_counters(netns, interface), (packets, octets))]
+        return ThroughputResult(mode=str(harness.mode), variant=variant, size=size,
+                                seconds=self.duration, sent=sent, received=received,
+                                pps=round(received / self.duration, 1),
+                                mbps=round(received_octets * 8 / self.duration / 1e6, 2),
+                                lost=max(sent - received, 0),
+                                qdisc_drops=qdisc_drops(qdisc_interfaces) - drops,
+                                cpu=busy, softirq=softirq)
+
+    def run(self) -> List[ThroughputResult]:
+        results = []
+        for mode in self.modes:
+            harness = ModeHarness(mode)
+            try:
+                harness.setup()
+            except Exception as ex:
+                Logger.error(f"Throughput: unable to set up {mode}: {ex}")
+                harness.teardown()
+                continue
+
+            try:
+                # The receiver never reads, the endpoint only has to accept the packets
+                self.sink_stop.clear()
+                sink = VethHarness.run_in(harness.right_ns, self.__sink)
+                for variant in self.variants:
+                    handler = None
+                    try:
+                        if variant == "theaterq":
+                            handler = TheaterQHandler(forward_interface=harness.right_host,
+                                                      return_interface=harness.left_host)
+                            handler.update(TheaterQDualLinkSettings(WIDE_OPEN_TRACE, WIDE_OPEN_TRACE,
+                                                                    contmode=TheaterQContMode.LOOP))
+                            handler.start()
+
+                        for size in self.sizes:
+                            Logger.info(f"Throughput: {mode} {variant} {size} bytes")
+                            results.append(self.__measure(harness, variant, size))
+                    except Exception as ex:
+                        Logger.error(f"Throughput: {mode} {variant} failed: {ex}")
+                    finally:
+                        if handler is not None:
+                            handler.clean()
+                self.sink_stop.set()
+                sink.join(timeout=1)
+            finally:
+                harness.teardown()
+        return results
+
+    def __sink(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.bind(("0.0.0.0", BENCHMARK_PORT))
+        self.sink_stop.wait()
+        sock.close()
+
+
+def measure_live(duration: float) -> ThroughputResult:
+    # Traffic of the real endpoints (e.g., iperf3), counted at the emulator interfaces
+    before = [link_counters(None, interface) for interface in [RIGHT_INTERFACE, LEFT_INTERFACE]]
+    drops = qdisc_drops([RIGHT_INTERFACE, LEFT_INTERFACE])
+    cpu = CpuSample.read()
+    time.sleep(duration)
+    busy, softirq = CpuSample.read().usage(cpu)
+    after = [link_counters(None, interface) for interface in [RIGHT_INTERFACE, LEFT_INTERFACE]]
+
+    received = sum(end[0] - start[0] for start, end in zip(before, after))
+    octets = sum(end[1] - start[1] for start, end in zip(before, after))
+    return ThroughputResult(mode="live", variant="live", size=int(octets / max(received, 1)),
+                            seconds=duration, sent=received, received=received,
+                            pps=round(received / duration, 1), mbps=round(octets * 8 / duration / 1e6, 2),
+                            lost=0, qdisc_drops=qdisc_drops([RIGHT_INTERFACE, LEFT_INTERFACE]) - drops,
+                            cpu=busy, softirq=softirq)
+
+
+def print_results(results: List[ThroughputResult]) -> None:
+    print(f"{'mode':>9}{'variant':>13}{'size':>6}{'sent pps':>12}{'recv pps':>12}{'Mbit/s':>10}"
+          f"{'lost':>10}{'qdisc drop':>12}  cpu % (softirq %) per core")
+    for r in results:
+        cores = " ".join(f"{busy:.0f}({softirq:.0f})" for busy, softirq in zip(r.cpu, r.softirq))
+        print(f"{r.mode:>9}{r.variant:>13}{r.size:>6}{r.sent / r.seconds:>12.0f}{r.pps:>12.0f}{r.mbps:>10.1f}"
+              f"{r.lost:>10}{r.qdisc_drops:>12}  {cores}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Datapath Throughput Benchmark")
+    parser.add_argument("--modes", "-m", type=str, nargs="+", default=[str(mode) for mode in OperationMode],
+                        choices=[str(mode) for mode in OperationMode], help="Operation modes to benchmark")
+    parser.add_argument("--sizes", "-s", type=int, nargs="+", default=DEFAULT_SIZES, help="IP packet sizes in bytes")
+    parser.add_argument("--duration", "-t", type=float, default=10.0, help="Seconds per measurement")
+    parser.add_argument("--senders", "-n", type=int, default=1, help="Generator processes")
+    parser.add_argument("--passthrough-only", action="store_true", help="Skip the runs with TheaterQ")
+    parser.add_argument("--live", type=float, default=None,
+                        help="Only measure the traffic of the real endpoints on eth0/eth1 for this many seconds")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    if args.live is not None:
+        results = [measure_live(args.live)]
+    else:
+        results = ThroughputBenchmark([OperationMode.from_str(mode) for mode in args.modes], args.sizes,
+                                      duration=args.duration, senders=args.senders,
+                                      theaterq=not args.passthrough_only).run()
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump([asdict(result) for result in results], handle, indent=4)
+
+    sys.exit(0 if results else 1)
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import numpy as np
+
+from pathlib import Path
+from typing import List, Optional, Set
+
+from models.trace import Trace, TraceTransform
+from utils.logger import Logger
+from constants import TRACE_BUFFER_PATH, TRACE_BUFFER_MEMORY_SHARE
+
+
+class TraceBuffer:
+    # Both Trace Files of a scenario in one memory-mapped file: a header with the
+    # number of forward and return entries followed by both traces as (n, 9) int64
+    # rows. Plot, statistics, uploader and video sync use read-only views of it,
+    # so a scenario occupies about the raw column size once, in the page cache
+    # and outside of the Python heap. Other processes can map the same file.
+    #
+    # Files are named by the source files and the transform, a scenario loaded
+    # again (or by a restarted frontend) is mapped without parsing. tmpfs keeps
+    # them in RAM, so the least recently used files of scenarios that are not
+    # loaded (mapped by this process) are removed while all files together
+    # exceed TRACE_BUFFER_MEMORY_SHARE of the memory.
+    HEADER = 2 # int64: forward entries, return entries
+
+    def __init__(self, forward: Trace, reverse: Trace, path: Optional[str] = None):
+        self.forward = forward
+        self.reverse = reverse
+        self.path = path
+
+    @property
+    def nbytes(self) -> int:
+        return self.forward.data.nbytes + self.reverse.data.nbytes
+
+    @staticmethod
+    def open(path: str) -> "TraceBuffer":
+        header = np.fromfile(path, dtype=np.int64, count=TraceBuffer.HEADER)
+        if len(header) != TraceBuffer.HEADER:
+            raise ValueError(f"Invalid trace buffer {path}")
+
+        forward, reverse = int(header[0]), int(header[1])
+        if os.path.getsize(path) != (TraceBuffer.HEADER + (forward + reverse) * Trace.FIELDS) * 8:
+            raise ValueError(f"Truncated trace buffer {path}")
+
+        if forward + reverse == 0:
+            empty = np.empty((0, Trace.FIELDS), dtype=np.int64)
+            return TraceBuffer(Trace(empty), Trace(empty), path)
+
+        data = np.memmap(path, dtype=np.int64, mode="r", offset=TraceBuffer.HEADER * 8,
+                         shape=(forward + reverse, Trace.FIELDS))
+        return TraceBuffer(Trace(data[:forward]), Trace(data[forward:]), path)
+
+    @staticmethod
+    def write(path: str, forward: Trace, reverse: Trace) -> None:
+        # Replaced atomically, concurrent readers never see a partial file
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "wb") as handle:
+            np.array([len(forward), len(reverse)], dtype=np.int64).tofile(handle)
+            forward.data.astype(np.int64, copy=False).tofile(handle)
+            reverse.data.astype(np.int64, copy=False).tofile(handle)
+        os.replace(temp, path)
+
+    @staticmethod
+    def key(files: List[Path], trace_format: str, transform: Optional[TraceTransform]) -> str:
+        identity = [trace_format, str(transform)]
+        for file in files:
+            stat = file.stat()
+            identity.append(f"{file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}")
+        return hashlib.sha1("|".join(identity).encode("utf-8")).hexdigest()[:20]
+
+    @staticmethod
+    def load(forward_file: Path, return_file: Path, trace_format: str,
+             transform: Optional[TraceTransform] = None,
+             directory: str = TRACE_BUFFER_PATH) -> "TraceBuffer":
+        path = os.path.join(directory,
+                            f"{TraceBuffer.key([forward_file, return_file], trace_format, transform)}.trace")
+        if os.path.exists(path):
+            try:
+                buffer = TraceBuffer.open(path)
+                os.utime(path)
+                return buffer
+            except Exception as ex:
+                Logger.warning(f"Rebuilding trace buffer {path}: {ex}")
+
+        simple = trace_format != "extended"
+        traces = []
+        for file in [forward_file, return_file]:
+            with open(file, "r") as handle:
+                trace = Trace.from_lines(handle, simple=simple)
+            if transform is not None:
+                trace = transform.apply(trace)
+            traces.append(trace)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Room for the new file first, a full tmpfs would fail the write
+            size = (TraceBuffer.HEADER + (len(traces[0]) + len(traces[1])) * Trace.FIELDS) * 8
+            TraceBuffer.prune(directory, limit=max(TraceBuffer.memory_limit() - size, 0))
+            TraceBuffer.write(path, traces[0], traces[1])
+            return TraceBuffer.open(path)
+        except Exception as ex:
+            # Still usable, but private to this process
+            Logger.warning(f"Unable to map traces to {directory}: {ex}")
+            return TraceBuffer(traces[0], traces[1])
+
+    @staticmethod
+    def memory_limit(share: float = TRACE_BUFFER_MEMORY_SHARE) -> int:
+        # bytes
+        with open("/proc/meminfo", "r") as handle:
+            for line in handle:
+                if line.startswith("MemTotal:"):
+                    return int(int(line.split()[1]) * 1024 * share)
+        raise ValueError("MemTotal missing in /proc/meminfo")
+
+    @staticmethod
+    def mapped() -> Set[str]:
+        # Files mapped by this process, i.e., buffers of loaded scenarios
+        paths = set()
+        with open("/proc/self/maps", "r") as handle:
+            for line in handle:
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6:
+                    paths.add(fields[5].rstrip("\n"))
+        return paths
+
+    @staticmethod
+    def prune(directory: str = TRACE_BUFFER_PATH, limit: Optional[int] = None) -> None:
+        limit = TraceBuffer.memory_limit() if limit is None else limit
+        loaded = TraceBuffer.mapped()
+
+        files = [(entry.path, entry.stat()) for entry in os.scandir(directory) if entry.name.endswith(".trace")]
+        total = sum(stat.st_size for _, stat in files)
+        # Removing a mapped file frees nothing, its pages stay until it is unmapped
+        unloaded = [(path, stat) for path, stat in files if os.path.realpath(path) not in loaded]
+        unloaded.sort(key=lambda file: file[1].st_mtime)
+        for path, stat in unloaded:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= stat.st_size
+            except OSError:
+                pass
+
+        if total > limit:
+            Logger.warning(f"Trace buffers of loaded scenarios use {total / 2**20:.0f} MiB, "
+                           f"above the limit of {limit / 2**20:.0f} MiB")
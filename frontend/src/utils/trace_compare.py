@@ -0,0 +1,125 @@
+import argparse
+import json
+
+from enum import Enum
+from typing import Dict, List, Tuple
+
+from models.scenario import ScenarioConfig
+from models.trace import TraceField, TraceComparison
+
+
+class CompareView(Enum):
+    OVERLAY = "overlay"
+    DIFFERENCE = "difference"
+
+    @staticmethod
+    def from_str(string: str):
+        try: return CompareView(string.strip().lower())
+        except Exception:
+            raise Exception(f"Unknown CompareView '{string}'")
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+
+# Field, label, unit scale and unit for each plotted panel
+COMPARE_PANELS = [
+    (TraceField.LATENCY, "Delay", 1e-6, "ms"),
+    (TraceField.RATE, "Capacity", 1e-6, "Mbps"),
+    (TraceField.LOSS, "Loss", 100 / 0xFFFFFFFF, "%"),
+    (TraceField.LIMIT, "Queue", 1, "pkts"),
+]
+
+
+def compare_scenarios(scenario_a: ScenarioConfig, scenario_b: ScenarioConfig,
+                      return_trace: bool = False) -> TraceComparison:
+    if return_trace:
+        return TraceComparison.align(scenario_a.return_trace, scenario_b.return_trace)
+
+    return TraceComparison.align(scenario_a.forward_trace, scenario_b.forward_trace)
+
+
+def format_summary(comparison: TraceComparison) -> List[str]:
+    summary = comparison.summary()
+    lines = []
+    for field, label, scale, unit in COMPARE_PANELS:
+        entry = summary[field.name.lower()]
+        lines.append(f"{label}: {entry['mean_a'] * scale:.2f} → {entry['mean_b'] * scale:.2f} {unit} "
+                     f"(Δ {entry['mean_delta'] * scale:+.2f}, max |Δ| {entry['max_abs_delta'] * scale:.2f}, "
+                     f"differs {100 * entry['differing_share']:.1f}% of time)")
+
+    length_a, length_b = comparison.a.get_length_us(), comparison.b.get_length_us()
+    if length_a != length_b:
+        lines.append(f"Length: {length_a / 1e6:.1f} s vs. {length_b / 1e6:.1f} s, "
+                     f"compared first {comparison.get_length_us() / 1e6:.1f} s")
+
+    return lines
+
+
+def draw_comparison(fig, comparison: TraceComparison, view: CompareView = CompareView.OVERLAY,
+                    labels: Tuple[str, str] = ("A", "B"), buckets: int = 1000,
+                    panels: int = len(COMPARE_PANELS), color: str = "black") -> Dict[TraceField, object]:
+    # Draws one panel per compared field into fig, returns the axes per field
+    axes = fig.subplots(panels, 1, sharex=True, squeeze=False)[:, 0]
+    result = {}
+    for ax, (field, label, scale, unit) in zip(axes, COMPARE_PANELS[:panels]):
+        time, envelopes = comparison.decimate(field, buckets)
+        if view == CompareView.OVERLAY:
+            for name, series_label, series_color in [("a", labels[0], "royalblue"), ("b", labels[1], "red")]:
+                low, high = envelopes[name]
+                ax.fill_between(time, low * scale, high * scale, step="post", color=series_color,
+                                alpha=0.3, linewidth=0)
+                ax.step(time, high * scale, where="post", color=series_color, linewidth=1,
+                        label=series_label)
+        else:
+            low, high = envelopes["delta"]
+            ax.fill_between(time, low * scale, high * scale, step="post", color="orange",
+                            linewidth=0.5, label=f"{labels[1]} − {labels[0]}")
+            ax.axhline(0, color=color, linewidth=0.5)
+
+        ax.set_ylabel(f"{label} ({unit})", color=color, fontsize="small")
+        ax.tick_params(axis="both", which="both", color=color, labelcolor=color, labelsize="small")
+        for spine in ax.spines.values():
+            spine.set_color(color)
+        result[field] = ax
+
+    axes[0].legend(loc="upper right", fontsize="x-small", ncols=2)
+    axes[-1].set_xlabel("Simulation Time (s)", color=color)
+    axes[-1].set_xlim(0, comparison.get_length_us() / 1e6)
+    return result
+
+
+if __name__ == "__main__":
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser(prog="Trace Comparison")
+    parser.add_argument("SCENARIO_A", type=str, help="Path to the first scenario JSON")
+    parser.add_argument("SCENARIO_B", type=str, help="Path to the second scenario JSON")
+    parser.add_argument("--return", "-r", dest="return_trace", action="store_true", default=False,
+                        help="Compare the return instead of the forward trace")
+    parser.add_argument("--view", "-v", choices=[str(view) for view in CompareView], default="overlay",
+                        help="Plot both traces or their difference")
+    parser.add_argument("--plot", "-p", type=str, default=None, help="Render the comparison to this image")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the summary as JSON to this path")
+    args = parser.parse_args()
+
+    scenario_a = ScenarioConfig.from_json_file(args.SCENARIO_A)
+    scenario_b = ScenarioConfig.from_json_file(args.SCENARIO_B)
+    comparison = compare_scenarios(scenario_a, scenario_b, args.return_trace)
+
+    print(f"{scenario_a.name} (A) vs. {scenario_b.name} (B), {len(comparison)} aligned segments")
+    for line in format_summary(comparison):
+        print(f"  {line}")
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(comparison.summary(), handle, indent=4)
+
+    if args.plot is not None:
+        fig = plt.figure(figsize=(12, 8))
+        draw_comparison(fig, comparison, CompareView.from_str(args.view),
+                        labels=(scenario_a.name, scenario_b.name))
+        fig.tight_layout()
+        fig.savefig(args.plot, dpi=150)
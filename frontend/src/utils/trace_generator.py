@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+
+import argparse
+import copy
+import json
+import os
+import numpy as np
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from models.trace import Trace, TraceField
+
+
+U32_MAX = 4294967295
+
+
+@dataclass
+class TraceDefaults:
+    latency: int = 40 * 1000 * 1000 # ns
+    jitter: int = 0 # ns
+    rate: int = 50 * 1000 * 1000 # bps
+    loss: int = 0 # scaled u32
+    limit: int = 200 # pkts
+    dup_prob: int = 0 # scaled u32
+    dup_delay: int = 0 # ns
+    route: int = 1
+
+    def to_row(self, keep: int) -> List[int]:
+        return [keep, self.latency, self.jitter, self.rate, self.loss,
+                self.limit, self.dup_prob, self.dup_delay, self.route]
+
+
+class TraceModifier(ABC):
+    # Modifiers are applied chunk by chunk, stateful ones carry their state
+    # across chunk boundaries.
+    @abstractmethod
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        pass
+
+    @staticmethod
+    def from_dict(data: Dict) -> "TraceModifier":
+        params = dict(data)
+        typename = params.pop("type")
+        if "field" in params:
+            params["field"] = TraceField[params["field"].upper()]
+
+        match typename:
+            case "step": return StepModifier(**params)
+            case "sawtooth": return SawtoothModifier(**params)
+            case "gilbert_elliott": return GilbertElliottModifier(**params)
+            case "handover": return HandoverModifier(**params)
+            case "random_walk": return RandomWalkModifier(**params)
+
+        raise Exception(f"Unknown trace modifier '{typename}'")
+
+
+class StepModifier(TraceModifier):
+    def __init__(self, field: TraceField, levels: List[int], duration: int):
+        self.field = field
+        self.levels = np.asarray(levels, dtype=np.int64)
+        self.duration = duration # µs
+
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        data[:, self.field] = self.levels[(time // self.duration) % len(self.levels)]
+
+
+class SawtoothModifier(TraceModifier):
+    def __init__(self, field: TraceField, minimum: int, maximum: int, period: int):
+        self.field = field
+        self.minimum = minimum
+        self.maximum = maximum
+        self.period = period # µs
+
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        phase = (time % self.period) / self.period
+        data[:, self.field] = self.minimum + np.rint((self.maximum - self.minimum) * phase).astype(np.int64)
+
+
+class GilbertElliottModifier(TraceModifier):
+    def __init__(self, p: float, r: float, loss_good: float = 0.0, loss_bad: float = 1.0):
+        self.p = p # P(good -> bad) per entry
+        self.r = r # P(bad -> good) per entry
+        self.loss = np.array([loss_good, loss_bad])
+        self.bad = False
+        self.remaining = 0
+
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        count = data.shape[0]
+        if self.remaining == 0:
+            self.remaining = int(rng.geometric(self.r if self.bad else self.p))
+
+        runs = [np.array([self.remaining])]
+        states = [np.array([self.bad])]
+        total = self.remaining
+
+        # Sojourn times of both states are geometric, draw them in batches
+        # instead of walking the Markov chain entry by entry.
+        while total < count:
+            batch = int((count - total) * min(self.p, self.r)) + 16
+            first, second = (self.r, self.p) if states[-1][-1] else (self.p, self.r)
+            pairs = np.empty(2 * batch, dtype=np.int64)
+            pairs[0::2] = rng.geometric(second, batch)
+            pairs[1::2] = rng.geometric(first, batch)
+            runs.append(pairs)
+            states.append(np.tile([not states[-1][-1], bool(states[-1][-1])], batch))
+            total += int(pairs.sum())
+
+        runs = np.concatenate(runs)
+        states = np.concatenate(states)
+        ends = np.cumsum(runs)
+        last = int(np.searchsorted(ends, count, side="left"))
+
+        series = np.repeat(states[:last + 1], runs[:last + 1])[:count]
+        data[:, TraceField.LOSS] = np.rint(self.loss[series.astype(np.int64)] * U32_MAX).astype(np.int64)
+
+        self.remaining = int(ends[last]) - count
+        self.bad = bool(states[last]) if self.remaining > 0 else not bool(states[last])
+
+
+class HandoverModifier(TraceModifier):
+    def __init__(self, period: int, outage: int, latency_min: Optional[int] = None,
+                 latency_max: Optional[int] = None):
+        self.period = period # µs
+        self.outage = outage # µs
+        self.latency_min = latency_min # ns
+        self.latency_max = latency_max # ns
+        self.latencies: Dict[int, int] = {}
+
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        epoch = time // self.period
+        in_outage = (time % self.period) < self.outage
+        data[in_outage, TraceField.LOSS] = U32_MAX
+        data[:, TraceField.ROUTE] = epoch % 65535 + 1
+
+        if self.latency_min is None or self.latency_max is None:
+            return
+
+        # Every handover switches to a new satellite path with a different base latency
+        epochs = np.unique(epoch)
+        missing = [e for e in epochs.tolist() if e not in self.latencies]
+        drawn = rng.integers(self.latency_min, self.latency_max, size=len(missing), endpoint=True)
+        self.latencies = {e: self.latencies[e] for e in epochs.tolist() if e in self.latencies}
+        self.latencies.update(zip(missing, drawn.tolist()))
+        lookup = np.array([self.latencies[e] for e in epochs.tolist()], dtype=np.int64)
+        data[:, TraceField.LATENCY] = lookup[np.searchsorted(epochs, epoch)]
+
+
+class RandomWalkModifier(TraceModifier):
+    def __init__(self, field: TraceField, start: int, step: float,
+                 minimum: int, maximum: int):
+        if maximum <= minimum:
+            # Reflection needs a non-empty interval
+            raise Exception(f"random_walk needs minimum < maximum, got [{minimum}, {maximum}]")
+
+        self.field = field
+        self.position = float(start - minimum)
+        self.step = step
+        self.minimum = minimum
+        self.width = float(maximum - minimum)
+
+    def apply(self, data: np.ndarray, time: np.ndarray, rng: np.random.Generator) -> None:
+        walk = self.position + np.cumsum(rng.normal(0.0, self.step, data.shape[0]))
+        self.position = float(walk[-1])
+
+        # Reflect the unbounded walk into [minimum, maximum]
+        folded = np.mod(walk, 2 * self.width)
+        folded = np.where(folded > self.width, 2 * self.width - folded, folded)
+        data[:, self.field] = self.minimum + np.rint(folded).astype(np.int64)
+
+
+@dataclass
+class TraceSynthesizer:
+    entries: int
+    granularity: int = 10000 # µs
+    defaults: TraceDefaults = field(default_factory=TraceDefaults)
+    modifiers: List[TraceModifier] = field(default_factory=list)
+    seed: Optional[int | np.random.SeedSequence] = None
+
+    def chunks(self, chunk_size: int = 262144) -> Iterator[Trace]:
+        rng = np.random.default_rng(self.seed)
+        modifiers = copy.deepcopy(self.modifiers)
+        row = np.array(self.defaults.to_row(self.granularity), dtype=np.int64)
+
+        for start in range(0, self.entries, chunk_size):
+            count = min(chunk_size, self.entries - start)
+            data = np.tile(row, (count, 1))
+            time = (np.arange(start, start + count, dtype=np.int64)) * self.granularity
+
+            for modifier in modifiers:
+                modifier.apply(data, time, rng)
+
+            yield Trace(data)
+
+    def generate(self) -> Trace:
+        parts = [chunk.data for chunk in self.chunks()]
+        if len(parts) == 0:
+            return Trace(np.empty((0, Trace.FIELDS), dtype=np.int64))
+
+        return Trace(np.concatenate(parts))
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as handle:
+            handle.write("keep,latency,jitter,rate,loss,limit,dup_prob,dub_delay,reorder_route\n")
+            for chunk in self.chunks():
+                for text in chunk.format_chunks():
+                    handle.write(text)
+
+
+def write_scenario(output: str, name: str, description: str,
+                   forward: TraceSynthesizer | Trace, reverse: TraceSynthesizer | Trace,
+                   basename: Optional[str] = None) -> str:
+    basename = basename or name.lower().replace(" ", "-")
+    os.makedirs(output, exist_ok=True)
+
+    forward.write(os.path.join(output, f"forward-{basename}.csv"))
+    reverse.write(os.path.join(output, f"return-{basename}.csv"))
+
+    scenario = {
+        "name": name,
+        "description": description,
+        "trace": {
+            "format": "extended",
+            "forward": f"forward-{basename}.csv",
+            "return": f"return-{basename}.csv"
+        },
+        "video": None
+    }
+
+    path = os.path.join(output, f"{basename}.json")
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(scenario, handle, indent=4, ensure_ascii=False)
+
+    return path
+
+
+def synthesizers_from_spec(spec: Dict, entries: Optional[int] = None,
+                           seed: Optional[int] = None) -> List[TraceSynthesizer]:
+    entries = entries if entries is not None else spec["entries"]
+    seed = seed if seed is not None else spec.get("seed", None)
+    defaults = TraceDefaults(**spec.get("defaults", {}))
+    seeds = np.random.SeedSequence(seed).spawn(2)
+
+    result = []
+    for direction, dir_seed in zip(["forward", "return"], seeds):
+        modifiers = [TraceModifier.from_dict(entry) for entry in spec.get(direction, [])]
+        result.append(TraceSynthesizer(entries=entries,
+                                       granularity=spec.get("granularity", 10000),
+                                       defaults=defaults,
+                                       modifiers=modifiers,
+                                       seed=dir_seed))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Trace Generator")
+    parser.add_argument("SPEC", type=str, help="Path to generator spec JSON")
+    parser.add_argument("OUTPUT", type=str, help="Output directory for scenario JSON and trace files")
+    parser.add_argument("--entries", "-n", type=int, default=None, help="Override number of trace entries")
+    parser.add_argument("--seed", "-s", type=int, default=None, help="Override random seed")
+    args = parser.parse_args()
+
+    with open(args.SPEC, "r", encoding="utf-8") as handle:
+        spec = json.load(handle)
+
+    forward, reverse = synthesizers_from_spec(spec, entries=args.entries, seed=args.seed)
+    path = write_scenario(args.OUTPUT, spec["name"], spec.get("description", ""),
+                          forward, reverse, basename=spec.get("basename", None))
+    print(f"Scenario written to {path}")
@@ -10,6 +10,8 @@ from typing import Dict, Tuple, List
 from utils.logger import Logger
 from utils.generic_data_provider import GenericDataProvider
 from models.scenario import ScenarioConfig
+from models.trace import TraceTransform
+from constants import SESSION_FALLBACK_PATH
 
 
 class USBWatcher(FileSystemEventHandler):
@@ -72,6 +74,13 @@ class USBDataProvider(GenericDataProvider):
                         return scenarios_path
         return None
 
+    def get_session_path(self) -> str:
+        # Sessions are stored next to the scenarios, the root filesystem is volatile
+        usb_path = self.get_base_path()
+        if usb_path is None:
+            return SESSION_FALLBACK_PATH
+        return os.path.join(os.path.dirname(usb_path), "sessions")
+
     def __start_usb_monitor(self) -> None:
         handler = USBWatcher(self)
         self.observer = Observer()
@@ -105,5 +114,6 @@ class USBDataProvider(GenericDataProvider):
                                 trace_format=data["trace"]["format"],
                                 forward_file=data["trace"]["forward"],
                                 return_file=data["trace"]["return"],
-                                video=data.get("video", None))
+                                video=data.get("video", None),
+                                transform=TraceTransform.from_dict(data.get("transform", None)))
         return config
@@ -2,9 +2,10 @@ import subprocess
 import os
 import re
 
-from typing import List
+from typing import List, Optional
 
 from utils.logger import Logger
+from utils.helper import HelperClient
 
 def log_trace(func):
     def wrap(*args, **kwargs):
@@ -27,24 +28,50 @@ def log_trace(func):
 @log_trace
 def invoke_subprocess(command: List[str] | str, capture_output: bool = True,
                       shell: bool = True, sudo: bool = False, 
-                      dryrun: bool = False, log_debug: bool = False) -> subprocess.CompletedProcess:
+                      dryrun: bool = False, log_debug: bool = False,
+                      input: Optional[bytes] = None) -> subprocess.CompletedProcess:
     if dryrun:
         return subprocess.CompletedProcess("", returncode=0)
 
     sudo = False if os.geteuid() == 0 else sudo
 
+    # Executed by the privileged helper without sudo and shell, see utils/helper.py
+    if sudo and HelperClient.available():
+        try:
+            return HelperClient.run(command, input=input)
+        except OSError as ex:
+            Logger.warning(f"Privileged helper not reachable, using sudo: {ex}")
+
+    if isinstance(command, str) and sudo:
+        command = "sudo " + command
+    elif isinstance(command, list) and sudo:
+        command = ["sudo"] + command
+
+    return subprocess.run(command, capture_output=capture_output, shell=shell, input=input)
+
+@log_trace
+def start_subprocess(command: List[str] | str, shell: bool = True, sudo: bool = False,
+                     dryrun: bool = False, log_debug: bool = False, 
+                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) -> subprocess.Popen | None:
+    if dryrun:
+        return None
+
+    sudo = False if os.geteuid() == 0 else sudo
+
     if isinstance(command, str) and sudo:
         command = "sudo " + command
     elif isinstance(command, list) and sudo:
         command = ["sudo"] + command
 
-    return subprocess.run(command, capture_output=capture_output, shell=shell)
+    return subprocess.Popen(command, shell=shell, stdout=stdout, 
+                            stderr=stderr)
 
 def run_fail_on_error(command: List[str] | str, shell: bool = True, 
-                      sudo: bool = False, dryrun: bool = False, log_debug: bool = False) -> None:
+                      sudo: bool = False, dryrun: bool = False, log_debug: bool = False,
+                      input: Optional[bytes] = None) -> None:
     
     proc = invoke_subprocess(command, capture_output=True, shell=shell, 
-                             sudo=sudo, dryrun=dryrun, log_debug=log_debug)
+                             sudo=sudo, dryrun=dryrun, log_debug=log_debug, input=input)
 
     if proc.returncode != 0:
         raise Exception(f"Command failed: {proc.stderr.decode("utf-8")}")
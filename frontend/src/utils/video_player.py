@@ -24,6 +24,11 @@ class VideoPlayer:
             Logger.error(f"Unable to open Video file: {video_path}: {ex}")
             self.cap = None
 
+        self.fps = 25.0
+        if self.cap is not None:
+            self.fps = self.cap.get(cv2.CAP_PROP_FPS) or self.fps
+        self.frame_index = None
+
     def __del__(self):
         if self.cap is not None and self.cap.isOpened():
             self.cap.release()
@@ -34,7 +39,18 @@ class VideoPlayer:
         if self.cap is None:
             return
 
-        self.cap.set(cv2.CAP_PROP_POS_MSEC, secs * 1000)
+        index = int(secs * self.fps)
+        if index == self.frame_index:
+            return
+
+        # Decoding forward is much cheaper than seeking, seek only on jumps
+        if self.frame_index is not None and self.frame_index < index <= self.frame_index + self.fps:
+            for _ in range(index - self.frame_index - 1):
+                self.cap.grab()
+        else:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, secs * 1000)
+
+        self.frame_index = index
         ret, frame = self.cap.read()
 
         if not ret or frame is None: